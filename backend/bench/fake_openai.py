@@ -0,0 +1,229 @@
+#fake_openai.py
+#벤치마크용 OpenAI 호환 가짜 서버 (POST /v1/chat/completions)
+#네트워크 없이 응답 지연만 흉내 낸다. 슬롯 추출 요청에는 {"updates": [...]}를, 그 외에는 공감 응답 문장을 돌려준다.
+#슬롯 추출 요청은 response_format(json_schema phq9_slot_updates)으로 알아보고, 스키마 없이 보낸 경우
+#(SLOT_STRUCTURED_OUTPUT=0)는 system 프롬프트의 출력 형식 예시("updates" 키)로 알아본다.
+#슬롯 업데이트는 요청에 담긴 응답 상태에서 첫 미응답 문항 하나를 답한 것으로 만들어, 세션이 끝까지 진행되게 한다
+#(--slot-json을 주면 항상 그 배열).
+#tools가 있으면(combined 모드) 첫 함수 호출에 {"bot_response", "updates"} 인자를 담아 돌려준다.
+#stream=true면 SSE 청크로 나눠 보낸다.
+#장애 주입: error_rate 비율의 요청은 error_status(기본 500)로, slow_rate 비율의 요청은 slow_ms만큼 더 늦게 응답한다.
+#실행 예시:
+#  python bench/fake_openai.py --port 8089 --latency-ms 300
+#  python bench/fake_openai.py --port 8089 --latency-ms 300 --slow-rate 0.05 --slow-ms 10000 --error-rate 0.02
+#  OPENAI_BASE_URL=http://127.0.0.1:8089/v1 python chatbot_service.py
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#slot_schema.build_slot_response_format의 json_schema 이름
+SLOT_SCHEMA_NAME = "phq9_slot_updates"
+DEFAULT_REPLY = "말씀해주셔서 고마워요. 최근 2주간 잠은 잘 주무셨나요? 얼마나 자주 잠을 설치셨는지 궁금해요."
+#첫 미응답 문항에 채워 넣는 답변
+SLOT_ANSWER = {
+    "status": "answered",
+    "score": 2,
+    "raw_user_input": "요즘 자주 그래요",
+    "freq_or_intensity": "자주",
+    "last_updated": None,
+}
+#응답 상태 형식별 미응답 문항 (slot_state.compact_slot_state / json_slot_state)
+COMPACT_PENDING_RE = re.compile(r"^미응답: (.*)$", re.MULTILINE)
+JSON_PENDING_RE = re.compile(r'"item": "([^"]+)", "status": "unanswered"')
+
+
+class FakeOpenAIConfig:
+    def __init__(self, latency_ms=0, reply=DEFAULT_REPLY, slot_json=None, chunk_chars=8,
+                 error_rate=0.0, error_status=500, slow_rate=0.0, slow_ms=0):
+        self.latency_ms = latency_ms
+        self.reply = reply
+        self.slot_json = slot_json
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+
+def is_slot_extraction(body):
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format.get("json_schema", {}).get("name") == SLOT_SCHEMA_NAME
+    if body.get("tools"):
+        return False
+    system = next((m.get("content") or "" for m in body.get("messages", []) if m.get("role") == "system"), "")
+    return '"updates"' in system
+
+
+def slot_updates(config, body):
+    if config.slot_json is not None:
+        return json.loads(config.slot_json)
+    user_text = "\n".join(m.get("content") or "" for m in body.get("messages", []) if m.get("role") == "user")
+    compact = COMPACT_PENDING_RE.search(user_text)
+    if compact:
+        pending = [name.strip() for name in re.sub(r"\([^)]*\)", "", compact.group(1)).split(",")]
+        pending = [name for name in pending if name and name != "없음"]
+    else:
+        pending = JSON_PENDING_RE.findall(user_text)
+    return [dict(SLOT_ANSWER, item=pending[0])] if pending else []
+
+
+def completion_content(config, body):
+    if is_slot_extraction(body):
+        return json.dumps({"updates": slot_updates(config, body)}, ensure_ascii=False)
+    return config.reply
+
+
+def tool_call_message(config, body):
+    name = body["tools"][0]["function"]["name"]
+    arguments = json.dumps({"bot_response": config.reply, "updates": slot_updates(config, body)}, ensure_ascii=False)
+    return {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                        "function": {"name": name, "arguments": arguments}}],
+    }
+
+
+def completion_body(body, content, message=None):
+    prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+    message = message or {"role": "assistant", "content": content}
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 2,
+            "completion_tokens": len(content) // 2,
+            "total_tokens": (prompt_chars + len(content)) // 2,
+        },
+    }
+
+
+def chunk_body(body, completion_id, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            length = int(self.headers.get("Content-Length", "0"))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            config.count()
+            content = completion_content(config, body)
+            latency_ms = config.latency_ms
+            if config.slow_rate and random.random() < config.slow_rate:
+                latency_ms += config.slow_ms
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            if config.error_rate and random.random() < config.error_rate:
+                self._send_error_json(config.error_status)
+                return
+            if body.get("tools"):
+                message = tool_call_message(config, body)
+                self._send_json(completion_body(body, message["tool_calls"][0]["function"]["arguments"], message))
+            elif body.get("stream"):
+                self._stream(body, content)
+            else:
+                self._send_json(completion_body(body, content))
+
+        def _send_error_json(self, status):
+            self._send_json({"error": {"message": "injected error", "type": "server_error", "code": None}}, status)
+
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, body, content):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            chunks = [{"role": "assistant", "content": ""}]
+            chunks += [{"content": content[i:i + config.chunk_chars]} for i in range(0, len(content), config.chunk_chars)]
+            for delta in chunks:
+                self._event(chunk_body(body, completion_id, delta))
+            self._event(chunk_body(body, completion_id, {}, "stop"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+        def _event(self, payload):
+            self.wfile.write(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_fake_openai(config=None, host="127.0.0.1", port=0):
+    """
+    백그라운드 스레드에서 가짜 서버를 띄우고 (server, base_url)을 반환한다. port=0이면 빈 포트를 쓴다.
+    """
+    config = config or FakeOpenAIConfig()
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI 호환 가짜 서버 (벤치마크용)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--reply", default=DEFAULT_REPLY)
+    parser.add_argument("--slot-json", help="슬롯 추출 응답으로 항상 돌려줄 JSON 배열 (생략하면 첫 미응답 문항)")
+    parser.add_argument("--error-rate", type=float, default=0, help="오류로 응답할 요청 비율")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--slow-rate", type=float, default=0, help="느리게 응답할 요청 비율")
+    parser.add_argument("--slow-ms", type=float, default=0, help="느린 요청에 더할 지연")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai(
+        FakeOpenAIConfig(args.latency_ms, args.reply, args.slot_json, error_rate=args.error_rate,
+                         error_status=args.error_status, slow_rate=args.slow_rate, slow_ms=args.slow_ms),
+        args.host, args.port,
+    )
+    print(f"fake OpenAI server: {base_url} (latency {args.latency_ms}ms)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,454 @@
+#run_bench.py
+#오프라인 벤치마크: 가짜 OpenAI 서버 + mongomock(또는 로컬 mongod)으로 마이크로/엔드투엔드 성능을 재고 JSON으로 저장한다.
+#실행 예시 (backend 디렉터리에서):
+#  python bench/run_bench.py --out bench_results.json
+#  python bench/run_bench.py --latency-ms 300 --concurrency 8 --sessions 16
+#  LLM_HEDGE_AFTER=0.5 python bench/run_bench.py --latency-ms 300 --slow-rate 0.05 --slow-ms 5000   # 헤징 효과 비교
+#  python bench/run_bench.py --mongo-uri mongodb://localhost:27017 --out after.json --compare before.json
+#mongomock이 없으면 pip install mongomock 또는 --mongo-uri로 로컬 mongod를 지정한다.
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import pymongo
+from pymongo import monitoring
+
+from fake_openai import FakeOpenAIConfig, start_fake_openai
+
+#대화형 엔드포인트에 보낼 사용자 발화 (순서대로 돌려 씀)
+CHAT_MESSAGES = [
+    "요즘 기분이 많이 가라앉아요",
+    "거의 매일 그런 것 같아요",
+    "잠도 잘 못 자요",
+    "일주일에 서너 번 정도요",
+    "입맛도 별로 없어요",
+    "며칠 정도요",
+    "집중이 잘 안 돼요",
+    "절반 이상은 그래요",
+    "그런 생각은 전혀 없어요",
+]
+FIXED_TURNS = 11  #시작 + 9문항 답변 + 완료 요약
+
+MONGO_OPS = ("find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one",
+             "update_many", "replace_one", "delete_one", "delete_many", "bulk_write", "count_documents",
+             "aggregate")
+IGNORED_COMMANDS = {"createIndexes", "listIndexes", "dropIndexes", "endSessions", "hello", "ismaster", "ping"}
+
+
+class OpCounter(monitoring.CommandListener):
+    """MongoDB 명령 수를 센다 (실제 mongod는 CommandListener, mongomock은 컬렉션 메서드 래핑)"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self.count += n
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+    def started(self, event):
+        if event.command_name not in IGNORED_COMMANDS:
+            self.add()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def mongomock_bulk_write(self, requests, ordered=True, **kwargs):
+    """
+    mongomock의 bulk_write는 최신 pymongo의 UpdateOne(sort 인자)을 받지 못하므로 연산별 메서드로 나눠 실행한다.
+    벤치마크에서만 쓰며, 이 bulk_write 한 번이 MongoDB 연산 하나로 세어진다.
+    """
+    for op in requests:
+        if isinstance(op, pymongo.UpdateOne):
+            self.update_one(op._filter, op._doc, upsert=op._upsert)
+        elif isinstance(op, pymongo.InsertOne):
+            self.insert_one(op._doc)
+        else:
+            raise NotImplementedError(f"벤치마크용 bulk_write가 지원하지 않는 연산: {type(op).__name__}")
+
+
+def patch_mongomock(counter):
+    import mongomock
+
+    shared_client = mongomock.MongoClient()
+    mongomock.collection.Collection.bulk_write = mongomock_bulk_write
+    #mongomock 내부에서 다른 컬렉션 메서드를 부르는 경우(find_one → find 등)는 세지 않는다
+    depth = threading.local()
+    for name in MONGO_OPS:
+        original = getattr(mongomock.collection.Collection, name)
+
+        def counted(self, *args, __original=original, **kwargs):
+            if getattr(depth, "value", 0) == 0:
+                counter.add()
+            depth.value = getattr(depth, "value", 0) + 1
+            try:
+                return __original(self, *args, **kwargs)
+            finally:
+                depth.value -= 1
+
+        setattr(mongomock.collection.Collection, name, counted)
+    pymongo.MongoClient = lambda *args, **kwargs: shared_client
+    return shared_client
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies_s, elapsed_s, requests, errors, ops):
+    values = sorted(v * 1000 for v in latencies_s)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(values), 3) if values else None,
+        "p50_ms": round(percentile(values, 50), 3) if values else None,
+        "p95_ms": round(percentile(values, 95), 3) if values else None,
+        "p99_ms": round(percentile(values, 99), 3) if values else None,
+        "rps": round(requests / elapsed_s, 2) if elapsed_s else None,
+        "mongo_ops_per_turn": round(ops / requests, 2) if requests else None,
+    }
+
+
+def time_call(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": round(statistics.fmean(samples) * 1e6, 3),
+        "p50_us": round(percentile(samples, 50) * 1e6, 3),
+        "p95_us": round(percentile(samples, 95) * 1e6, 3),
+    }
+
+
+def run_micro(cs, iterations):
+    from slot_store import PHQ9_ITEMS, init_slot_structure, update_slot_structure
+    slot_json = json.dumps([
+        {"item": item, "status": "answered", "score": 2, "raw_user_input": "거의 매일 그래요",
+         "freq_or_intensity": "거의 매일", "last_updated": None}
+        for item in PHQ9_ITEMS[:3]
+    ], ensure_ascii=False)
+    gpt_text = f"다음은 결과입니다.\n```json\n{slot_json}\n```\n참고하세요."
+    schema_text = f'{{"updates": {slot_json}}}'
+    new_slot_data = json.loads(slot_json)
+    base_doc = init_slot_structure("bench_user")
+    #update_slot_structure는 문서를 제자리에서 바꾸므로 반복마다 새 사본을 미리 만들어 둔다
+    docs = [copy.deepcopy(base_doc) for _ in range(iterations)]
+    doc_iter = iter(docs)
+    answered = copy.deepcopy(base_doc)
+    for slot in answered["slots"]:
+        slot.update(status="answered", score=1, raw_user_input="며칠 정도 그랬어요")
+    edited_map = {answered["slots"][0]["item"]: "수정한 답변", answered["slots"][4]["item"]: "수정한 답변 2"}
+
+    return {
+        "parse_slot_updates": time_call(lambda: cs.slot_update_parser.parse_dicts(gpt_text), iterations),
+        "parse_slot_updates_schema": time_call(lambda: cs.slot_update_parser.parse_dicts(schema_text), iterations),
+        "update_slot_structure": time_call(lambda: update_slot_structure(next(doc_iter), new_slot_data), iterations),
+        "build_original_summary": time_call(lambda: cs.build_original_summary(answered["slots"]), iterations),
+        "build_edited_summary": time_call(lambda: cs.build_edited_summary(answered["slots"], edited_map), iterations),
+    }
+
+
+def chat_session(path, turns):
+    def run(client, user_id):
+        for i in range(turns):
+            yield client.post(path, json={"message": CHAT_MESSAGES[i % len(CHAT_MESSAGES)], "user_id": user_id})
+    return run
+
+
+def fixed_session(path):
+    def run(client, user_id):
+        for i in range(FIXED_TURNS):
+            yield client.post(path, json={"message": f"답변 {i}" if i else None, "user_id": user_id})
+    return run
+
+
+def stream_session(path, turns):
+    def run(client, user_id):
+        for i in range(turns):
+            response = client.post(path, json={"message": CHAT_MESSAGES[i % len(CHAT_MESSAGES)], "user_id": user_id})
+            response.get_data()  #스트림을 끝까지 읽어야 응답 시간이 잡힌다
+            yield response
+    return run
+
+
+def summary_edit_session(turns):
+    def run(client, user_id):
+        for i in range(turns):
+            yield client.post("/api/summary/edit", json={
+                "user_id": user_id,
+                "edited_items": [{"item": "수면 문제", "edited_answer": f"수정 {i}"}],
+            })
+    return run
+
+
+def sse_events(body):
+    """SSE 응답 본문에서 이벤트 이름 목록을 꺼낸다."""
+    return [line[len("event:"):].strip() for line in body.splitlines() if line.startswith("event:")]
+
+
+def response_failed(response):
+    """
+    4xx/5xx면 실패. 스트리밍 응답은 상태 코드가 항상 200이므로
+    error 이벤트가 있거나 마지막 이벤트가 done이 아니면 실패로 센다.
+    """
+    if response.status_code >= 400:
+        return True
+    if response.mimetype == "text/event-stream":
+        events = sse_events(response.get_data(as_text=True))
+        return "error" in events or not events or events[-1] != "done"
+    return False
+
+
+#GPT를 호출해야 하는 라우트 (턴당 GPT 호출 수가 0이면 측정이 잘못된 것)
+LLM_ROUTES = {"/api/chat", "/api/phq9_high_c_low_u", "/api/chat/stream", "/api/phq9_high_c_low_u/stream"}
+
+
+#세션 상태 문서 (데이터베이스, 컬렉션). 모든 세션이 끝까지 진행됐는지(completed_at) 확인할 라우트
+SESSION_COLLECTIONS = {
+    "/api/chat": ("phq9_chatbot", "slots"),
+    "/api/phq9_high_c_low_u": ("phq9_high_c_low_u", "slots"),
+    "/api/chat/stream": ("phq9_chatbot", "slots"),
+    "/api/phq9_high_c_low_u/stream": ("phq9_high_c_low_u", "slots"),
+    "/api/phq9_fixed": ("phq9_fixed_db", "slots"),
+    "/api/phq9_fixed_editable": ("phq9_fixed_editable", "slots"),
+}
+
+
+def route_user_prefix(run_id, route):
+    return f"bench_{run_id}_{route.strip('/').replace('/', '_')}_"
+
+
+def completed_sessions(mongo_client, route, run_id):
+    db_name, coll_name = SESSION_COLLECTIONS[route]
+    return mongo_client[db_name][coll_name].count_documents({
+        "user_id": {"$regex": "^" + re.escape(route_user_prefix(run_id, route))},
+        "completed_at": {"$ne": None},
+    })
+
+
+def build_routes(turns):
+    return {
+        "/api/chat": chat_session("/api/chat", turns),
+        "/api/phq9_high_c_low_u": chat_session("/api/phq9_high_c_low_u", turns),
+        "/api/chat/stream": stream_session("/api/chat/stream", turns),
+        "/api/phq9_high_c_low_u/stream": stream_session("/api/phq9_high_c_low_u/stream", turns),
+        "/api/phq9_fixed": fixed_session("/api/phq9_fixed"),
+        "/api/phq9_fixed_editable": fixed_session("/api/phq9_fixed_editable"),
+        "/api/summary/edit": summary_edit_session(turns),
+    }
+
+
+def run_route(app, session_fn, route, sessions, concurrency, counter, run_id, drain=None):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(session_idx):
+        nonlocal errors
+        client = app.test_client()
+        user_id = f"{route_user_prefix(run_id, route)}{session_idx}"
+        responses = session_fn(client, user_id)
+        while True:
+            start = time.perf_counter()
+            try:
+                response = next(responses)
+            except StopIteration:
+                return
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response_failed(response):
+                    errors += 1
+
+    counter.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(sessions)))
+    elapsed = time.perf_counter() - start
+    #write-behind로 미뤄진 쓰기도 이 라우트의 MongoDB 연산 수에 포함
+    if drain is not None:
+        drain()
+    return summarize(latencies, elapsed, len(latencies), errors, counter.count)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """baseline 대비 p50/p95가 threshold(비율) 이상 느려졌거나 mongo_ops_per_turn이 늘어난 항목을 반환한다."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    for route, current in results["e2e"].items():
+        before = baseline.get("e2e", {}).get(route)
+        if not before:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if before.get(key) and current.get(key) and current[key] > before[key] * (1 + threshold):
+                regressions.append(f"{route} {key}: {before[key]} → {current[key]}")
+        if (current.get("mongo_ops_per_turn") or 0) > (before.get("mongo_ops_per_turn") or 0) + 1e-9:
+            regressions.append(f"{route} mongo_ops_per_turn: {before.get('mongo_ops_per_turn')} → {current['mongo_ops_per_turn']}")
+    #고정 프리픽스가 커지면 모든 턴의 입력 토큰이 늘어난다
+    for name, current in results.get("prompts", {}).items():
+        before = baseline.get("prompts", {}).get(name)
+        if before and current["static_prefix_tokens"] > before["static_prefix_tokens"]:
+            regressions.append(f"{name} static_prefix_tokens: {before['static_prefix_tokens']} → {current['static_prefix_tokens']}")
+    for name, current in results["micro"].items():
+        before = baseline.get("micro", {}).get(name)
+        if before and current["p50_us"] > before["p50_us"] * (1 + threshold):
+            regressions.append(f"{name} p50_us: {before['p50_us']} → {current['p50_us']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PHQ-9 챗봇 오프라인 벤치마크")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--latency-ms", type=float, default=50, help="가짜 OpenAI 응답 지연")
+    parser.add_argument("--error-rate", type=float, default=0, help="가짜 OpenAI 서버가 500으로 응답할 비율")
+    parser.add_argument("--slow-rate", type=float, default=0, help="가짜 OpenAI 서버가 느리게 응답할 비율")
+    parser.add_argument("--slow-ms", type=float, default=0, help="느린 응답에 더할 지연")
+    parser.add_argument("--sessions", type=int, default=8, help="엔드포인트별 사용자 세션 수")
+    parser.add_argument("--turns", type=int, default=9, help="대화형 엔드포인트 세션당 턴 수")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--micro-iterations", type=int, default=2000)
+    parser.add_argument("--routes", nargs="*", help="측정할 라우트 (기본: 전체)")
+    parser.add_argument("--mongo-uri", help="로컬 mongod 주소 (생략하면 mongomock)")
+    parser.add_argument("--openai-base-url", help="이미 떠 있는 가짜/실제 OpenAI 호환 서버 (생략하면 내장 가짜 서버)")
+    parser.add_argument("--keep-llm-cache", action="store_true", help="GPT 응답 캐시를 켠 채로 측정")
+    parser.add_argument("--compare", help="이전 결과 JSON과 비교해 회귀가 있으면 종료 코드 1")
+    parser.add_argument("--threshold", type=float, default=0.2, help="회귀로 볼 느려짐 비율")
+    args = parser.parse_args()
+
+    fake_config = None
+    if args.openai_base_url:
+        base_url = args.openai_base_url
+    else:
+        fake_config = FakeOpenAIConfig(latency_ms=args.latency_ms, error_rate=args.error_rate,
+                                       slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+        _, base_url = start_fake_openai(fake_config)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    if not args.keep_llm_cache:
+        os.environ["LLM_CACHE_SIZE"] = "0"
+
+    counter = OpCounter()
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        monitoring.register(counter)
+        mongo_backend = "mongod"
+    else:
+        try:
+            patch_mongomock(counter)
+        except ImportError:
+            sys.exit("mongomock이 없습니다: pip install mongomock 또는 --mongo-uri로 로컬 mongod 지정")
+        mongo_backend = "mongomock"
+
+    import chatbot_service as cs
+    from prompts import prompt_token_report
+    logging.getLogger().setLevel(logging.WARNING)
+
+    routes = build_routes(args.turns)
+    selected = args.routes or list(routes)
+    run_id = datetime.datetime.now().strftime("%H%M%S")
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "mongo": mongo_backend,
+            "openai_base_url": base_url,
+            "args": vars(args),
+        },
+        "micro": run_micro(cs, args.micro_iterations),
+        "prompts": prompt_token_report(cs.PROMPT_TEMPLATES),
+        "e2e": {},
+    }
+    failures = []
+    for route in selected:
+        before_llm = fake_config.requests if fake_config else None
+        before_fallback = cs.metrics.llm_resilience_events.total(event="fallback")
+        before_rejected = cs.metrics.slot_updates_rejected.total()
+        drain = cs.dialog_writer.flush if cs.dialog_writer is not None else None
+        stats = run_route(cs.app, routes[route], route, args.sessions, args.concurrency, counter, run_id, drain)
+        #고정 질문으로 대신 응답한 턴은 200이지만 GPT 응답을 받지 못한 턴이다
+        stats["fallback_turns"] = cs.metrics.llm_resilience_events.total(event="fallback") - before_fallback
+        #슬롯 추출 응답이 검증에서 버려지면 상태 코드는 200이어도 세션이 진행되지 않는다
+        stats["slot_updates_rejected"] = cs.metrics.slot_updates_rejected.total() - before_rejected
+        if route in SESSION_COLLECTIONS:
+            stats["completed_sessions"] = completed_sessions(cs.mongo_client, route, run_id)
+        if fake_config:
+            stats["llm_calls_per_turn"] = round((fake_config.requests - before_llm) / stats["requests"], 2)
+            if route in LLM_ROUTES and not stats["llm_calls_per_turn"]:
+                failures.append(f"{route}: GPT 호출이 한 번도 없음 (llm_calls_per_turn 0)")
+        if stats["errors"]:
+            failures.append(f"{route}: 실패 응답 {stats['errors']}건")
+        if stats["fallback_turns"] and not (args.error_rate or args.slow_rate):
+            failures.append(f"{route}: 장애 주입 없이 고정 질문 대체 {stats['fallback_turns']}건")
+        if stats["slot_updates_rejected"]:
+            failures.append(f"{route}: 슬롯 업데이트 거부 {stats['slot_updates_rejected']}건")
+        if stats.get("completed_sessions") == 0:
+            failures.append(f"{route}: 끝까지 진행된 세션 없음")
+        results["e2e"][route] = stats
+        print(f"{route:32s} p50 {stats['p50_ms']:>9}ms  p95 {stats['p95_ms']:>9}ms  p99 {stats['p99_ms']:>9}ms  "
+              f"{stats['rps']:>8} rps  mongo ops/turn {stats['mongo_ops_per_turn']}  errors {stats['errors']}  "
+              f"fallbacks {stats['fallback_turns']}  rejected {stats['slot_updates_rejected']}  "
+              f"completed {stats.get('completed_sessions', '-')}")
+    for name, stats in results["micro"].items():
+        print(f"{name:32s} p50 {stats['p50_us']:>9}us  p95 {stats['p95_us']:>9}us")
+    for name, report in results["prompts"].items():
+        print(f"{name:32s} system {report['system_tokens']} tok  static prefix {report['static_prefix_tokens']} tok"
+              + ("" if report["exact"] else " (추정값)"))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"결과 저장: {args.out}")
+
+    for line in failures:
+        print(f"실패: {line}")
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+    for line in regressions:
+        print(f"회귀: {line}")
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
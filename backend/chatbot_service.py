@@ -1,16 +1,39 @@
 #chatbot_service.py
-from flask import Flask, request, jsonify
+import time
+_import_started_at = time.perf_counter()  #시작 시간 측정 (import 단계)
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import logging
 import os
 import datetime
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from pymongo import MongoClient
 import pytz
 import json
-import re
+import sys
+import atexit
+import contextvars
+import hmac
 from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from phq9_rules import rule_based_slot_update, is_crisis_turn, match_items, CRISIS_ITEM
+from prompts import build_prompt_templates, log_prompt_usage, count_tokens
+from llm_cache import CompletionCache, MongoCacheBackend
+from mongo_indexes import ensure_indexes
+from session_history import SessionHistoryStore, parse_client_history
+from questionnaire import Questionnaire
+from slot_state import compact_slot_state, json_slot_state, slot_state_tokens
+from llm_resilience import ResilientCompletions, CircuitBreaker, LLMUnavailableError
+from llm_admission import AdmissionController, AdmissionRejected, PRIORITY_CRISIS, PRIORITY_ROUTINE, current_ticket
+from llm_backends import OpenAIBackend, LocalSeq2SeqBackend, BackendRouter, parse_backend_routes
+from slot_schema import SlotUpdateParser, build_slot_response_format, build_turn_tool, TURN_TOOL_NAME
+from dialog_store import dialog_message, append_dialog_messages, DialogWriter
+from slot_store import PHQ9_ITEMS, load_slot_doc, persist_slot_updates, clean_edited_items, save_edited_answers
+from lazy_resources import LazyResource
+from cohort_analytics import CohortAnalytics
+from study_export import iter_export_rows, ndjson_lines, parse_watermark, format_watermark, select_sources, export_now
+import metrics
 #환경 설정
 load_dotenv()
 app = Flask(__name__)
@@ -18,73 +41,171 @@ CORS(app, supports_credentials=True, origins=["http://115.145.36.231:3000"])
 logging.basicConfig(level=logging.INFO)
 
 #OpenAI & MongoDB 클라이언트 설정
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-mongo_client = MongoClient(os.environ.get("MONGO_URI"))
+#클라이언트는 import 시점이 아니라 각 프로세스에서 처음 쓸 때 만든다 (lazy_resources.py, pre-fork 워커마다 따로 생성)
+#MongoDB 커넥션 풀: 워커 수 × MONGO_MAX_POOL_SIZE가 서버 연결 수 상한이 된다
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ["MONGO_MAX_IDLE_TIME_MS"]) if os.environ.get("MONGO_MAX_IDLE_TIME_MS") else None
+#OpenAI HTTP 커넥션 풀: 턴 사이에 TLS 연결을 다시 맺지 않도록 keep-alive 연결을 OPENAI_KEEPALIVE_EXPIRY초 동안 유지
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "60"))
+
+
+def mongo_pool_options():
+    return dict(maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE, maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS)
+
+
+def openai_http_client(async_client=False):
+    """
+    커넥션 풀 설정을 넣은 OpenAI SDK 기본 HTTP 클라이언트. SDK 버전에 따라 httpx 대신 SDK가 포함한 호환 라이브러리를 쓰므로
+    Limits는 DefaultHttpxClient가 상속한 클라이언트의 모듈에서 가져온다. 찾지 못하면 None (SDK 기본 풀 사용).
+    """
+    http_module = sys.modules.get(DefaultHttpxClient.__mro__[1].__module__.split(".")[0])
+    limits_cls = getattr(http_module, "Limits", None)
+    if limits_cls is None:
+        logging.warning("OpenAI HTTP 커넥션 풀 설정을 적용하지 못해 SDK 기본값을 사용")
+        return None
+    limits = limits_cls(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+    return DefaultAsyncHttpxClient(limits=limits) if async_client else DefaultHttpxClient(limits=limits)
+
+
+def create_openai_client():
+    #SDK 자체 재시도는 끄고 ResilientCompletions에서 제한 시간/재시도/헤징/서킷 브레이커를 처리한다
+    return OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0, http_client=openai_http_client())
+
+
+def create_mongo_client():
+    return MongoClient(os.environ.get("MONGO_URI"), event_listeners=[metrics.MongoMetricsListener()], **mongo_pool_options())
+
+
+client = LazyResource("openai", create_openai_client, on_create=metrics.record_startup)
+mongo_client = LazyResource("mongo", create_mongo_client, on_create=metrics.record_startup)
 db = mongo_client["phq9_chatbot"]
 slot_collection = db["slots"]
 edited_collection = db["edited_summaries"]   # 사용자가 수정한 요약문 저장용 (1단계에서는 아직 안 씀)
 
-#PHQ-9 항목 정의
-PHQ9_ITEMS = [
-    "흥미나 즐거움 감소", "우울감", "수면 문제", "피로감", "식욕 변화",
-    "자기비하", "집중력 저하", "정신 운동성 지연 또는 초조", "자살 생각"
-]
+#응답 생성 GPT 호출과 슬롯 추출 GPT 호출을 동시에 보낼지 여부 (CONCURRENT_LLM_CALLS=0이면 순차 실행)
+CONCURRENT_LLM_CALLS = os.environ.get("CONCURRENT_LLM_CALLS", "1") != "0"
+llm_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("LLM_EXECUTOR_WORKERS", "16")))
+#GPT 호출 제한 시간(초)과 재시도 정책 (LLM_HEDGE_AFTER=0이면 헤징 안 함, LLM_BREAKER_FAILURES=0이면 서킷 브레이커 끔)
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "20"))
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "30"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+LLM_HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", "0"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+#GPT 호출 입장 제어 (워커 프로세스마다 적용, LLM_MAX_CONCURRENT=0이면 끔, LLM_TOKENS_PER_MINUTE=0이면 토큰 예산 없음)
+#gunicorn은 스레드 수보다 작게 잡거나 전체 한도(LLM_MAX_CONCURRENT_TOTAL)를 워커 수로 나눠 넣는다 (gunicorn.conf.py)
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "6"))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_ADMISSION_QUEUE = int(os.environ.get("LLM_ADMISSION_QUEUE", "200"))
+LLM_ADMISSION_MAX_WAIT = float(os.environ.get("LLM_ADMISSION_MAX_WAIT", "10"))
+LLM_ADMISSION_CRISIS_MAX_WAIT = float(os.environ.get("LLM_ADMISSION_CRISIS_MAX_WAIT", "30"))
+#턴 하나의 토큰 추정치 = 대화 맥락 토큰 × 2(응답 생성/슬롯 추출 프롬프트에 모두 들어감) + 프롬프트 템플릿/출력 몫
+#턴이 끝나면 response.usage의 실제 사용량으로 보정한다
+LLM_TURN_TOKEN_OVERHEAD = int(os.environ.get("LLM_TURN_TOKEN_OVERHEAD", "2000"))
+llm_admission = AdmissionController(
+    max_concurrent=LLM_MAX_CONCURRENT,
+    tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+    max_queue=LLM_ADMISSION_QUEUE,
+    max_wait=LLM_ADMISSION_MAX_WAIT,
+    crisis_max_wait=LLM_ADMISSION_CRISIS_MAX_WAIT,
+    on_event=metrics.record_admission_event,
+    on_wait=metrics.record_admission_wait,
+)
+
+
+def resilient_completions(create_fn):
+    return ResilientCompletions(
+        create_fn,
+        timeout=LLM_TIMEOUT,
+        deadline=LLM_DEADLINE,
+        max_retries=LLM_MAX_RETRIES,
+        hedge_after=LLM_HEDGE_AFTER,
+        breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET),
+        on_event=metrics.record_resilience_event,
+    )
+
+
+def openai_create(**kwargs):
+    #client를 호출 시점에 찾으므로 워커마다 자기 클라이언트를 쓴다
+    return client.chat.completions.create(**kwargs)
+
+
+llm_completions = resilient_completions(openai_create)
+#LLM 백엔드 선택 (llm_backends.py): 기본은 OpenAI, LLM_BACKEND_ROUTES로 엔드포인트/단계별로 로컬 모델을 쓸 수 있다
+#예: LLM_BACKEND_ROUTES="slot_extraction=local" LOCAL_LLM_MODEL=google/flan-t5-base
+LLM_MODEL = os.environ.get("LLM_MODEL", "gpt-4o")
+LLM_DEFAULT_BACKEND = os.environ.get("LLM_DEFAULT_BACKEND", "openai")
+LLM_BACKEND_ROUTES = parse_backend_routes(os.environ.get("LLM_BACKEND_ROUTES", ""))
+local_llm_backend = None
+if "local" in set(LLM_BACKEND_ROUTES.values()) | {LLM_DEFAULT_BACKEND}:
+    #모델은 서버 시작 시 한 번만 올린다 (preload_app이면 마스터에서 올리고 워커는 fork로 공유, 배치 스레드는 워커마다 시작)
+    local_llm_backend = LocalSeq2SeqBackend(
+        os.environ["LOCAL_LLM_MODEL"],
+        kind=os.environ.get("LOCAL_LLM_KIND", "seq2seq"),
+        max_batch_size=int(os.environ.get("LOCAL_LLM_BATCH_SIZE", "8")),
+        batch_wait_ms=float(os.environ.get("LOCAL_LLM_BATCH_WAIT_MS", "10")),
+        max_input_tokens=int(os.environ.get("LOCAL_LLM_MAX_INPUT_TOKENS", "1024")),
+        timeout=LLM_TIMEOUT,
+        num_threads=int(os.environ["LOCAL_LLM_THREADS"]) if os.environ.get("LOCAL_LLM_THREADS") else None,
+    )
+
+
+def build_llm_router(completions):
+    """completions: OpenAI 호출용 ResilientCompletions (동기/비동기 앱이 각자 만든 것)"""
+    backends = {"openai": OpenAIBackend(completions)}
+    if local_llm_backend is not None:
+        backends["local"] = local_llm_backend
+    return BackendRouter(backends, LLM_BACKEND_ROUTES, LLM_DEFAULT_BACKEND)
+
+
+llm_router = build_llm_router(llm_completions)
+#temperature=0 GPT 응답 캐시 (LLM_CACHE_SIZE=0이면 끔, LLM_CACHE_SHARED=1이면 MongoDB 공유 캐시도 사용)
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "600"))
+completion_cache = None
+if LLM_CACHE_SIZE > 0:
+    completion_cache = CompletionCache(
+        max_entries=LLM_CACHE_SIZE,
+        ttl_seconds=LLM_CACHE_TTL,
+        backend=MongoCacheBackend(db["llm_cache"], LLM_CACHE_TTL) if os.environ.get("LLM_CACHE_SHARED") == "1" else None,
+        on_event=metrics.record_cache_event,
+    )
+#슬롯 추출 프롬프트의 응답 상태 형식 (compact: 필요한 정보만, json: 기존 전체 슬롯 JSON)
+#SLOT_STATE_MEASURE=1이면 턴마다 두 형식의 토큰 수를 로그로 남긴다
+SLOT_STATE_FORMAT = os.environ.get("SLOT_STATE_FORMAT", "compact")
+SLOT_STATE_MEASURE = os.environ.get("SLOT_STATE_MEASURE") == "1"
+#서버 측 대화 이력: 사용자별 최근 메시지 수/토큰 예산 (HISTORY_CACHE_SIZE=0이면 메모리 캐시 없이 매 턴 MongoDB에서 읽음)
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "6"))
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS", "1500"))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "10000"))
+
+
+def session_history_store(collection=None):
+    return SessionHistoryStore(collection, HISTORY_MAX_MESSAGES, HISTORY_MAX_TOKENS, HISTORY_CACHE_SIZE)
+
+
+chat_history_store = session_history_store(db["session_history"])
+#직전 질문 문항의 빈도 답변을 규칙 기반으로 먼저 처리할지 여부 (RULE_BASED_SLOTS=0이면 항상 GPT 슬롯 추출)
+RULE_BASED_SLOTS = os.environ.get("RULE_BASED_SLOTS", "1") != "0"
+#프롬프트 템플릿 (고정 지시문은 시작 시 한 번만 생성)
+PROMPT_TEMPLATES = build_prompt_templates(PHQ9_ITEMS)
+#슬롯 추출 응답 형식: item을 PHQ9_ITEMS enum으로 제한한 JSON 스키마 (SLOT_STRUCTURED_OUTPUT=0이면 기존처럼 자유 형식)
+SLOT_STRUCTURED_OUTPUT = os.environ.get("SLOT_STRUCTURED_OUTPUT", "1") == "1"
+SLOT_RESPONSE_FORMAT = build_slot_response_format(PHQ9_ITEMS)
+slot_update_parser = SlotUpdateParser(PHQ9_ITEMS, on_reject=metrics.record_slot_rejection)
+#응답 생성과 슬롯 추출을 함수 호출(report_turn) 한 번으로 합칠 엔드포인트 (예: COMBINED_LLM_ENDPOINTS=chat,phq9_high_c_low_u)
+#비어 있으면 기존처럼 두 번 호출한다. 스트리밍 엔드포인트는 항상 두 번 호출한다.
+COMBINED_LLM_ENDPOINTS = {e.strip() for e in os.environ.get("COMBINED_LLM_ENDPOINTS", "").split(",") if e.strip()}
+COMBINED_TEMPLATES = {"chat_reply": "chat_combined", "high_reply": "high_combined"}
+TURN_TOOL = build_turn_tool(PHQ9_ITEMS)
 
-#슬롯 초기화
-def init_slot_structure(user_id):
-    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
-    return {
-        "user_id": user_id,
-        "slots": [
-            {
-                "item": item,
-                "status": "unanswered",
-                "score": None,
-                "raw_user_input": None,
-                "freq_or_intensity": None,
-                "last_updated": None,
-            }
-            for item in PHQ9_ITEMS
-        ],
-        "last_updated": now
-    }
-
-#슬롯 업데이트 조건 확인 및 적용
-def update_slot_structure(slot_doc, new_slot_data):
-    updated = False
-    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
-
-    for new_slot in new_slot_data:
-        for existing in slot_doc["slots"]:
-            if existing["item"] == new_slot["item"]:
-                #score/freq_or_intensity가 null이 아니면 덮어씀
-                if new_slot.get("score") is not None and new_slot["score"] != existing.get("score"):
-                    existing["score"] = new_slot["score"]
-                    updated = True
-                if new_slot.get("freq_or_intensity") is not None and new_slot["freq_or_intensity"] != existing.get("freq_or_intensity"):
-                    existing["freq_or_intensity"] = new_slot["freq_or_intensity"]
-                    updated = True
-                #raw_user_input은 항상 최신으로 업데이트
-                if new_slot.get("raw_user_input") and new_slot["raw_user_input"] != existing.get("raw_user_input"):
-                    existing["raw_user_input"] = new_slot["raw_user_input"]
-                    updated = True
-
-                if ( #6월 25일자 코드 변경한거 
-                    new_slot.get("status")=="answered"
-                    and new_slot.get("freq_or_intensity") is not None
-                    and new_slot.get("score") is not None
-                    and existing['status']!='answered'
-                ):
-                    existing['status']='answered'
-                    updated=True
-                #업데이트되었을 경우 timestamp 갱신
-                if updated:
-                    existing["last_updated"] = now
-                break
-
-    if updated:
-        slot_doc["last_updated"] = now
-    return slot_doc
 
 def build_original_summary(slots):
     """
@@ -106,29 +227,464 @@ def build_edited_summary(slots, edited_map):
     return "\n\n".join(lines)
 
 
-def extract_json_array(text):
+def build_reply_request(unanswered_items, context_text, slot_doc, template_name="chat_reply"):
+    """
+    공감 응답 생성용 GPT 요청 인자를 만든다.
+    template_name: chat_reply(/api/chat) 또는 high_reply(/api/phq9_high_c_low_u)
+    """
+    return dict(
+        model=LLM_MODEL,
+        messages=PROMPT_TEMPLATES[template_name].render(
+            context_text=context_text,
+            answered_items=[s['item'] for s in slot_doc['slots'] if s['status']=='answered'],
+            unanswered_items=unanswered_items,
+        ),
+        temperature=0.0,
+        max_tokens=512,
+    )
+
+
+def build_slot_request(context_text, latest_user_input, slot_doc):
+    """
+    슬롯 추출용 GPT 요청 인자를 만든다. 봇 응답에 의존하지 않는다.
+    SLOT_STATE_FORMAT=compact(기본)이면 미응답/응답 완료/직전 질문 문항만 짧게 넣는다.
+    """
+    slots = slot_doc['slots']
+    if SLOT_STATE_MEASURE:
+        json_tokens, compact_tokens = slot_state_tokens(slots, slot_doc.get("last_asked_item"))
+        logging.info(f"슬롯 상태 토큰: json {json_tokens} → compact {compact_tokens} (절감 {json_tokens - compact_tokens})")
+    if SLOT_STATE_FORMAT == "compact":
+        messages = PROMPT_TEMPLATES["slot_extraction_compact"].render(
+            context_text=context_text,
+            latest_user_input=latest_user_input,
+            slot_state=compact_slot_state(slots, slot_doc.get("last_asked_item")),
+        )
+    else:
+        slot_state, answered_items = json_slot_state(slots)
+        messages = PROMPT_TEMPLATES["slot_extraction"].render(
+            context_text=context_text,
+            latest_user_input=latest_user_input,
+            slot_state=slot_state,
+            answered_items=answered_items,
+        )
+    request_kwargs = dict(
+        model=LLM_MODEL,
+        messages=messages,
+        temperature=0.0,
+        max_tokens=512,
+    )
+    if SLOT_STRUCTURED_OUTPUT:
+        request_kwargs["response_format"] = SLOT_RESPONSE_FORMAT
+    return request_kwargs
+
+
+def build_combined_request(unanswered_items, context_text, latest_user_input, slot_doc, template_name="chat_reply"):
+    """
+    combined 모드 GPT 요청 인자: 응답 문장과 슬롯 업데이트를 report_turn 함수 호출 하나로 받는다.
+    template_name: 두 번 호출 모드의 응답 템플릿 이름 (chat_reply, high_reply)
+    """
+    return dict(
+        model=LLM_MODEL,
+        messages=PROMPT_TEMPLATES[COMBINED_TEMPLATES[template_name]].render(
+            context_text=context_text,
+            latest_user_input=latest_user_input,
+            slot_state=compact_slot_state(slot_doc['slots'], slot_doc.get("last_asked_item")),
+            unanswered_items=unanswered_items,
+        ),
+        tools=[TURN_TOOL],
+        tool_choice={"type": "function", "function": {"name": TURN_TOOL_NAME}},
+        temperature=0.0,
+        max_tokens=1024,
+    )
+
+
+def parse_combined_response(response):
+    """
+    combined 응답을 (응답 문장, 슬롯 업데이트 리스트)로 만든다. 응답 문장을 얻지 못하면 (None, []).
+    """
+    message = response.choices[0].message
+    call = next((c for c in (message.tool_calls or []) if c.function.name == TURN_TOOL_NAME), None)
+    if call is None:
+        logging.warning(f"combined 응답에 {TURN_TOOL_NAME} 호출 없음")
+        metrics.record_slot_rejection("no_tool_call")
+        return (message.content or "").strip() or None, []
+    logging.info(f"GPT 함수 호출 인자 원문:\n{call.function.arguments}")
+    return slot_update_parser.parse_turn(call.function.arguments)
+
+
+def create_completion(stage="reply", **kwargs):
+    """
+    모든 GPT 호출의 진입점. llm_router가 고른 백엔드로 보내고, temperature=0 호출은 completion_cache를 거친다.
+    제한 시간/재시도 후에도 응답이 없거나 서킷 브레이커가 열려 있으면 LLMUnavailableError.
+    stage: 지표 라벨 (reply, slot_extraction, combined). 스트리밍 호출 시간은 호출한 쪽에서 기록한다.
+    """
+    started_at = time.perf_counter()
+    backend = llm_router.select(metrics.current_endpoint.get(), stage, kwargs)
+    if backend.model:
+        kwargs["model"] = backend.model
+
+    def backend_create(**call_kwargs):
+        #캐시 적중이 아닌 실제 호출의 토큰 사용량만 입장 제어 토큰 예산에 반영
+        response = backend.create(**call_kwargs)
+        ticket = current_ticket.get()
+        usage = getattr(response, "usage", None)
+        if ticket is not None and usage is not None:
+            ticket.record_usage(usage.total_tokens or 0)
+        return response
+
     try:
-        clean_text = re.sub(r"```(?:json)?", "", text).replace("```", "").strip()
+        if completion_cache is None:
+            response = backend_create(**kwargs)
+        else:
+            response = completion_cache.cached_create(backend_create, **kwargs)
+    except Exception:
+        metrics.record_llm_call(stage, time.perf_counter() - started_at, error=True)
+        raise
+    if not kwargs.get("stream"):
+        metrics.record_llm_call(stage, time.perf_counter() - started_at, response)
+    return response
 
-        #배열 단위가 아닌 객체 단위로 강제 분리해서 파싱 시도
-        matches = re.findall(r"{[^{}]+}", clean_text)
-        parsed_items = []
-        now_str = datetime.datetime.now(pytz.timezone('Asia/Seoul')).isoformat()
 
-        for match in matches:
-            try:
-                item = json.loads(match)
-                item["last_updated"] = now_str  # 서버에서 강제로 갱신
-                parsed_items.append(item)
-            except Exception as e:
-                logging.warning(f"JSON 항목 파싱 실패: {match} → {e}")
-                continue
+def submit_in_context(fn, *args, **kwargs):
+    #llm_executor 스레드에서도 현재 요청의 지표 라벨이 유지되도록 컨텍스트를 복사해서 넘긴다
+    return llm_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
 
-        return parsed_items
 
-    except Exception as e:
-        logging.warning(f"JSON 배열 추출 실패: {e}")
+def create_completion_or_none(kwargs, stage="reply"):
+    try:
+        return create_completion(stage, **kwargs)
+    except LLMUnavailableError as e:
+        logging.warning(f"GPT 호출 실패({stage}): {e}")
+        return None
+
+
+def run_reply_and_slot_calls(reply_kwargs, slot_kwargs):
+    """
+    응답 생성 호출과 슬롯 추출 호출을 실행하고 (응답, 슬롯 추출 응답)을 반환한다.
+    슬롯 추출 프롬프트는 봇 응답에 의존하지 않으므로 두 호출을 동시에 보낼 수 있다.
+    slot_kwargs가 None이면(규칙 기반으로 슬롯을 채운 경우) 응답 생성만 호출한다.
+    GPT 장애(LLMUnavailableError)로 응답을 받지 못한 호출은 None이다.
+    """
+    slot_response = None
+    if slot_kwargs is None:
+        response = create_completion_or_none(reply_kwargs)
+    elif not CONCURRENT_LLM_CALLS:
+        response = create_completion_or_none(reply_kwargs)
+        slot_response = create_completion_or_none(slot_kwargs, "slot_extraction")
+    else:
+        #슬롯 추출은 스레드 풀에서, 응답 생성은 현재 스레드에서 동시에 진행
+        slot_future = submit_in_context(create_completion_or_none, slot_kwargs, "slot_extraction")
+        response = create_completion_or_none(reply_kwargs)
+        slot_response = slot_future.result()
+
+    if response is not None:
+        log_prompt_usage("reply", response)
+    if slot_response is not None:
+        log_prompt_usage("slot_extraction", slot_response)
+    return response, slot_response
+
+
+def admission_request(slot_doc, user_message, context_text):
+    """입장 제어에 넘길 (우선순위, 추정 토큰 수). 위기 턴(9번 문항 관련)은 일반 턴보다 먼저 들어간다."""
+    priority = PRIORITY_CRISIS if is_crisis_turn(slot_doc, user_message) else PRIORITY_ROUTINE
+    context_tokens, _ = count_tokens(context_text)
+    return priority, 2 * context_tokens + LLM_TURN_TOKEN_OVERHEAD
+
+
+def admit_turn(slot_doc, user_message, context_text):
+    """
+    GPT 호출 전에 입장 제어를 받아 티켓을 돌려준다.
+    티켓을 with 문으로 쓰면 그 안의 GPT 호출 토큰 사용량이 기록되고, 끝날 때 자리를 돌려준다.
+    일반 턴이 대기열 초과/대기 시간 초과면 AdmissionRejected.
+    """
+    with metrics.timed_stage("admission"):
+        return llm_admission.admit(*admission_request(slot_doc, user_message, context_text))
+
+
+def admission_rejected_response(error):
+    """과부하 응답 (503 + Retry-After). 클라이언트는 잠시 후 같은 메시지를 다시 보낸다."""
+    logging.warning(f"GPT 호출 입장 거절: {error.reason} (Retry-After {error.retry_after}초)")
+    response = jsonify({'error': 'The server is busy. Please try again shortly.'})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def prepare_slot_request(context_text, latest_user_input, slot_doc):
+    """
+    (규칙 기반 슬롯 업데이트, 슬롯 추출 GPT 요청 인자)를 반환한다.
+    규칙 기반으로 직전 문항 점수가 확실히 정해지면 GPT 요청 인자는 None이다.
+    """
+    fast_slot_data = rule_based_slot_update(slot_doc, latest_user_input) if RULE_BASED_SLOTS else None
+    if fast_slot_data:
+        return fast_slot_data, None
+    return None, build_slot_request(context_text, latest_user_input, slot_doc)
+
+
+def generate_turn(endpoint, unanswered_items, context_text, latest_user_input, slot_doc, template_name):
+    """
+    /api/chat, /api/phq9_high_c_low_u의 GPT 호출 부분. (봇 응답, 슬롯 업데이트 리스트)를 반환한다.
+    endpoint가 COMBINED_LLM_ENDPOINTS에 있으면 한 번 호출로 둘 다 받고, 아니면 두 호출을 동시에 보낸다.
+    규칙 기반으로 슬롯을 채운 턴은 어느 모드든 응답 생성만 호출한다.
+    GPT 장애로 응답을 받지 못하면 고정 문항 질문(fallback_question)을 봇 응답으로 쓴다.
+    """
+    fast_slot_data, slot_kwargs = prepare_slot_request(context_text, latest_user_input, slot_doc)
+    if slot_kwargs is not None and endpoint in COMBINED_LLM_ENDPOINTS:
+        response = create_completion_or_none(
+            build_combined_request(unanswered_items, context_text, latest_user_input, slot_doc, template_name), "combined"
+        )
+        if response is None:
+            return fallback_question(slot_doc), []
+        log_prompt_usage("combined", response)
+        bot_response, new_slot_data = parse_combined_response(response)
+        if bot_response:
+            return bot_response, new_slot_data
+        logging.warning("combined 응답에서 응답 문장을 얻지 못해 두 번 호출로 다시 시도")
+
+    reply_kwargs = build_reply_request(unanswered_items, context_text, slot_doc, template_name=template_name)
+    response, slot_update_prompt = run_reply_and_slot_calls(reply_kwargs, slot_kwargs)
+    try:
+        new_slot_data = resolve_slot_updates(fast_slot_data, slot_update_prompt)
+    except Exception as slot_err:
+        logging.warning(f"슬롯 JSON 파싱 실패: {slot_err}")
+        new_slot_data = []
+    if response is None:
+        return fallback_question(slot_doc, new_slot_data), new_slot_data
+    return response.choices[0].message.content.strip(), new_slot_data
+
+
+def resolve_slot_updates(fast_slot_data, slot_update_prompt):
+    """
+    규칙 기반 결과가 있으면 그대로, 없으면 슬롯 추출 GPT 응답을 파싱해 슬롯 업데이트 리스트를 반환한다.
+    """
+    if fast_slot_data:
+        logging.info(f"규칙 기반 슬롯 추출 사용: {fast_slot_data}")
+        return fast_slot_data
+    if slot_update_prompt is None:
         return []
+    slot_update_str = (slot_update_prompt.choices[0].message.content or "").strip()
+    logging.info(f"GPT JSON 응답 원문:\n{slot_update_str}")
+    return slot_update_parser.parse_dicts(slot_update_str)
+
+
+@metrics.timed("summary")
+def build_chat_final_payload(slot_doc, conversation_history):
+    """
+    /api/chat에서 9개 문항 응답이 모두 끝났을 때 반환할 응답을 만든다.
+    conversation_history에 마무리 메시지를 추가한다.
+    """
+    summary_lines=[]
+    summary_items = []
+
+    for idx, slot in enumerate(slot_doc['slots'], 1):
+        item = slot['item']
+        answer = slot.get('raw_user_input') or ""   # None 방지
+        summary_lines.append(f"Q{idx}. {item}\nA{idx}. {answer}")
+        summary_items.append({
+            "num": idx,
+            "item": item,
+            "answer": answer
+        })
+
+    final_summary = "\n\n".join(summary_lines)
+    bot_response=(
+        "PHQ-9의 모든 항목에 답변해주셔서 감사합니다.\n"
+        "다음은 당신이 해주신 응답 요약입니다:\n\n"
+        f"{final_summary}\n\n"
+        "당신의 이야기를 들어서 기쁩니다."
+    )
+
+    conversation_history.append(bot_response)
+    updated_history='|'.join(conversation_history)
+    total_score = sum(slot["score"] for slot in slot_doc["slots"])
+    return {
+        'response': bot_response,
+        'conversation_history': updated_history,
+        "summary": final_summary,
+        "summary_items": summary_items,
+        "totalScore": total_score,
+        "slots": slot_doc["slots"]   # <-- 여기에 slot-by-slot score 포함
+    }
+
+
+@metrics.timed("summary")
+def build_high_final_payload(slot_doc, conversation_history):
+    """
+    /api/phq9_high_c_low_u에서 9개 문항 응답이 모두 끝났을 때 반환할 응답을 만든다.
+    """
+    bot_response="PHQ-9 모든 문항에 답변해주셔서 감사합니다. 수고 많으셨습니다."
+    conversation_history.append(bot_response)
+    updated_history="|".join(conversation_history)
+    slots_data = slot_doc['slots']
+    total_score = sum(s.get('score', 0) for s in slots_data)
+    return {
+        "response":bot_response,
+        "conversation_history":updated_history,
+        "finished":True,
+        "slots": slots_data,
+        "totalScore": total_score
+    }
+
+
+#지표 라벨용 엔드포인트 이름 (Flask view 함수 이름 → 라벨)
+METRICS_ENDPOINTS = {
+    "chat": "chat",
+    "chat_stream": "chat",
+    "phq9_high_c_low_u": "phq9_high_c_low_u",
+    "phq9_high_c_low_u_stream": "phq9_high_c_low_u",
+    "fixed_phq9_chat": "phq9_fixed",
+    "fixed_phq9_editable": "phq9_fixed_editable",
+    "submit_edited_answers": "summary_edit",
+    "export_study_data": "export",
+    "cohort_analytics_summary": "analytics",
+}
+#응답에 Server-Timing 헤더(단계별 시간)를 붙일지 여부
+METRICS_TIMING_HEADER = os.environ.get("METRICS_TIMING_HEADER") == "1"
+
+
+@app.before_request
+def start_request_metrics():
+    request.metrics_started_at = metrics.start_request(METRICS_ENDPOINTS.get(request.endpoint, "other"))
+
+
+@app.after_request
+def finish_request_metrics(response):
+    started_at = getattr(request, "metrics_started_at", None)
+    if started_at is not None and request.endpoint != "metrics_endpoint":
+        #스트리밍 응답은 본문을 보내기 전까지의 시간만 잡힌다
+        server_timing = metrics.finish_request(started_at, response.status_code)
+        if METRICS_TIMING_HEADER:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+
+def completion_cache_metrics():
+    if completion_cache is None:
+        return []
+    lines = ["# HELP chatbot_llm_cache_entries 프로세스 내 GPT 응답 캐시 항목 수", "# TYPE chatbot_llm_cache_entries gauge"]
+    lines.append(f"chatbot_llm_cache_entries {completion_cache.stats()['size']}")
+    return lines
+
+
+def circuit_breaker_metrics():
+    return [
+        "# HELP chatbot_llm_circuit_open GPT 호출 서킷 브레이커가 열려 있으면 1",
+        "# TYPE chatbot_llm_circuit_open gauge",
+        f"chatbot_llm_circuit_open {int(llm_completions.breaker.is_open)}",
+    ]
+
+
+def dialog_writer_metrics():
+    if dialog_writer is None:
+        return []
+    return [
+        "# HELP chatbot_dialog_writer_pending 저장을 기다리는 고정 문항 대화 기록 턴 수",
+        "# TYPE chatbot_dialog_writer_pending gauge",
+        f"chatbot_dialog_writer_pending {dialog_writer.pending}",
+    ]
+
+
+def admission_metrics():
+    if not llm_admission.enabled:
+        return []
+    lines = [
+        "# HELP chatbot_llm_admission_queue GPT 호출 입장을 기다리는 턴 수",
+        "# TYPE chatbot_llm_admission_queue gauge",
+    ]
+    for priority, depth in sorted(llm_admission.queue_depths().items()):
+        lines.append(f'chatbot_llm_admission_queue{{priority="{priority}"}} {depth}')
+    lines += [
+        "# HELP chatbot_llm_admission_active GPT 호출 단계에 들어간 턴 수",
+        "# TYPE chatbot_llm_admission_active gauge",
+        f"chatbot_llm_admission_active {llm_admission.active}",
+    ]
+    tokens = llm_admission.tokens_available()
+    if tokens is not None:
+        lines += [
+            "# HELP chatbot_llm_admission_tokens_available 토큰 예산 버킷에 남은 토큰 수",
+            "# TYPE chatbot_llm_admission_tokens_available gauge",
+            f"chatbot_llm_admission_tokens_available {tokens:.0f}",
+        ]
+    return lines
+
+
+metrics.registry.collectors.append(completion_cache_metrics)
+metrics.registry.collectors.append(circuit_breaker_metrics)
+metrics.registry.collectors.append(dialog_writer_metrics)
+metrics.registry.collectors.append(admission_metrics)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+#연구 데이터 내보내기 (Authorization: Bearer <EXPORT_TOKEN>, 설정하지 않으면 엔드포인트를 막아 둔다)
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN")
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_MAX_DOCS_PER_SEC = float(os.environ.get("EXPORT_MAX_DOCS_PER_SEC", "2000"))
+
+
+def check_export_token():
+    """연구 데이터 엔드포인트(/api/export, /api/analytics/cohorts) 인증. 통과하면 None, 아니면 오류 응답."""
+    if not EXPORT_TOKEN:
+        return jsonify({"error": "export disabled"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {EXPORT_TOKEN}"):
+        return jsonify({"error": "unauthorized"}), 401
+    return None
+
+
+@app.route('/api/export')
+def export_study_data():
+    """
+    네 실험군과 edited_answers를 NDJSON으로 스트리밍한다 (study_export.py).
+    쿼리: since/until(ISO 8601, 생략 시 처음부터/요청 시각), sources(쉼표로 구분한 source 이름 또는 kind)
+    마지막 줄은 {"source": "_end", "watermark", "rows"}이고, 이 줄이 없으면 중간에 끊긴 것이다.
+    다음 증분 내보내기는 watermark 값을 since로 넘긴다.
+    """
+    denied = check_export_token()
+    if denied is not None:
+        return denied
+    try:
+        since = parse_watermark(request.args.get("since"))
+        until = parse_watermark(request.args.get("until")) or export_now()
+        sources = select_sources(request.args.get("sources"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    watermark = format_watermark(until)
+
+    def generate():
+        count = 0
+        for line in ndjson_lines(iter_export_rows(mongo_client, since, until, sources, EXPORT_BATCH_SIZE, EXPORT_MAX_DOCS_PER_SEC)):
+            count += 1
+            yield line
+        yield json.dumps({"source": "_end", "watermark": watermark, "rows": count}) + "\n"
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"X-Export-Watermark": watermark, "X-Accel-Buffering": "no"},
+    )
+
+
+#실험군별 코호트 분석 (새 세션/완료가 생길 때까지 캐시)
+cohort_analytics = CohortAnalytics(mongo_client, PHQ9_ITEMS)
+
+
+@app.route('/api/analytics/cohorts')
+def cohort_analytics_summary():
+    """
+    실험군별 심각도 구간, 문항별 평균, 완료율, 완료까지 걸린 턴 수와 실험군 간 총점 비교 (cohort_analytics.py).
+    refresh=1이면 캐시를 무시하고 다시 계산한다.
+    """
+    denied = check_export_token()
+    if denied is not None:
+        return denied
+    if request.args.get("refresh") == "1":
+        cohort_analytics.invalidate()
+    result, cached = cohort_analytics.summary()
+    return jsonify(dict(result, cached=cached))
+
 
 @app.route('/')
 def home():
@@ -140,186 +696,45 @@ def chat():
         data = request.get_json()
         user_message = data.get('message')
         user_id = data.get('user_id') or 'default_user'
-        history_raw = data.get('conversation_history', '')
-        conversation_history = history_raw.split('|') if history_raw else []
-
         if not user_message:
             return jsonify({'error': 'No message provided'}), 400
 
         logging.info(f"사용자 메시지: {user_message}")
-        conversation_history.append(user_message)
+        #대화 이력은 서버에 저장된 것을 사용. 서버 이력이 없는 첫 턴만 클라이언트 이력(Node가 보낸 인사말)으로 시작
+        history = chat_history_store.get(user_id, parse_client_history(data.get('conversation_history')))
         latest_user_input = user_message
-        context_text = '|'.join(conversation_history)
+        context_text = '|'.join(history + [user_message])
 
         # 기존 슬롯 문서 조회 또는 새로 생성
-        slot_doc = slot_collection.find_one({"user_id": user_id})
-        if not slot_doc:
-            slot_doc = init_slot_structure(user_id)
-            slot_collection.insert_one(slot_doc)
+        slot_doc = load_slot_doc(slot_collection, user_id)
         #미응답문항만 질문하게 하려고 추가-7월 7일 주세진
         unanswered_items = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']
 
-        #GPT 응답 생성  
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "당신은 공감적이고 따뜻한 정신건강 챗봇입니다. 지금 사용자의 PHQ-9 우울증 자가진단을 대화형 방식으로 진행하고 있습니다.\n\n"
-                        "* 대화 규칙:\n"
-                        "- 이미 응답이 완료된 문항은 절대 반복해서 질문하지 마세요.\n"
-                        "- 첫 번째 인삿말 이후에는 '안녕하세요' 같은 인삿말을 반복하지 마세요.\n"  #추가
-                        "- 사용자의 발화를 분석하여 어떤 PHQ-9 항목(item)에 해당하는지 판단하세요.\n"
-                        "- 사용자의 발화를 바탕으로 해당 항목의 점수(0~3점)와 빈도/강도 정보를 추론하세요.\n"
-                        "- 빈도(며칠, 거의 매일 등)나 강도(심함의 정도) 정보가 부족한 경우, 반드시 후속 질문을 통해 **최근 2주간**의 **빈도나 강도**에 대해 자연스럽게 따뜻한 말투로 물어보세요.\n"
-                        "- 후속 질문은 기계적이거나 일반적인 표현을 피하고, 반드시 이전 사용자의 응답과 **맥락**을 고려한 말투여야 합니다.\n"
-                        "- 후속 질문 예시:\n"
-                        "  * “말씀해주셔서 감사해요. 최근 2주 동안 이런 일이 얼마나 자주 있었나요?”\n"
-                        "  * “많이 힘드셨겠어요. 최근 2주간 이런 기분이 거의 매일 있었을까요, 아니면 가끔이었을까요?”\n"
-                        "  * “솔직하게 얘기해주셔서 고마워요. 최근 2주간 이런 감정이 얼마나 강하게 느껴졌는지 말씀해주실 수 있을까요?”\n"
-                        "- 후속 질문에는 항상 '최근 2주간'이라는 표현이 **자연스럽게 포함**되어야 합니다.\n"
-                        "- 점수와 빈도/강도가 **모두** 명확히 파악된 경우에만 해당 항목을 'answered'상태로 간주하세요.\n"
-                        "- 사용자의 최근 응답을 바탕으로 다음으로 가장 관련 있어 보이는 미응답한 PHQ-9 항목 **하나만** 선택해 자연스럽게 다음 질문을 이어가세요.\n"
-                        f"- 다음 질문은 반드시 아래 미응답 항목 중 하나만 선택하세요:\n{unanswered_items}\n"
-                        #"- 모든 9개 항목에 대한 응답이 완료되면, 부드럽게 결과를 요약하고 감정적으로 따뜻하게 마무리하며, 필요 시 전문가 상담도 권유하세요.\n\n"
-                        "* 말투:\n"
-                        "- 항상 따뜻하고 지지적인, 배려심 있는 말투를 사용하세요. 친절한 친구처럼 대화해주세요.\n"
-                        "- 사용자를 재촉하거나 압박하지 말고, 필요한 경우에는 공감 어린 후속 질문으로 자연스럽게 유도하세요.\n\n"
-                        "* 출력 방식:\n"
-                        "- 사용자의 응답에 점수와 빈도/강도가 명확히 포함된 경우, 따뜻하게 공감하며 다음 미응답 항목으로 자연스럽게 넘어가세요.\n"
-                        "- 빈도 또는 강도 정보가 부족한 경우, **단 하나의 후속 질문**만 사용해 해당 정보를 자연스럽게 물어보세요. 반드시 대화 문맥에 맞는 따뜻한 말투여야 합니다."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"현재 미응답 항목 리스트:\n{unanswered_items}\n"
-                        f"이 중에서 가장 관련 있는 문항 하나를 골라 자연스럽게 질문하세요.\n"
-                        f"이전 대화: {context_text}\n"
-                        f"이전 답변 완료 문항: {[s['item'] for s in slot_doc['slots'] if s['status']=='answered']}"
-                    )
-                }
-            ],
-            temperature=0.0,
-            max_tokens=512,
-        )
-        bot_response = response.choices[0].message.content.strip()
+        #GPT 응답 생성 + 슬롯 추출 (봇 응답과 무관하므로 두 호출을 동시에 보내거나, combined 모드면 한 번에 받음)
+        #직전 질문 문항의 빈도 답변이 확실하면 규칙 기반으로 채우고 슬롯 추출 GPT 호출은 생략
+        try:
+            ticket = admit_turn(slot_doc, user_message, context_text)
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+        with ticket:
+            bot_response, new_slot_data = generate_turn("chat", unanswered_items, context_text, latest_user_input, slot_doc, "chat_reply")
         logging.info(f"GPT 응답: {bot_response}")
-        conversation_history.append(bot_response)
-        if len(conversation_history)>6:
-            conversation_history.pop(0)
+        conversation_history = chat_history_store.append(user_id, history, user_message, bot_response)
         updated_history='|'.join(conversation_history)
 
-        #슬롯 추출 GPT 호출
-        slot_update_prompt = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "당신은 사용자의 PHQ-9 자가진단 대화 내용을 바탕으로 JSON 배열을 생성하는 보조 도우미입니다.\n\n"
-                        "- 전체 대화 맥락(이전 발화들)과 최신 입력을 함께 고려해서 평가하세요."
-                        "- 빈도 또는 강도(freq_intensity)와 점수(score)가 모두 명확히 포함된 경우에만 해당 문항을 'answered'로 간주하세요."
-                        "- 출력은 아래와 같은 **JSON 배열 형식만** 제공해야 합니다. 그 외의 텍스트는 절대 포함하지 마세요:\n"
-                        "[\n"
-                        "  {\n"
-                        "    \"item\": \"우울감\",\n"
-                        "    \"status\": \"answered\",\n"
-                        "    \"score\": (사용자 응답에 근거하여 추론된 0~3 중 하나),\n"
-                        "    \"raw_user_input\": \"사용자의 원문 발화\",\n"
-                        "    \"freq_or_intensity\": \"사용자가 표현한 빈도 또는 강도 그대로(ex.거의 5일정도, 한 3~4일, 2주넘게)\",\n"
-                        "    \"last_updated\": null\n"
-                        "  }\n"
-                        "]\n\n"
-                        "예시:"
-                        "[\n"
-                        "  {\n"
-                        "    \"item\": \"식욕 저하\",\n"
-                        "    \"status\": \"answered\",\n"
-                        "    \"score\": 1,\n"
-                        "    \"raw_user_input\": \"맞아...초콜릿을 안 먹게 된지 3~4일 정도 된 것 같아...\",\n"
-                        "    \"freq_or_intensity\": \"3~4일 정도\",\n"
-                        "    \"last_updated\": null\n"
-                        "  }\n"
-                        "]\n"
-                        "- score는 다음 기준에 따라 추정하세요:\n"
-                        "  - 전혀 아니다, 그런 적 없다, 전혀 하지 않았다 → 0점\n"
-                        "  - 며칠 동안, 가끔 → 1점\n"
-                        "  - 절반 이상, 자주 → 2점\n"
-                        "  - 거의 매일, 대부분의 날 → 3점\n"
-                        "- 빈도나 강도에 대한 언급이 없으면 freq_or_intensity는 null로 설정하세요.\n"
-                        "- 사용자가 명확히 특정 증상이 *전혀 없다*고 말했으면, 꼭 status: answered, score: 0, freq_or_intensity: 거의 없음 으로 JSON 배열에 포함하세요.\n"
-                        "- 이전에 언급된 증상에 대한 후속 응답이 있을 수 있으므로, 같은 항목이라도 내용이 다르면 업데이트해야 합니다.\n"
-                        "- 이미 'answered' 상태로 응답된 문항은 다시 질문하지 마세요. JSON배열에도 포함하지 마세요.\n"
-                        f"- 가능한 item 값: {PHQ9_ITEMS}"
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"전체 대화 맥락:\n{context_text}\n\n"
-                        f"사용자의 최신 입력:\n{latest_user_input}\n\n"
-                        f"현재까지의 사용자 응답 상태(JSON):\n{json.dumps(slot_doc['slots'], ensure_ascii=False,default=str)}"
-                        f"사용자의 최신 응답은 '직전에 질문한 문항'에 대한 후속 설명일 가능성이 높습니다."
-                        f"따라서 '마지막으로 질문했던 문항'이 존재하면, 그 문항만을 업데이트 대상으로 간주하세요."
-                        f"* 이미 'answered'상태인 문항은 다시 묻거나 json배열에 포함하지 마세요:\n"
-                        f"{[s['item'] for s in slot_doc['slots'] if s['status'] == 'answered']}"
-                    )
-                },
-            ],
-            temperature=0.0,
-            max_tokens=512,
-        )
-        slot_update_str = slot_update_prompt.choices[0].message.content.strip()
-        logging.info(f"GPT JSON 응답 원문:\n{slot_update_str}")
         try:
-            new_slot_data = extract_json_array(slot_update_str)
             logging.info(f"업데이트할 슬롯 데이터: {new_slot_data}")
-            updated_slot_doc = update_slot_structure(slot_doc, new_slot_data)
-            slot_collection.replace_one({"user_id": user_id}, updated_slot_doc,upsert=True)#upsert=True추가해서
-            #문서가 존재하지않거나 key가달라도 덮어쓰기 동작이 확실히 일어남
-            slot_doc=slot_collection.find_one({"user_id":user_id})#내가 수정한 부분코드-6월 22일
+            #바뀐 필드와 이번에 물어본 문항만 $set으로 저장하고, 저장 후 문서를 그대로 사용 (재조회 없음)
+            slot_doc = persist_slot_updates(slot_collection, user_id, slot_doc, new_slot_data, bot_response)
         except Exception as slot_err:
-            logging.warning(f"슬롯 JSON 파싱 실패: {slot_err}")
+            logging.warning(f"슬롯 저장 실패: {slot_err}")
 
 
         unanswered_items = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']#미응답문항만 질문하게 하려고 추가-7월 7일 주세진
         all_answered=len(unanswered_items)==0#여기부터
         
         if all_answered:
-            summary_lines=[]    
-            summary_items = []
-
-            for idx, slot in enumerate(slot_doc['slots'], 1):
-                item = slot['item']
-                answer = slot.get('raw_user_input') or ""   # None 방지
-                summary_lines.append(f"Q{idx}. {item}\nA{idx}. {answer}")
-                summary_items.append({
-                    "num": idx,
-                    "item": item,
-                    "answer": answer
-                })
-
-            final_summary = "\n\n".join(summary_lines)
-            bot_response=(
-                "PHQ-9의 모든 항목에 답변해주셔서 감사합니다.\n"
-                "다음은 당신이 해주신 응답 요약입니다:\n\n"
-                f"{final_summary}\n\n"
-                "당신의 이야기를 들어서 기쁩니다."
-            )
-
-            conversation_history.append(bot_response)
-            updated_history='|'.join(conversation_history)
-            total_score = sum(slot["score"] for slot in slot_doc["slots"])
-            return jsonify({
-                'response': bot_response,
-                'conversation_history': updated_history,
-                "summary": final_summary,
-                "summary_items": summary_items,
-                "totalScore": total_score,
-                "slots": slot_doc["slots"]   # <-- 여기에 slot-by-slot score 포함
-            })#여기까지는 수정한 부분 7월 9일 오후 3시 기준
+            return jsonify(build_chat_final_payload(slot_doc, conversation_history))#여기까지는 수정한 부분 7월 9일 오후 3시 기준
         return jsonify({
             'response': bot_response,
             'conversation_history': updated_history
@@ -334,6 +749,20 @@ def chat():
 phq9_fixed_db = mongo_client["phq9_fixed_db"]
 phq9_fixed_slot_collection = phq9_fixed_db["slots"]
 phq9_fixed_dialog_collection = phq9_fixed_db["phq9_fixed_dialog"]
+#고정 문항 대화 기록은 write-behind로 저장 (DIALOG_WRITE_BEHIND=0이면 요청 경로에서 바로 저장)
+#큐가 DIALOG_QUEUE_SIZE턴을 넘으면 요청 경로에서 바로 저장하고, 종료 시 남은 턴을 저장한다
+DIALOG_WRITE_BEHIND = os.environ.get("DIALOG_WRITE_BEHIND", "1") != "0"
+dialog_writer = DialogWriter(
+    max_queue=int(os.environ.get("DIALOG_QUEUE_SIZE", "10000")),
+    batch_size=int(os.environ.get("DIALOG_FLUSH_BATCH", "500")),
+    flush_interval=float(os.environ.get("DIALOG_FLUSH_INTERVAL_MS", "50")) / 1000,
+    on_event=metrics.record_dialog_writer_event,
+) if DIALOG_WRITE_BEHIND else None
+if dialog_writer is not None:
+    atexit.register(dialog_writer.close)
+#고정 문항 흐름 이력은 응답으로 돌려주기만 하지만 워커/재시작과 상관없이 같아야 하므로 chat/high처럼 MongoDB에 둔다
+#(연구용 원본 기록은 대화 버킷, 이 컬렉션은 응답용 최근 이력)
+fixed_history_store = session_history_store(phq9_fixed_db["session_history"])
 # PHQ-9 고정 문항
 PHQ9_ITEMS_FIXED = [
     "1. 최근 2주간 기분이 가라앉거나, 우울하거나, 희망이 없다고 느끼셨나요?",
@@ -346,122 +775,90 @@ PHQ9_ITEMS_FIXED = [
     "8. 최근 2주간 다른 사람들이 알아차릴 정도로 느리게 움직이거나, 또는 너무 안절부절못하거나 들떠서 가만히 있을 수 없었던 적이 있었나요?",
     "9. 최근 2주간 죽고 싶다는 생각을 하거나 자해할 생각을 해본 적이 있으신가요?"
 ]
+#9번(자살 생각) 문항의 번호 (이 문항에 대한 답변은 대화 기록을 요청 경로에서 바로 저장)
+PHQ9_FIXED_CRISIS_INDEX = next(i for i, question in enumerate(PHQ9_ITEMS_FIXED) if match_items(question, [CRISIS_ITEM]))
+#GPT 장애 시 대화형 엔드포인트가 보낼 고정 질문 (PHQ9_ITEMS와 고정 문항은 1, 2번 순서가 서로 바뀌어 있음)
+FALLBACK_QUESTIONS = dict(zip(
+    PHQ9_ITEMS,
+    [q.split(". ", 1)[1] for q in [PHQ9_ITEMS_FIXED[1], PHQ9_ITEMS_FIXED[0]] + PHQ9_ITEMS_FIXED[2:]],
+))
+
+
+def fallback_question(slot_doc, new_slot_data=()):
+    """
+    직전에 물은 문항이 아직 미응답이면 그 문항을, 아니면 첫 미응답 문항을 고정 질문으로 다시 묻는다.
+    new_slot_data: 이번 턴에 이미 채운 슬롯 업데이트 (규칙 기반 결과 등)
+    """
+    metrics.record_resilience_event("fallback")
+    filled = {s['item'] for s in new_slot_data if s.get('status') == 'answered'}
+    unanswered = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered' and s['item'] not in filled]
+    if not unanswered:
+        return "말씀해주셔서 고마워요. 잠시 후에 다시 이야기를 이어가 볼까요?"
+    item = slot_doc.get("last_asked_item")
+    if item not in unanswered:
+        item = unanswered[0]
+    return f"말씀해주셔서 고마워요. {FALLBACK_QUESTIONS[item]}"
+
+
+FIXED_SUMMARY_HEADER = "PHQ-9 전체 문항에 답변해주셔서 감사합니다. 다음은 당신이 해주신 응답 요약입니다:"
+
+#고정 문항 설문 (시작 시 한 번 상태 기계로 컴파일)
+PHQ9_FIXED = Questionnaire(
+    "phq9_fixed",
+    PHQ9_ITEMS_FIXED,
+    closing_message="PHQ-9의 모든 문항에 답변해주셔서 감사합니다. 당신의 이야기를 들어서 정말 소중했어요.",
+)
+PHQ9_FIXED_EDITABLE = Questionnaire(
+    "phq9_fixed_editable",
+    PHQ9_ITEMS_FIXED,
+    summary_header=FIXED_SUMMARY_HEADER,
+    format_summary=build_edited_summary,
+)
+
+
+def run_fixed_turn(questionnaire, session_collection, dialog_collection, history_store):
+    """
+    고정 문항 엔드포인트 공통 처리: 세션 상태 읽기 1번 + 조건부 쓰기 1번 (대화 버킷 추가는 dialog_writer가 모아서 저장, 위기 턴은 바로 저장).
+    완료 시 요약을 보여주는 설문이면 summary_items도 돌려준다.
+    """
+    data = request.get_json()
+    user_message = data.get('message')
+    user_id = data.get('user_id', 'default_user')
+    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
+
+    with metrics.timed_stage("questionnaire"):
+        plan = questionnaire.advance(session_collection, user_id, user_message, now)
+
+    #이번 턴의 대화 메시지를 버킷에 한 번에 추가
+    turn_messages = []
+    if user_message:
+        turn_messages.append(dialog_message("user", user_message, now))
+    if plan.bot_message:
+        turn_messages.append(dialog_message("bot", plan.bot_message, now))
+    if dialog_writer is not None:
+        #위기 문항 답변이나 관련 표현이 있는 턴은 워커가 죽어도 잃지 않도록 write-behind를 거치지 않는다
+        crisis = plan.step.answer_index == PHQ9_FIXED_CRISIS_INDEX or bool(match_items(user_message or "", [CRISIS_ITEM]))
+        dialog_writer.append(dialog_collection, user_id, turn_messages, durable=crisis)
+    else:
+        append_dialog_messages(dialog_collection, user_id, turn_messages)
+
+    #새 세션은 이전 이력 없이 시작
+    history = [] if plan.step.starts_session else history_store.get(user_id)
+    conversation_history = history_store.append(user_id, history, user_message, plan.response)
+
+    payload = {
+        'response': plan.response,
+        'conversation_history': '|'.join(conversation_history)
+    }
+    if plan.summary_items is not None:
+        payload["summary_items"] = plan.summary_items
+    return jsonify(payload)
+
 
 @app.route('/api/phq9_fixed', methods=['POST'])
 def fixed_phq9_chat():
     try:
-        data = request.get_json()
-        user_message = data.get('message')
-        user_id = data.get('user_id', 'default_user')
-        history_raw = data.get('conversation_history', '')
-        conversation_history = history_raw.split('|') if history_raw else []
-
-        now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
-
-        # 사용자 상태 확인 (시작 여부 및 진행 인덱스)
-        user_doc = phq9_fixed_slot_collection.find_one({"user_id": user_id})
-        if not user_doc:
-            user_doc = {
-                "user_id": user_id,
-                "started": False,
-                "current_index": 0,
-                "last_updated": now
-            }
-            phq9_fixed_slot_collection.insert_one(user_doc)
-
-        current_index = user_doc.get("current_index", 0)
-
-        # 대화 document 생성 또는 불러오기
-        dialog_doc = phq9_fixed_dialog_collection.find_one({"user": user_id})
-        if not dialog_doc:
-            dialog_doc = {
-                "user": user_id,
-                "messages": [],
-                "createdAt": now
-            }
-            phq9_fixed_dialog_collection.insert_one(dialog_doc)
-
-        # 1단계: 아직 시작하지 않은 경우
-        if not user_doc.get("started"):
-            if user_message:
-                phq9_fixed_dialog_collection.update_one(
-                    {"user": user_id},
-                    {"$push": {"messages": {
-                        "sender": "user",
-                        "text": user_message,
-                        "timestamp": now
-                    }}}
-                )
-
-            question = PHQ9_ITEMS_FIXED[0]
-
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "bot",
-                    "text": question,
-                    "timestamp": now
-                }}}
-            )
-
-            # 시작 상태 업데이트
-            phq9_fixed_slot_collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"started": True, "current_index": 1, "last_updated": now}}
-            )
-
-            conversation_history += [user_message, question] if user_message else [question]
-
-            return jsonify({
-                'response': question,
-                'conversation_history': '|'.join(conversation_history)
-            })
-
-        # 2단계: 시작된 경우 (응답 수신 및 다음 질문 전달)
-        if user_message:
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "user",
-                    "text": user_message,
-                    "timestamp": now
-                }}}
-            )
-
-        if current_index < len(PHQ9_ITEMS_FIXED):
-            question = PHQ9_ITEMS_FIXED[current_index]
-
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "bot",
-                    "text": question,
-                    "timestamp": now
-                }}}
-            )
-
-            # 다음 문항으로 진행
-            phq9_fixed_slot_collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"current_index": current_index + 1, "last_updated": now}}
-            )
-        else:
-            question = "PHQ-9의 모든 문항에 답변해주셔서 감사합니다. 당신의 이야기를 들어서 정말 소중했어요."
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "bot",
-                    "text": question,
-                    "timestamp": now
-                }}}
-            )
-
-        conversation_history += [user_message, question] if user_message else [question]
-        return jsonify({
-            'response': question,
-            'conversation_history': '|'.join(conversation_history)
-        })
-
+        return run_fixed_turn(PHQ9_FIXED, phq9_fixed_slot_collection, phq9_fixed_dialog_collection, fixed_history_store)
     except Exception as e:
         logging.error("고정 질문 API 오류 발생", exc_info=True)
         return jsonify({'error': '고정 질문 API 처리 중 오류 발생'}), 500
@@ -470,171 +867,11 @@ def fixed_phq9_chat():
 phq9_editable_db = mongo_client["phq9_fixed_editable"]
 phq9_editable_slot_collection = phq9_editable_db["slots"]
 phq9_editable_dialog_collection = phq9_editable_db["dialog"]
+editable_history_store = session_history_store(phq9_editable_db["session_history"])
 @app.route('/api/phq9_fixed_editable', methods=['POST'])
 def fixed_phq9_editable():
     try:
-        data = request.get_json()
-        user_message = data.get('message')
-        user_id = data.get('user_id', 'default_user')
-        history_raw = data.get('conversation_history', '')
-        conversation_history = history_raw.split('|') if history_raw else []
-
-        now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
-
-        #사용자 상태 확인 (시작 여부 및 진행 인덱스)
-        user_doc = phq9_fixed_slot_collection.find_one({"user_id": user_id})
-        if not user_doc:
-            user_doc = {
-                "user_id": user_id,
-                "started": False,
-                "current_index": 0,
-                "last_updated": now
-            }
-            phq9_fixed_slot_collection.insert_one(user_doc)
-
-        current_index = user_doc.get("current_index", 0)
-
-        # 대화 document 생성 또는 불러오기
-        dialog_doc = phq9_fixed_dialog_collection.find_one({"user": user_id})
-        if not dialog_doc:
-            dialog_doc = {
-                "user": user_id,
-                "messages": [],
-                "createdAt": now
-            }
-            phq9_fixed_dialog_collection.insert_one(dialog_doc)
-
-        #1단계: 아직 시작하지 않은 경우
-        if not user_doc.get("started"):
-            if user_message:
-                phq9_fixed_dialog_collection.update_one(
-                    {"user": user_id},
-                    {"$push": {"messages": {
-                        "sender": "user",
-                        "text": user_message,
-                        "timestamp": now
-                    }}}
-                )
-
-            question = PHQ9_ITEMS_FIXED[0]
-
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "bot",
-                    "text": question,
-                    "timestamp": now
-                }}}
-            )
-
-            #시작 상태 업데이트
-            phq9_fixed_slot_collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"started": True, "current_index": 1, "last_updated": now}}
-            )
-
-            conversation_history += [user_message, question] if user_message else [question]
-
-            return jsonify({
-                'response': question,
-                'conversation_history': '|'.join(conversation_history)
-            })
-
-        #2단계: 시작된 경우 (응답 수신 및 다음 질문 전달)
-        if user_message:
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "user",
-                    "text": user_message,
-                    "timestamp": now
-                }}}
-            )
-
-        if current_index < len(PHQ9_ITEMS_FIXED):
-            question = PHQ9_ITEMS_FIXED[current_index]
-
-            phq9_fixed_dialog_collection.update_one(
-                {"user": user_id},
-                {"$push": {"messages": {
-                    "sender": "bot",
-                    "text": question,
-                    "timestamp": now
-                }}}
-            )
-
-            #다음 문항으로 진행
-            phq9_fixed_slot_collection.update_one(
-                {"user_id": user_id},
-                {"$set": {"current_index": current_index + 1, "last_updated": now}}
-            )
-
-            # 대화 이력에 추가하고 응답 반환
-            conversation_history += [user_message, question] if user_message else [question]
-            return jsonify({
-                "response": question,
-                "conversation_history": "|".join(conversation_history)
-            })
-        
-        else:
-            if user_message:
-                phq9_fixed_dialog_collection.update_one(
-                    {"user": user_id},
-                    {"$push": {"messages": {
-                        "sender": "user",
-                        "text": user_message,
-                        "timestamp": now
-                    }}}
-                )
-            # 메모리상 dialog_doc에도 반영
-            dialog_doc["messages"].append({
-                "sender": "user",
-                "text": user_message,
-                "timestamp": now
-            })
-            #모든 문항 완료 시, 요약 메시지 생성
-            if dialog_doc and "messages" in dialog_doc:
-                messages = dialog_doc["messages"]
-                summary_lines = []
-                #첫 줄에 인사말 추가
-                summary_lines.append("PHQ-9 전체 문항에 답변해주셔서 감사합니다. 다음은 당신이 해주신 응답 요약입니다:")
-                q_count = 0
-                a_count = 0
-                i=0
-                summary_items = []
-                while i < len(messages):
-                    msg=messages[i]
-                    if msg["sender"]=="bot":
-                        #PHQ-9 문항 질문인지 확인
-                        if msg["text"] not in PHQ9_ITEMS_FIXED:
-                            i += 1
-                            continue
-                        q_count += 1
-                        question_text = msg["text"].strip()
-                        answer_text = ""
-                        if i + 1 < len(messages) and messages[i + 1]["sender"] == "user":
-                            a_count += 1
-                            answer_text = messages[i + 1]["text"].strip()
-                            i += 1
-                        #질문-답변 한 쌍을 한 줄 띄워서 추가
-                        summary_lines.append(f"Q{q_count}. {question_text}\nA{a_count}. {answer_text}")
-                        summary_items.append({
-                        "num": q_count,
-                        "item": question_text,
-                        "answer": answer_text
-                    })
-                    i += 1
-
-                final_summary="\n\n".join(summary_lines)  #\n\n 두 줄 띄우기
-                question=final_summary
-            else:
-                question="PHQ-9의 모든 문항에 답변해주셔서 감사합니다."
-            conversation_history+=[user_message, question] if user_message else [question]
-            return jsonify({
-                'response': question,
-                'conversation_history': '|'.join(conversation_history),
-                "summary_items": summary_items
-            })
+        return run_fixed_turn(PHQ9_FIXED_EDITABLE, phq9_editable_slot_collection, phq9_editable_dialog_collection, editable_history_store)
     except Exception as e:
         logging.error("고정 질문 API 오류 발생", exc_info=True)
         return jsonify({'error': '고정 질문 API 처리 중 오류 발생'}), 500
@@ -656,36 +893,16 @@ def submit_edited_answers():
     try:
         data = request.get_json()
         user_id = data.get('user_id', 'default_user')
-        edited_items = data.get('edited_items')
-
-        if not isinstance(edited_items, list):
-            return jsonify({"error": "edited_items must be a list"}), 400
-
-        cleaned = []
-        for idx, it in enumerate(edited_items):
-            if not isinstance(it, dict):
-                return jsonify({"error": f"edited_items[{idx}] invalid"}), 400
-            item = it.get("item")
-            edited_answer = it.get("edited_answer")
-            if not item:
-                return jsonify({"error": f"edited_items[{idx}] missing item"}), 400
-            if edited_answer is None:
-                edited_answer = ""  # 빈 문자열 허용
-            cleaned.append({
-                "item": item,
-                "edited_answer": edited_answer
-            })
-
-        doc = {
-            "user_id": user_id,
-            "edited_items": cleaned,
-            "saved_at": datetime.datetime.now(pytz.timezone('Asia/Seoul'))
-        }
-        ins = edited_answers_collection.insert_one(doc)
+        try:
+            cleaned = clean_edited_items(data.get('edited_items'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        edited_id = save_edited_answers(edited_answers_collection, phq9_editable_slot_collection, user_id, cleaned)
 
         return jsonify({
             "message": "edited answers saved",
-            "edited_id": str(ins.inserted_id),
+            "edited_id": str(edited_id),
             "count": len(cleaned)
         }), 200
 
@@ -695,163 +912,44 @@ def submit_edited_answers():
 
 db_high_c_low_u = mongo_client["phq9_high_c_low_u"]
 slot_collection_high = db_high_c_low_u["slots"]
+high_history_store = session_history_store(db_high_c_low_u["session_history"])
 @app.route('/api/phq9_high_c_low_u', methods=['POST'])
 def phq9_high_c_low_u():
     try:
         data = request.get_json()
         user_message = data.get('message')
         user_id = data.get('user_id') or 'default_user'
-        history_raw = data.get('conversation_history', '')
-        conversation_history = history_raw.split('|') if history_raw else []
         if not user_message:
             return jsonify({'error': 'No message provided'}), 400
         logging.info(f"사용자 메세지:{user_message}")
-        conversation_history.append(user_message)
+        history = high_history_store.get(user_id, parse_client_history(data.get('conversation_history')))
         latest_user_input=user_message
-        context_text="|".join(conversation_history)
+        context_text="|".join(history + [user_message])
         #새로운 컬렉션에 문서 조회/생성
-        slot_doc=slot_collection_high.find_one({"user_id":user_id})
-        if not slot_doc:
-            slot_doc=init_slot_structure(user_id)
-            slot_collection_high.insert_one(slot_doc)
+        slot_doc=load_slot_doc(slot_collection_high, user_id)
         unanswered_items=[s['item'] for s in slot_doc['slots'] if s['status']!='answered']
         
-        #GPT응답생성
-        response=client.chat.completions.create(
-            model='gpt-4o',
-            messages=[
-                {
-                    "role":"system",
-                    "content":(
-                        "당신은 공감적이고 따뜻한 정신건강 챗봇입니다. 지금 사용자의 PHQ-9 우울증 자가진단을 대화형 방식으로 진행하고 있습니다.\n\n"
-                         "* 대화 규칙:\n"
-                        "- 이미 응답이 완료된 문항은 절대 반복해서 질문하지 마세요.\n"
-                        "- 첫 번째 인삿말 이후에는 '안녕하세요' 같은 인삿말을 반복하지 마세요.\n"  #추가 7/30
-                        "- 사용자의 발화를 분석하여 어떤 PHQ-9 항목(item)에 해당하는지 판단하세요.\n"
-                        "- 사용자의 발화를 바탕으로 해당 항목의 점수(0~3점)와 빈도/강도 정보를 추론하세요.\n"
-                        "- 빈도(며칠, 거의 매일 등)나 강도(심함의 정도) 정보가 부족한 경우, 반드시 후속 질문을 통해 **최근 2주간**의 **빈도나 강도**에 대해 자연스럽게 따뜻한 말투로 물어보세요.\n"
-                        "- 후속 질문은 기계적이거나 일반적인 표현을 피하고, 반드시 이전 사용자의 응답과 **맥락**을 고려한 말투여야 합니다.\n"
-                        "- 후속 질문 예시:\n"
-                        "  * “말씀해주셔서 감사해요. 최근 2주 동안 이런 일이 얼마나 자주 있었나요?”\n"
-                        "  * “많이 힘드셨겠어요. 최근 2주간 이런 기분이 거의 매일 있었을까요, 아니면 가끔이었을까요?”\n"
-                        "  * “솔직하게 얘기해주셔서 고마워요. 최근 2주간 이런 감정이 얼마나 강하게 느껴졌는지 말씀해주실 수 있을까요?”\n"
-                        "- 후속 질문에는 항상 '최근 2주간'이라는 표현이 **자연스럽게 포함**되어야 합니다.\n"
-                        "- 점수와 빈도/강도가 **모두** 명확히 파악된 경우에만 해당 항목을 'answered'상태로 간주하세요.\n"
-                        "- 사용자의 최근 응답을 바탕으로 다음으로 가장 관련 있어 보이는 미응답한 PHQ-9 항목 **하나만** 선택해 자연스럽게 다음 질문을 이어가세요.\n"
-                        f"- 다음 질문은 반드시 아래 미응답 항목 중 하나만 선택하세요:\n{unanswered_items}\n"
-                        "* 말투:\n"
-                        "- 항상 따뜻하고 지지적인, 배려심 있는 말투를 사용하세요. 친절한 친구처럼 대화해주세요.\n"
-                        "- 사용자를 재촉하거나 압박하지 말고, 필요한 경우에는 공감 어린 후속 질문으로 자연스럽게 유도하세요.\n\n"
-                        "* 출력 방식:\n"
-                        "- 사용자의 응답에 점수와 빈도/강도가 명확히 포함된 경우, 따뜻하게 공감하며 다음 미응답 항목으로 자연스럽게 넘어가세요.\n"
-                        "- 빈도 또는 강도 정보가 부족한 경우, **단 하나의 후속 질문**만 사용해 해당 정보를 자연스럽게 물어보세요. 반드시 대화 문맥에 맞는 따뜻한 말투여야 합니다."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"현재 미응답 항목 리스트:\n{unanswered_items}\n"
-                        f"이 중에서 가장 관련 있는 항목 하나를 골라 자연스럽게 질문하세요.\n"
-                        f"이전 대화: {context_text}\n"
-                        f"이전 답변 완료 문항: {[s['item'] for s in slot_doc['slots'] if s['status']=='answered']}"
-                    )
-                }
-            ],
-            temperature=0.0,
-            max_tokens=512
-        )
-        bot_response=response.choices[0].message.content.strip()
-        conversation_history.append(bot_response)
-        if len(conversation_history)>6:
-            conversation_history.pop(0)
+        #GPT응답생성 + 슬롯 업데이트 요청 (동시에 두 번 호출, combined 모드면 한 번 호출)
+        try:
+            ticket = admit_turn(slot_doc, user_message, context_text)
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+        with ticket:
+            bot_response, new_slot_data = generate_turn("phq9_high_c_low_u", unanswered_items, context_text, latest_user_input, slot_doc, "high_reply")
+        conversation_history = high_history_store.append(user_id, history, user_message, bot_response)
         updated_history="|".join(conversation_history)
-        #슬롯 업데이트
-        slot_update_prompt = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "당신은 사용자의 PHQ-9 자가진단 대화 내용을 바탕으로 JSON 배열을 생성하는 보조 도우미입니다.\n\n"
-                        "- 전체 대화 맥락(이전 발화들)과 최신 입력을 함께 고려해서 평가하세요."
-                        "- 빈도 또는 강도(freq_intensity)와 점수(score)가 모두 명확히 포함된 경우에만 해당 문항을 'answered'로 간주하세요."
-                        "- 출력은 아래와 같은 **JSON 배열 형식만** 제공해야 합니다. 그 외의 텍스트는 절대 포함하지 마세요:\n"
-                        "[\n"
-                        "  {\n"
-                        "    \"item\": \"우울감\",\n"
-                        "    \"status\": \"answered\",\n"
-                        "    \"score\": (사용자 응답에 근거하여 추론된 0~3 중 하나),\n"
-                        "    \"raw_user_input\": \"사용자의 원문 발화\",\n"
-                        "    \"freq_or_intensity\": \"사용자가 표현한 빈도 또는 강도 그대로(ex.거의 5일정도, 한 3~4일, 2주넘게)\",\n"
-                        "    \"last_updated\": null\n"
-                        "  }\n"
-                        "]\n\n"
-                        "예시:"
-                        "[\n"
-                        "  {\n"
-                        "    \"item\": \"식욕 저하\",\n"
-                        "    \"status\": \"answered\",\n"
-                        "    \"score\": 1,\n"
-                        "    \"raw_user_input\": \"맞아...초콜릿을 안 먹게 된지 3~4일 정도 된 것 같아...\",\n"
-                        "    \"freq_or_intensity\": \"3~4일 정도\",\n"
-                        "    \"last_updated\": null\n"
-                        "  }\n"
-                        "]\n"
-                        "- score는 다음 기준에 따라 추정하세요:\n"
-                        "  - 전혀 아니다, 그런 적 없다, 전혀 하지 않았다 → 0점\n"
-                        "  - 며칠 동안, 가끔 → 1점\n"
-                        "  - 절반 이상, 자주 → 2점\n"
-                        "  - 거의 매일, 대부분의 날 → 3점\n"
-                        "- 빈도나 강도에 대한 언급이 없으면 freq_or_intensity는 null로 설정하세요.\n"
-                        "- 사용자가 명확히 특정 증상이 *전혀 없다*고 말했으면, 꼭 status: answered, score: 0, freq_or_intensity: 거의 없음 으로 JSON 배열에 포함하세요.\n"
-                        "- 이전에 언급된 증상에 대한 후속 응답이 있을 수 있으므로, 같은 항목이라도 내용이 다르면 업데이트해야 합니다.\n"
-                        "- 이미 'answered' 상태로 응답된 문항은 다시 질문하지 마세요. JSON배열에도 포함하지 마세요.\n"
-                        f"- 가능한 item 값: {PHQ9_ITEMS}"
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"전체 대화 맥락:\n{context_text}\n\n"
-                        f"사용자의 최신 입력:\n{latest_user_input}\n\n"
-                        f"현재까지의 사용자 응답 상태(JSON):\n{json.dumps(slot_doc['slots'], ensure_ascii=False,default=str)}"
-                        f"사용자의 최신 응답은 '직전에 질문한 문항'에 대한 후속 설명일 가능성이 높습니다."
-                        f"따라서 '마지막으로 질문했던 문항'이 존재하면, 그 문항만을 업데이트 대상으로 간주하세요."
-                        f"* 이미 'answered'상태인 문항은 다시 묻거나 json배열에 포함하지 마세요:\n"
-                        f"{[s['item'] for s in slot_doc['slots'] if s['status'] == 'answered']}"
-                    )
-                }
-            ],
-            temperature=0.0,
-            max_tokens=512,
-        )
 
-        slot_update_str = slot_update_prompt.choices[0].message.content.strip()
-        logging.info(f"GPT JSON 응답 원문:\n{slot_update_str}")
         try:
-            new_slot_data = extract_json_array(slot_update_str)
             logging.info(f"업데이트할 슬롯 데이터: {new_slot_data}")
-            updated_slot_doc = update_slot_structure(slot_doc, new_slot_data)
-            slot_collection_high.replace_one({"user_id": user_id}, updated_slot_doc, upsert=True)
+            slot_doc = persist_slot_updates(slot_collection_high, user_id, slot_doc, new_slot_data, bot_response)
         except Exception as slot_err:
-            logging.warning(f"슬롯 JSON 파싱 실패: {slot_err}")
+            logging.warning(f"슬롯 저장 실패: {slot_err}")
 
         unanswered_items=[s['item'] for s in slot_doc['slots'] if s['status']!='answered']
         all_answered=len(unanswered_items)==0
 
         if all_answered:
-            bot_response="PHQ-9 모든 문항에 답변해주셔서 감사합니다. 수고 많으셨습니다."
-            conversation_history.append(bot_response)
-            updated_history="|".join(conversation_history)
-            slots_data = slot_doc['slots']
-            total_score = sum(s.get('score', 0) for s in slots_data)
-            return jsonify({
-                "response":bot_response,
-                "conversation_history":updated_history,
-                "finished":True,
-                "slots": slots_data,
-                "totalScore": total_score
-            })
+            return jsonify(build_high_final_payload(slot_doc, conversation_history))
 
         return jsonify({
             'response': bot_response,
@@ -861,6 +959,159 @@ def phq9_high_c_low_u():
         logging.error("채팅 처리 중 오류 발생:", exc_info=True)
         return jsonify({'error': 'An error occurred while processing the message.'}), 500
 
+#토큰 스트리밍(SSE) 버전 - 응답 토큰을 생성되는 대로 보내고, 슬롯 추출/저장은 백그라운드에서 마친다
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def extract_and_save_slots(collection, user_id, slot_doc, fast_slot_data, slot_kwargs):
+    """
+    슬롯 추출 GPT 호출 → 슬롯 업데이트 → 바뀐 필드 저장까지 수행하고 갱신된 slot_doc을 반환한다.
+    스트리밍 엔드포인트에서 llm_executor로 백그라운드 실행한다.
+    """
+    slot_update_prompt = create_completion_or_none(slot_kwargs, "slot_extraction") if slot_kwargs else None
+    try:
+        new_slot_data = resolve_slot_updates(fast_slot_data, slot_update_prompt)
+        logging.info(f"업데이트할 슬롯 데이터: {new_slot_data}")
+        slot_doc = persist_slot_updates(collection, user_id, slot_doc, new_slot_data)
+    except Exception as slot_err:
+        logging.warning(f"슬롯 JSON 파싱 실패: {slot_err}")
+    return slot_doc
+
+
+def stream_slot_turn(collection, history_store, template_name, build_final_payload):
+    """
+    /api/chat/stream, /api/phq9_high_c_low_u/stream 공통 처리.
+    event: token  → {"text": 응답 토큰}
+    event: done   → 일반 엔드포인트와 같은 최종 응답 (9문항 완료 시 summary_items, totalScore 포함)
+    event: error  → {"error": ...}
+    """
+    data = request.get_json()
+    user_message = data.get('message')
+    user_id = data.get('user_id') or 'default_user'
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    logging.info(f"사용자 메시지(stream): {user_message}")
+    history = history_store.get(user_id, parse_client_history(data.get('conversation_history')))
+    context_text = '|'.join(history + [user_message])
+
+    slot_doc = load_slot_doc(collection, user_id)
+    unanswered_items = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']
+
+    reply_kwargs = build_reply_request(unanswered_items, context_text, slot_doc, template_name=template_name)
+    fast_slot_data, slot_kwargs = prepare_slot_request(context_text, user_message, slot_doc)
+    try:
+        ticket = admit_turn(slot_doc, user_message, context_text)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    #슬롯 추출과 저장은 응답 스트리밍과 동시에 백그라운드에서 진행
+    #티켓은 스트림이 끝날 때 돌려주므로 with 대신 슬롯 추출 스레드에만 컨텍스트로 넘긴다
+    context_token = current_ticket.set(ticket)
+    try:
+        slot_future = submit_in_context(extract_and_save_slots, collection, user_id, slot_doc, fast_slot_data, slot_kwargs)
+    except BaseException:
+        ticket.release()
+        raise
+    finally:
+        current_ticket.reset(context_token)
+
+    def generate():
+        try:
+            tokens = []
+            stream_started_at = time.perf_counter()
+            try:
+                stream = create_completion(**reply_kwargs, stream=True)
+            except LLMUnavailableError as e:
+                #스트림을 열지 못하면 고정 질문을 한 번에 보낸다
+                logging.warning(f"GPT 호출 실패(reply stream): {e}")
+                stream = []
+                tokens.append(fallback_question(slot_doc, fast_slot_data or []))
+                yield sse_event("token", {"text": tokens[0]})
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    tokens.append(delta)
+                    yield sse_event("token", {"text": delta})
+
+            metrics.record_llm_call("reply", time.perf_counter() - stream_started_at)
+            bot_response = "".join(tokens).strip()
+            logging.info(f"GPT 응답(stream): {bot_response}")
+            conversation_history = history_store.append(user_id, history, user_message, bot_response)
+
+            updated_slot_doc = slot_future.result()
+            #응답이 끝난 뒤에야 이번에 물어본 문항을 알 수 있으므로 따로 기록
+            updated_slot_doc = persist_slot_updates(collection, user_id, updated_slot_doc, [], bot_response)
+            if all(s['status'] == 'answered' for s in updated_slot_doc['slots']):
+                yield sse_event("done", build_final_payload(updated_slot_doc, conversation_history))
+            else:
+                yield sse_event("done", {
+                    'response': bot_response,
+                    'conversation_history': '|'.join(conversation_history)
+                })
+        except Exception:
+            logging.error("스트리밍 채팅 처리 중 오류 발생:", exc_info=True)
+            yield sse_event("error", {'error': 'An error occurred while processing the message.'})
+        finally:
+            ticket.release()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    #스트림을 시작하기 전에 연결이 끊겨도 티켓을 돌려준다 (release는 여러 번 불러도 한 번만 반영)
+    response.call_on_close(ticket.release)
+    return response
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    try:
+        return stream_slot_turn(slot_collection, chat_history_store, "chat_reply", build_chat_final_payload)
+    except Exception:
+        logging.error("채팅 처리 중 오류 발생:", exc_info=True)
+        return jsonify({'error': 'An error occurred while processing the message.'}), 500
+
+
+@app.route('/api/phq9_high_c_low_u/stream', methods=['POST'])
+def phq9_high_c_low_u_stream():
+    try:
+        return stream_slot_turn(slot_collection_high, high_history_store, "high_reply", build_high_final_payload)
+    except Exception:
+        logging.error("채팅 처리 중 오류 발생:", exc_info=True)
+        return jsonify({'error': 'An error occurred while processing the message.'}), 500
+
+metrics.record_startup("import", time.perf_counter() - _import_started_at)
+
+
+def warm_up():
+    """
+    워커가 요청을 받기 전에 이 프로세스의 MongoDB/OpenAI 클라이언트를 만들고 MongoDB 연결을 한 번 맺어 둔다.
+    (gunicorn.conf.py의 post_worker_init에서 호출, 첫 요청이 연결 설정 시간을 떠안지 않도록)
+    """
+    started_at = time.perf_counter()
+    mongo_client.admin.command("ping")
+    client.get()
+    metrics.record_startup("warm_up", time.perf_counter() - started_at)
+
+
+def create_app():
+    """WSGI 서버용 앱 팩토리 (gunicorn "chatbot_service:create_app()"). 클라이언트는 워커에서 처음 쓸 때 만들어진다."""
+    return app
+
+
 #서버 실행
+#  python chatbot_service.py               # 개발 서버 (프로세스 1개)
+#  python chatbot_service.py --production  # gunicorn pre-fork 워커 (gunicorn.conf.py, 기본 코어 수만큼)
 if __name__ == '__main__':
+    if "--production" in sys.argv[1:]:
+        backend_dir = os.path.dirname(os.path.abspath(__file__))
+        os.chdir(backend_dir)
+        os.execvp("gunicorn", ["gunicorn", "-c", os.path.join(backend_dir, "gunicorn.conf.py"), "chatbot_service:create_app()"])
+    #필요한 인덱스 생성 (ENSURE_INDEXES=0이면 생략, 배포 시에는 python mongo_indexes.py --verify로 확인)
+    if os.environ.get("ENSURE_INDEXES", "1") != "0":
+        ensure_indexes(mongo_client)
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,421 @@
+#chatbot_service_async.py
+#chatbot_service.py와 같은 라우트를 비동기(ASGI) 방식으로 제공하는 서빙 모드
+#GPT 호출과 MongoDB 작업을 모두 await하므로 워커 하나가 수백 개의 대화를 동시에 들고 있을 수 있다.
+#실행 예시:
+#  hypercorn chatbot_service_async:app --bind 0.0.0.0:5001
+#  python chatbot_service_async.py
+#테스트할 때는 OPENAI_BASE_URL로 로컬 가짜 LLM 서버를, MONGO_URI로 로컬 mongod를 가리키거나
+#bind_clients()로 비동기 클라이언트를 직접 주입한다.
+#슬롯 문서/수정 답변 저장(slot_store.py), 입장 제어(llm_admission.py), 지표(/metrics)는 동기 앱과 같은 것을 쓴다.
+#동기 앱과 다른 점: 스트리밍 라우트, 연구 데이터 내보내기/분석 라우트, 고정 문항 대화 기록 write-behind가 없다
+#(대화 버킷은 요청 경로에서 바로 await로 저장).
+import asyncio
+import datetime
+import logging
+import os
+import time
+import pytz
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from pymongo import AsyncMongoClient
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+
+from pymongo.errors import OperationFailure
+
+import metrics
+from chatbot_service import (
+    PHQ9_FIXED,
+    PHQ9_FIXED_EDITABLE,
+    METRICS_ENDPOINTS,
+    METRICS_TIMING_HEADER,
+    llm_admission,
+    admission_request,
+    admission_metrics,
+    build_reply_request,
+    build_combined_request,
+    parse_combined_response,
+    COMBINED_LLM_ENDPOINTS,
+    prepare_slot_request,
+    resolve_slot_updates,
+    build_chat_final_payload,
+    build_high_final_payload,
+    LLM_CACHE_SIZE,
+    LLM_CACHE_TTL,
+    session_history_store,
+    resilient_completions,
+    build_llm_router,
+    fallback_question,
+    mongo_pool_options,
+    openai_http_client,
+)
+from dialog_store import dialog_message, bucket_append_op
+from session_history import parse_client_history
+from slot_store import aload_slot_doc, apersist_slot_updates, clean_edited_items, asave_edited_answers
+from llm_admission import AdmissionRejected, current_ticket
+from llm_cache import CompletionCache
+from llm_resilience import LLMUnavailableError
+from mongo_indexes import REQUIRED_INDEXES, OBSOLETE_INDEXES
+
+#환경 설정
+load_dotenv()
+app = Quart(__name__)
+app = cors(app, allow_credentials=True, allow_origin=["http://115.145.36.231:3000"])
+logging.basicConfig(level=logging.INFO)
+
+client = None
+llm_completions = None
+llm_router = None
+mongo_client = None
+slot_collection = None
+slot_collection_high = None
+phq9_fixed_slot_collection = None
+phq9_fixed_dialog_collection = None
+phq9_editable_slot_collection = None
+phq9_editable_dialog_collection = None
+edited_answers_collection = None
+chat_history_store = None
+high_history_store = None
+fixed_history_store = None
+editable_history_store = None
+
+
+def bind_clients(openai_client=None, async_mongo_client=None):
+    """
+    비동기 OpenAI / MongoDB 클라이언트를 연결하고 컬렉션 핸들을 다시 만든다.
+    인자를 생략하면 환경 변수(OPENAI_API_KEY, OPENAI_BASE_URL, MONGO_URI)로 새로 만든다.
+    """
+    global client, llm_completions, llm_router, mongo_client, slot_collection, slot_collection_high
+    global phq9_fixed_slot_collection, phq9_fixed_dialog_collection, edited_answers_collection
+    global phq9_editable_slot_collection, phq9_editable_dialog_collection
+    global chat_history_store, high_history_store, fixed_history_store, editable_history_store
+
+    client = openai_client or AsyncOpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0, http_client=openai_http_client(async_client=True)
+    )
+    llm_completions = resilient_completions(client.chat.completions.create)
+    llm_router = build_llm_router(llm_completions)
+    mongo_client = async_mongo_client or AsyncMongoClient(
+        os.environ.get("MONGO_URI"), event_listeners=[metrics.MongoMetricsListener()], **mongo_pool_options()
+    )
+
+    db = mongo_client["phq9_chatbot"]
+    slot_collection = db["slots"]
+    edited_answers_collection = db["edited_answers"]
+    phq9_fixed_db = mongo_client["phq9_fixed_db"]
+    phq9_fixed_slot_collection = phq9_fixed_db["slots"]
+    phq9_fixed_dialog_collection = phq9_fixed_db["phq9_fixed_dialog"]
+    phq9_editable_db = mongo_client["phq9_fixed_editable"]
+    phq9_editable_slot_collection = phq9_editable_db["slots"]
+    phq9_editable_dialog_collection = phq9_editable_db["dialog"]
+    slot_collection_high = mongo_client["phq9_high_c_low_u"]["slots"]
+    chat_history_store = session_history_store(db["session_history"])
+    high_history_store = session_history_store(mongo_client["phq9_high_c_low_u"]["session_history"])
+    fixed_history_store = session_history_store(phq9_fixed_db["session_history"])
+    editable_history_store = session_history_store(phq9_editable_db["session_history"])
+
+
+@app.before_serving
+async def bind_default_clients():
+    #클라이언트는 import 시점이 아니라 워커 프로세스가 서빙을 시작할 때 만든다 (이미 bind_clients로 연결했으면 그대로 사용)
+    if mongo_client is None:
+        started_at = time.perf_counter()
+        bind_clients()
+        logging.info(f"비동기 클라이언트 연결 ({time.perf_counter() - started_at:.3f}초)")
+
+
+#비동기 모드에서는 프로세스 내 캐시만 사용 (공유 백엔드는 동기 pymongo라 이벤트 루프를 막음)
+completion_cache = CompletionCache(
+    max_entries=LLM_CACHE_SIZE, ttl_seconds=LLM_CACHE_TTL, on_event=metrics.record_cache_event
+) if LLM_CACHE_SIZE > 0 else None
+
+
+async def create_completion(stage="reply", **kwargs):
+    """chatbot_service.create_completion의 비동기 버전 (같은 백엔드 선택 규칙과 지표)"""
+    started_at = time.perf_counter()
+    backend = llm_router.select(metrics.current_endpoint.get(), stage, kwargs)
+    if backend.model:
+        kwargs["model"] = backend.model
+
+    async def backend_create(**call_kwargs):
+        #캐시 적중이 아닌 실제 호출의 토큰 사용량만 입장 제어 토큰 예산에 반영
+        response = await backend.acreate(**call_kwargs)
+        ticket = current_ticket.get()
+        usage = getattr(response, "usage", None)
+        if ticket is not None and usage is not None:
+            ticket.record_usage(usage.total_tokens or 0)
+        return response
+
+    try:
+        if completion_cache is None:
+            response = await backend_create(**kwargs)
+        else:
+            response = await completion_cache.acached_create(backend_create, **kwargs)
+    except Exception:
+        metrics.record_llm_call(stage, time.perf_counter() - started_at, error=True)
+        raise
+    metrics.record_llm_call(stage, time.perf_counter() - started_at, response)
+    return response
+
+
+async def create_completion_or_none(kwargs, stage="reply"):
+    try:
+        return await create_completion(stage, **kwargs)
+    except LLMUnavailableError as e:
+        logging.warning(f"GPT 호출 실패({stage}): {e}")
+        return None
+
+
+async def admit_turn(slot_doc, user_message, context_text):
+    """chatbot_service.admit_turn의 비동기 버전. 동기 앱과 같은 입장 제어(llm_admission)를 쓴다."""
+    with metrics.timed_stage("admission"):
+        return await llm_admission.aadmit(*admission_request(slot_doc, user_message, context_text))
+
+
+def admission_rejected_response(error):
+    """과부하 응답 (503 + Retry-After). 클라이언트는 잠시 후 같은 메시지를 다시 보낸다."""
+    logging.warning(f"GPT 호출 입장 거절: {error.reason} (Retry-After {error.retry_after}초)")
+    response = jsonify({'error': 'The server is busy. Please try again shortly.'})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+@app.before_request
+async def start_request_metrics():
+    request.metrics_started_at = metrics.start_request(METRICS_ENDPOINTS.get(request.endpoint, "other"))
+
+
+@app.after_request
+async def finish_request_metrics(response):
+    started_at = getattr(request, "metrics_started_at", None)
+    if started_at is not None and request.endpoint != "metrics_endpoint":
+        server_timing = metrics.finish_request(started_at, response.status_code)
+        if METRICS_TIMING_HEADER:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+
+def completion_cache_metrics():
+    if completion_cache is None:
+        return []
+    lines = ["# HELP chatbot_llm_cache_entries 프로세스 내 GPT 응답 캐시 항목 수", "# TYPE chatbot_llm_cache_entries gauge"]
+    lines.append(f"chatbot_llm_cache_entries {completion_cache.stats()['size']}")
+    return lines
+
+
+def circuit_breaker_metrics():
+    if llm_completions is None:
+        return []
+    return [
+        "# HELP chatbot_llm_circuit_open GPT 호출 서킷 브레이커가 열려 있으면 1",
+        "# TYPE chatbot_llm_circuit_open gauge",
+        f"chatbot_llm_circuit_open {int(llm_completions.breaker.is_open)}",
+    ]
+
+
+#chatbot_service가 등록한 수집 함수는 동기 앱의 캐시/서킷 브레이커/write-behind 큐를 읽으므로 이 앱의 것으로 바꾼다
+metrics.registry.collectors[:] = [completion_cache_metrics, circuit_breaker_metrics, admission_metrics]
+
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/')
+async def home():
+    return "Hello, Quart server is running!"
+
+
+async def generate_turn(endpoint, unanswered_items, context_text, latest_user_input, slot_doc, template_name):
+    """chatbot_service.generate_turn의 비동기 버전. (봇 응답, 슬롯 업데이트 리스트)를 반환한다."""
+    fast_slot_data, slot_kwargs = prepare_slot_request(context_text, latest_user_input, slot_doc)
+    if slot_kwargs is not None and endpoint in COMBINED_LLM_ENDPOINTS:
+        response = await create_completion_or_none(
+            build_combined_request(unanswered_items, context_text, latest_user_input, slot_doc, template_name), "combined"
+        )
+        if response is None:
+            return fallback_question(slot_doc), []
+        bot_response, new_slot_data = parse_combined_response(response)
+        if bot_response:
+            return bot_response, new_slot_data
+        logging.warning("combined 응답에서 응답 문장을 얻지 못해 두 번 호출로 다시 시도")
+
+    reply_kwargs = build_reply_request(unanswered_items, context_text, slot_doc, template_name=template_name)
+    if slot_kwargs is None:
+        response, slot_update_prompt = await create_completion_or_none(reply_kwargs), None
+    else:
+        response, slot_update_prompt = await asyncio.gather(
+            create_completion_or_none(reply_kwargs),
+            create_completion_or_none(slot_kwargs, "slot_extraction"),
+        )
+    try:
+        new_slot_data = resolve_slot_updates(fast_slot_data, slot_update_prompt)
+    except Exception as slot_err:
+        logging.warning(f"슬롯 JSON 파싱 실패: {slot_err}")
+        new_slot_data = []
+    if response is None:
+        return fallback_question(slot_doc, new_slot_data), new_slot_data
+    return response.choices[0].message.content.strip(), new_slot_data
+
+
+async def run_slot_turn(endpoint, collection, history_store, data, template_name, build_final_payload):
+    """
+    /api/chat, /api/phq9_high_c_low_u 공통 처리.
+    응답 생성과 슬롯 추출 GPT 호출을 동시에 await하고(combined 모드면 한 번 호출) 슬롯 문서를 갱신한다.
+    """
+    user_message = data.get('message')
+    user_id = data.get('user_id') or 'default_user'
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    logging.info(f"사용자 메시지: {user_message}")
+    history = await history_store.aget(user_id, parse_client_history(data.get('conversation_history')))
+    latest_user_input = user_message
+    context_text = '|'.join(history + [user_message])
+
+    slot_doc = await aload_slot_doc(collection, user_id)
+    unanswered_items = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']
+
+    try:
+        ticket = await admit_turn(slot_doc, user_message, context_text)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    with ticket:
+        bot_response, new_slot_data = await generate_turn(
+            endpoint, unanswered_items, context_text, latest_user_input, slot_doc, template_name
+        )
+    logging.info(f"GPT 응답: {bot_response}")
+    conversation_history = await history_store.aappend(user_id, history, user_message, bot_response)
+    updated_history='|'.join(conversation_history)
+
+    try:
+        logging.info(f"업데이트할 슬롯 데이터: {new_slot_data}")
+        slot_doc = await apersist_slot_updates(collection, user_id, slot_doc, new_slot_data, bot_response)
+    except Exception as slot_err:
+        logging.warning(f"슬롯 저장 실패: {slot_err}")
+
+    unanswered_items = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']
+    if len(unanswered_items)==0:
+        return jsonify(build_final_payload(slot_doc, conversation_history))
+    return jsonify({
+        'response': bot_response,
+        'conversation_history': updated_history
+    })
+
+
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    try:
+        data = await request.get_json()
+        return await run_slot_turn("chat", slot_collection, chat_history_store, data, "chat_reply", build_chat_final_payload)
+    except Exception:
+        logging.error("채팅 처리 중 오류 발생:", exc_info=True)
+        return jsonify({'error': 'An error occurred while processing the message.'}), 500
+
+
+@app.route('/api/phq9_high_c_low_u', methods=['POST'])
+async def phq9_high_c_low_u():
+    try:
+        data = await request.get_json()
+        return await run_slot_turn("phq9_high_c_low_u", slot_collection_high, high_history_store, data, "high_reply", build_high_final_payload)
+    except Exception:
+        logging.error("채팅 처리 중 오류 발생:", exc_info=True)
+        return jsonify({'error': 'An error occurred while processing the message.'}), 500
+
+
+async def run_fixed_turn(questionnaire, session_collection, dialog_collection, history_store, data):
+    """
+    /api/phq9_fixed, /api/phq9_fixed_editable 공통 처리 (동기 버전 run_fixed_turn과 동일한 흐름).
+    """
+    user_message = data.get('message')
+    user_id = data.get('user_id', 'default_user')
+    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
+
+    with metrics.timed_stage("questionnaire"):
+        plan = await questionnaire.aadvance(session_collection, user_id, user_message, now)
+
+    #이번 턴의 대화 메시지를 버킷에 한 번에 추가
+    turn_messages = []
+    if user_message:
+        turn_messages.append(dialog_message("user", user_message, now))
+    if plan.bot_message:
+        turn_messages.append(dialog_message("bot", plan.bot_message, now))
+    if turn_messages:
+        query, update = bucket_append_op(user_id, turn_messages)
+        await dialog_collection.update_one(query, update, upsert=True)
+
+    history = [] if plan.step.starts_session else await history_store.aget(user_id)
+    conversation_history = await history_store.aappend(user_id, history, user_message, plan.response)
+
+    payload = {
+        'response': plan.response,
+        'conversation_history': '|'.join(conversation_history)
+    }
+    if plan.summary_items is not None:
+        payload["summary_items"] = plan.summary_items
+    return jsonify(payload)
+
+
+@app.route('/api/phq9_fixed', methods=['POST'])
+async def fixed_phq9_chat():
+    try:
+        data = await request.get_json()
+        return await run_fixed_turn(PHQ9_FIXED, phq9_fixed_slot_collection, phq9_fixed_dialog_collection, fixed_history_store, data)
+    except Exception:
+        logging.error("고정 질문 API 오류 발생", exc_info=True)
+        return jsonify({'error': '고정 질문 API 처리 중 오류 발생'}), 500
+
+
+@app.route('/api/phq9_fixed_editable', methods=['POST'])
+async def fixed_phq9_editable():
+    try:
+        data = await request.get_json()
+        return await run_fixed_turn(PHQ9_FIXED_EDITABLE, phq9_editable_slot_collection, phq9_editable_dialog_collection, editable_history_store, data)
+    except Exception:
+        logging.error("고정 질문 API 오류 발생", exc_info=True)
+        return jsonify({'error': '고정 질문 API 처리 중 오류 발생'}), 500
+
+
+@app.route('/api/summary/edit', methods=['POST'])
+async def submit_edited_answers():
+    try:
+        data = await request.get_json()
+        user_id = data.get('user_id', 'default_user')
+        try:
+            cleaned = clean_edited_items(data.get('edited_items'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        edited_id = await asave_edited_answers(edited_answers_collection, phq9_editable_slot_collection, user_id, cleaned)
+
+        return jsonify({
+            "message": "edited answers saved",
+            "edited_id": str(edited_id),
+            "count": len(cleaned)
+        }), 200
+
+    except Exception:
+        logging.exception("submit_edited_answers error")
+        return jsonify({"error": "internal error"}), 500
+
+@app.before_serving
+async def create_indexes():
+    #필요한 인덱스 생성 (ENSURE_INDEXES=0이면 생략)
+    if os.environ.get("ENSURE_INDEXES", "1") == "0":
+        return
+    for (db_name, coll_name), models in REQUIRED_INDEXES.items():
+        try:
+            await mongo_client[db_name][coll_name].create_indexes(models)
+        except OperationFailure as e:
+            logging.error(f"인덱스 생성 실패 {db_name}.{coll_name}: {e}")
+    for (db_name, coll_name), names in OBSOLETE_INDEXES.items():
+        existing = await mongo_client[db_name][coll_name].index_information()
+        for name in names:
+            if name in existing:
+                await mongo_client[db_name][coll_name].drop_index(name)
+
+#서버 실행
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5001)
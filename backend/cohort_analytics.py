@@ -0,0 +1,264 @@
+#cohort_analytics.py
+#실험군별 PHQ-9 코호트 분석 (numpy)
+#각 실험군의 slots 컬렉션에서 점수/응답 여부만 projection으로 커서 배치를 읽어, 사용자 한 명 = 한 행,
+#문항 9개 = 열인 배열에 채운다. 심각도 구간, 문항별 평균, 완료율, 완료까지 걸린 턴 수, 실험군 간 총점 비교는
+#전부 배열 연산으로 계산하므로 세션 수가 수십만이 되어도 문서를 하나씩 다루는 비용은 읽기 한 번뿐이다.
+#결과는 실험군별 (문서 수, 마지막 완료 시각) 지문이 바뀔 때까지, 즉 새 세션이나 새 완료가 생길 때까지 캐시한다.
+#진행 중인 세션의 부분 점수는 다음 완료 때 반영된다.
+#고정 문항 실험군(phq9_fixed_db, phq9_fixed_editable)은 답변이 점수 없는 자유 텍스트라 완료율/답변 수만 계산한다.
+#실행 예시:
+#  python cohort_analytics.py          # MONGO_URI의 데이터로 계산해서 JSON 출력
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from pymongo import DESCENDING, ReadPreference
+
+#name: 결과에 쓰는 실험군 이름 (엔드포인트 이름과 같음)
+Arm = namedtuple("Arm", ["name", "db", "collection"])
+
+SCORED_ARMS = [
+    Arm("chat", "phq9_chatbot", "slots"),
+    Arm("phq9_high_c_low_u", "phq9_high_c_low_u", "slots"),
+]
+FIXED_ARMS = [
+    Arm("phq9_fixed", "phq9_fixed_db", "slots"),
+    Arm("phq9_fixed_editable", "phq9_fixed_editable", "slots"),
+]
+
+#PHQ-9 총점 심각도 구간: 0-4, 5-9, 10-14, 15-19, 20-27
+SEVERITY_BANDS = ["minimal", "mild", "moderate", "moderately_severe", "severe"]
+SEVERITY_EDGES = [5, 10, 15, 20]
+MAX_TOTAL_SCORE = 27
+
+SLOT_PROJECTION = {"_id": 0, "slots.item": 1, "slots.status": 1, "slots.score": 1, "turn_count": 1, "completed_turn": 1}
+
+#scores: (n, 9) float32, 점수가 없으면 NaN / answered: (n, 9) bool
+#turn_count/completed_turn: (n,) float32, 기록이 없는 예전 문서는 NaN
+ArmColumns = namedtuple("ArmColumns", ["scores", "answered", "turn_count", "completed_turn"])
+
+
+def _number(value):
+    return np.nan if value is None else value
+
+
+def load_arm_columns(collection, items, batch_size=5000):
+    """slots 컬렉션을 batch_size 행짜리 배열 묶음에 채운 뒤 하나로 잇는다."""
+    index = {item: i for i, item in enumerate(items)}
+    width = len(items)
+    chunks = []
+    row = batch_size
+    cursor = collection.find({}, SLOT_PROJECTION).batch_size(batch_size)
+    try:
+        for doc in cursor:
+            if row == batch_size:
+                chunk = ArmColumns(
+                    np.full((batch_size, width), np.nan, dtype=np.float32),
+                    np.zeros((batch_size, width), dtype=bool),
+                    np.full(batch_size, np.nan, dtype=np.float32),
+                    np.full(batch_size, np.nan, dtype=np.float32),
+                )
+                chunks.append(chunk)
+                row = 0
+            for slot in doc.get("slots") or []:
+                col = index.get(slot.get("item"))
+                if col is None:
+                    continue
+                if slot.get("score") is not None:
+                    chunk.scores[row, col] = slot["score"]
+                chunk.answered[row, col] = slot.get("status") == "answered"
+            chunk.turn_count[row] = _number(doc.get("turn_count"))
+            chunk.completed_turn[row] = _number(doc.get("completed_turn"))
+            row += 1
+    finally:
+        cursor.close()
+    if not chunks:
+        return ArmColumns(np.empty((0, width), np.float32), np.empty((0, width), bool),
+                          np.empty(0, np.float32), np.empty(0, np.float32))
+    chunks[-1] = ArmColumns(*(column[:row] for column in chunks[-1]))
+    return ArmColumns(*(np.concatenate(columns) for columns in zip(*chunks)))
+
+
+def completed_totals(columns):
+    """9문항을 모두 응답한 행의 총점 (응답한 문항의 점수만 더한다)"""
+    completed = columns.answered.all(axis=1)
+    scores = np.where(columns.answered & ~np.isnan(columns.scores), columns.scores, 0)
+    return scores[completed].sum(axis=1)
+
+
+def _ratio(numerator, denominator):
+    return round(float(numerator) / denominator, 4) if denominator else None
+
+
+def _rounded(values):
+    return [None if np.isnan(v) else round(float(v), 4) for v in values]
+
+
+def distribution(values):
+    """값 배열의 요약 통계 (비어 있으면 n만)"""
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {"n": 0}
+    p25, median, p75, p90 = np.percentile(values, [25, 50, 75, 90])
+    return {
+        "n": int(len(values)),
+        "mean": round(float(values.mean()), 3),
+        "std": round(float(values.std(ddof=1)), 3) if len(values) > 1 else 0.0,
+        "p25": float(p25), "median": float(median), "p75": float(p75), "p90": float(p90),
+    }
+
+
+def severity_counts(totals):
+    return np.bincount(np.digitize(totals, SEVERITY_EDGES), minlength=len(SEVERITY_BANDS))
+
+
+def summarize_scored_arm(columns, items):
+    sessions = len(columns.scores)
+    completed = columns.answered.all(axis=1)
+    totals = completed_totals(columns)
+    scored = columns.answered & ~np.isnan(columns.scores)
+    item_counts = scored.sum(axis=0)
+    item_sums = np.where(scored, columns.scores, 0).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        item_means = item_sums / item_counts
+    bands = severity_counts(totals)
+    return {
+        "sessions": sessions,
+        "completed": int(completed.sum()),
+        "completion_rate": _ratio(completed.sum(), sessions),
+        "items": [
+            {"item": item, "answer_rate": _ratio(count, sessions), "mean_score": mean}
+            for item, count, mean in zip(items, item_counts, _rounded(item_means))
+        ],
+        "severity": {band: int(count) for band, count in zip(SEVERITY_BANDS, bands)},
+        "severity_ratio": {band: _ratio(count, len(totals)) for band, count in zip(SEVERITY_BANDS, bands)},
+        "total_score": distribution(totals.astype(np.float64)),
+        "total_score_histogram": np.bincount(totals.astype(np.int64), minlength=MAX_TOTAL_SCORE + 1).tolist(),
+        "turns_to_completion": distribution(columns.completed_turn[completed].astype(np.float64)),
+    }
+
+
+def compare_totals(a, b):
+    """
+    두 실험군의 완료 총점 비교: 평균 차이(a - b), Cohen's d, Welch t와 정규 근사 양측 p값,
+    심각도 구간 비율 차이. 표본이 2개 미만이면 None.
+    """
+    if len(a) < 2 or len(b) < 2:
+        return None
+    mean_a, mean_b = float(a.mean()), float(b.mean())
+    var_a, var_b = float(a.var(ddof=1)), float(b.var(ddof=1))
+    pooled = math.sqrt(((len(a) - 1) * var_a + (len(b) - 1) * var_b) / (len(a) + len(b) - 2))
+    se = math.sqrt(var_a / len(a) + var_b / len(b))
+    t = (mean_a - mean_b) / se if se else 0.0
+    ratio_diff = severity_counts(a) / len(a) - severity_counts(b) / len(b)
+    return {
+        "n": [int(len(a)), int(len(b))],
+        "mean_diff": round(mean_a - mean_b, 3),
+        "cohens_d": round((mean_a - mean_b) / pooled, 3) if pooled else 0.0,
+        "welch_t": round(t, 3),
+        "p_value": round(math.erfc(abs(t) / math.sqrt(2)), 6),
+        "severity_ratio_diff": {band: round(float(d), 4) for band, d in zip(SEVERITY_BANDS, ratio_diff)},
+    }
+
+
+def summarize_fixed_arm(collection, item_count):
+    """고정 문항 실험군: 세션별 답변 수만 서버에서 세어 받아 완료율/답변 수 분포를 계산한다."""
+    pipeline = [{"$project": {"_id": 0, "answered": {"$size": {"$objectToArray": {"$ifNull": ["$answers", {}]}}}}}]
+    answered = np.fromiter((doc["answered"] for doc in collection.aggregate(pipeline)), dtype=np.int64)
+    completed = answered >= item_count
+    return {
+        "sessions": int(len(answered)),
+        "completed": int(completed.sum()),
+        "completion_rate": _ratio(completed.sum(), len(answered)),
+        "answered_items": distribution(answered.astype(np.float64)),
+    }
+
+
+class CohortAnalytics:
+    """
+    items: 문항 이름 리스트 (PHQ9_ITEMS, 배열 열 순서)
+    summary()는 지문이 같으면 캐시된 결과를 돌려주고, 바뀌었으면 한 요청만 다시 계산한다.
+    """
+
+    def __init__(self, mongo_client, items, scored_arms=SCORED_ARMS, fixed_arms=FIXED_ARMS, batch_size=5000):
+        self.mongo_client = mongo_client
+        self.items = list(items)
+        self.batch_size = batch_size
+        self.scored_arms = list(scored_arms)
+        self.fixed_arms = list(fixed_arms)
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._result = None
+
+    def _collection(self, arm):
+        #분석 읽기는 서비스 트래픽과 겹치지 않도록 가능하면 secondary에서 읽는다
+        return self.mongo_client[arm.db][arm.collection].with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+
+    def fingerprint(self):
+        """실험군별 (문서 수 추정치, 마지막 완료 시각). completed_at 인덱스로 문서 하나만 읽는다."""
+        parts = []
+        for arm in self.scored_arms + self.fixed_arms:
+            collection = self._collection(arm)
+            latest = list(collection.find({}, {"_id": 0, "completed_at": 1}).sort("completed_at", DESCENDING).limit(1))
+            parts.append((arm.name, collection.estimated_document_count(), latest[0].get("completed_at") if latest else None))
+        return tuple(parts)
+
+    def invalidate(self):
+        with self._lock:
+            self._fingerprint = None
+
+    def compute(self):
+        started_at = time.perf_counter()
+        arms = {}
+        totals = {}
+        for arm in self.scored_arms:
+            columns = load_arm_columns(self._collection(arm), self.items, self.batch_size)
+            arms[arm.name] = summarize_scored_arm(columns, self.items)
+            totals[arm.name] = completed_totals(columns).astype(np.float64)
+        for arm in self.fixed_arms:
+            arms[arm.name] = summarize_fixed_arm(self._collection(arm), len(self.items))
+        names = list(totals)
+        comparisons = {
+            f"{a}_vs_{b}": compare_totals(totals[a], totals[b])
+            for i, a in enumerate(names) for b in names[i + 1:]
+        }
+        elapsed = time.perf_counter() - started_at
+        logging.info(f"코호트 분석 계산 완료 ({elapsed:.2f}초)")
+        return {
+            "arms": arms,
+            "comparisons": comparisons,
+            "severity_bands": dict(zip(SEVERITY_BANDS, ["0-4", "5-9", "10-14", "15-19", "20-27"])),
+            "computed_at": time.time(),
+            "compute_seconds": round(elapsed, 3),
+        }
+
+    def summary(self):
+        """(결과, 캐시 사용 여부)"""
+        fingerprint = self.fingerprint()
+        with self._lock:
+            if self._result is not None and fingerprint == self._fingerprint:
+                return self._result, True
+            self._result = self.compute()
+            self._fingerprint = fingerprint
+            return self._result, False
+
+
+if __name__ == "__main__":
+    import json
+    import os
+
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    #chatbot_service를 불러오면 서버 전체가 초기화되므로 문항 이름은 슬롯 문서 순서를 따른다
+    client = MongoClient(os.environ.get("MONGO_URI"))
+    sample = client[SCORED_ARMS[0].db][SCORED_ARMS[0].collection].find_one({}, {"slots.item": 1})
+    if sample is None:
+        raise SystemExit("슬롯 문서가 없습니다")
+    analytics = CohortAnalytics(client, [s["item"] for s in sample["slots"]])
+    print(json.dumps(analytics.compute(), ensure_ascii=False, indent=2))
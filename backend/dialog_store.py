@@ -0,0 +1,234 @@
+#dialog_store.py
+#고정 문항 대화 기록을 고정 크기 버킷 문서에 나눠 저장하는 모듈
+#사용자당 문서 하나에 $push 하던 방식은 세션이 쌓일수록 문서가 끝없이 커지고 find_one 때마다 전체 배열을 읽었다.
+#버킷 문서: {"user", "messages": [...약 DIALOG_BUCKET_SIZE개, 한 턴의 메시지는 나누지 않음], "count", "first_ts", "last_ts",
+#          "last_stored_at", "createdAt"}
+#메시지의 timestamp는 요청 시각, stored_at은 실제로 쓴 시각이다. write-behind는 재시도 때문에 요청보다 한참 뒤에 저장될 수 있으므로
+#증분 내보내기(study_export.py)는 stored_at/last_stored_at을 기준으로 구간을 나눈다.
+#추가는 열린 버킷(count < 크기)에 upsert 한 번. 응답에 쓰는 최근 이력은 session_history에 따로 두므로 앱은 버킷을 읽지 않는다.
+#DialogWriter는 요청 경로에서 큐에 넣기만 하고 백그라운드 스레드가 여러 턴을 모아 bulk_write로 저장한다 (write-behind).
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DIALOG_BUCKET_SIZE = int(os.environ.get("DIALOG_BUCKET_SIZE", "50"))
+
+
+def dialog_message(sender, text, timestamp):
+    return {"sender": sender, "text": text, "timestamp": timestamp}
+
+
+def bucket_append_op(user, messages, bucket_size=DIALOG_BUCKET_SIZE):
+    """
+    messages를 user의 열린 버킷에 추가하는 (filter, update)를 만든다. 열린 버킷이 없으면 upsert로 새 버킷이 생긴다.
+    동기/비동기 컬렉션 모두 update_one(filter, update, upsert=True)로 실행한다.
+    메시지마다 stored_at(지금 시각)을 붙이므로 쓰기 직전에 만든다 (재시도할 때도 다시 만든다).
+    """
+    timestamps = [m["timestamp"] for m in messages]
+    stored_at = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        {"user": user, "count": {"$lt": bucket_size}},
+        {
+            "$push": {"messages": {"$each": [dict(m, stored_at=stored_at) for m in messages]}},
+            "$inc": {"count": len(messages)},
+            "$min": {"first_ts": min(timestamps)},
+            "$max": {"last_ts": max(timestamps), "last_stored_at": stored_at},
+            "$setOnInsert": {"createdAt": min(timestamps)},
+        },
+    )
+
+
+def append_dialog_messages(collection, user, messages):
+    """한 턴의 메시지들을 한 번의 쓰기로 저장한다."""
+    if not messages:
+        return None
+    query, update = bucket_append_op(user, messages)
+    return collection.update_one(query, update, upsert=True)
+
+
+class DialogWriter:
+    """
+    대화 메시지 write-behind 저장기. append()는 턴을 큐에 넣고 바로 돌아오며,
+    백그라운드 스레드가 flush_interval초 동안(최대 batch_size턴) 모은 턴을 컬렉션별 ordered bulk_write 한 번으로 저장한다.
+    max_queue: 큐에 쌓아 둘 수 있는 턴 수 (메모리 상한). 가득 차면 요청이 put_timeout초까지 자리가 나기를 기다리고(역압력),
+      그래도 가득 차 있으면 그 턴은 요청 경로에서 바로 저장한다. 이때는 대기 중인 턴보다 먼저 저장될 수 있다 (timestamp는 그대로).
+    on_event: (이벤트, 개수)를 받는 콜백 (지표 기록용)
+      queued, written: 큐에 넣은/저장한 턴 수, sync_write: durable이거나 큐가 가득 차거나 종료 중이라 바로 저장한 턴 수,
+      retry: 배치 재시도 횟수, dropped: 저장을 포기한 턴 수,
+      write_concern_error: 적용은 됐지만 write concern 확인을 받지 못한 배치 수 (다시 보내지 않고 저장된 것으로 센다)
+    프로세스가 살아 있는 동안만 재시도한다: 연결 오류 등으로 실패한 배치는 성공할 때까지 지수 백오프로 다시 보내며,
+    결과를 알 수 없는 오류 뒤에는 남은 턴을 다시 보내므로 드물게 같은 턴이 두 번 저장될 수 있다.
+    큐는 메모리에만 있으므로 프로세스가 비정상 종료(OOM, SIGKILL, 워커 타임아웃)하면 아직 저장하지 못한 턴은 사라진다.
+    잃으면 안 되는 턴은 append(durable=True)로 요청 경로에서 바로 저장하고, 모든 턴이 그래야 하면 write-behind를 끈다.
+    문서 자체가 거부된 턴(BulkWriteError)은 다시 보내도 실패하므로 로그를 남기고 버린다.
+    워커 스레드는 프로세스(PID)마다 처음 append할 때 시작한다 (pre-fork 워커용). close()는 남은 턴을 저장하고 멈춘다.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.05, put_timeout=1.0,
+                 retry_backoff=0.5, max_backoff=10.0, on_event=None):
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.on_event = on_event
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition()
+        self._pending = 0  #큐에 넣었지만 아직 저장(또는 포기)하지 않은 턴 수
+        self._closing = False
+        self._close_deadline = None
+
+    @property
+    def pending(self):
+        return self._pending if self._pid == os.getpid() else 0
+
+    def _notify(self, event, count=1):
+        if self.on_event is not None and count:
+            self.on_event(event, count)
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.max_queue)
+                    self._pending = 0
+                    self._closing = False
+                    self._thread = threading.Thread(target=self._run, args=(self._queue,), name="dialog-writer", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def append(self, collection, user, messages, durable=False):
+        """
+        한 턴의 메시지들을 저장 대기열에 넣는다.
+        durable이면 큐를 거치지 않고 요청 경로에서 바로 저장한다 (위기 턴용). 큐가 가득 찬 경우처럼
+        같은 사용자의 대기 중인 턴보다 먼저 저장될 수 있다 (timestamp는 그대로).
+        """
+        if not messages:
+            return
+        if durable:
+            self._notify("sync_write")
+            append_dialog_messages(collection, user, messages)
+            return
+        pending_queue = self._ensure_worker()
+        if not self._closing:
+            with self._idle:
+                self._pending += 1
+            try:
+                pending_queue.put((collection, user, messages), timeout=self.put_timeout)
+                self._notify("queued")
+                return
+            except queue.Full:
+                self._done(1)
+        self._notify("sync_write")
+        append_dialog_messages(collection, user, messages)
+
+    def _done(self, count):
+        with self._idle:
+            self._pending -= count
+            if self._pending <= 0:
+                self._idle.notify_all()
+
+    def _run(self, pending_queue):
+        stop = False
+        while not stop:
+            item = pending_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = pending_queue.get(timeout=max(deadline - time.monotonic(), 0.0001))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write_batch(batch)
+            except Exception:
+                logging.exception(f"대화 기록 저장 중 예기치 않은 오류, {len(batch)}턴 버림")
+                self._notify("dropped", len(batch))
+            finally:
+                self._done(len(batch))
+
+    def _write_batch(self, batch):
+        groups = {}
+        for collection, user, messages in batch:
+            groups.setdefault(collection.full_name, (collection, []))[1].append((user, messages))
+        for collection, turns in groups.values():
+            self._bulk_write(collection, turns)
+
+    def _bulk_write(self, collection, turns):
+        backoff = self.retry_backoff
+        while turns:
+            #stored_at이 실제 쓰기 시각이 되도록 시도할 때마다 연산을 새로 만든다
+            ops = [UpdateOne(*bucket_append_op(user, messages), upsert=True) for user, messages in turns]
+            try:
+                collection.bulk_write(ops, ordered=True)
+                self._notify("written", len(ops))
+                return
+            except BulkWriteError as e:
+                if e.details.get("writeConcernErrors"):
+                    #primary에는 적용됐지만 write concern 확인을 못 받은 것. 다시 보내면 같은 턴이 두 번 쌓이므로 저장된 것으로 본다
+                    logging.warning(f"대화 기록 write concern 확인 실패 ({collection.full_name}): "
+                                    f"{e.details['writeConcernErrors'][0].get('errmsg')}")
+                    self._notify("write_concern_error")
+                errors = e.details.get("writeErrors")
+                if not errors:
+                    self._notify("written", len(ops))
+                    return
+                #ordered 배치는 거부된 턴 앞까지는 저장되어 있으므로, 거부된 턴은 버리고 그 뒤부터 다시 보낸다
+                failed = errors[0]["index"]
+                logging.error(f"대화 기록 저장 거부 ({collection.full_name}): {errors[0].get('errmsg')}")
+                self._notify("written", failed)
+                self._notify("dropped")
+                turns = turns[failed + 1:]
+                continue
+            except PyMongoError as e:
+                if self._closing and time.monotonic() >= self._close_deadline:
+                    logging.error(f"종료 시간 안에 대화 기록 {len(turns)}턴을 저장하지 못함 ({collection.full_name}): {e}")
+                    self._notify("dropped", len(turns))
+                    return
+                logging.warning(f"대화 기록 저장 실패, {backoff:.1f}초 후 재시도 ({collection.full_name}, {len(turns)}턴): {e}")
+                self._notify("retry")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def flush(self, timeout=None):
+        """지금까지 넣은 턴이 모두 저장될 때까지 기다린다. 제한 시간 안에 끝나면 True."""
+        if self._pid != os.getpid():
+            return True
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending <= 0, timeout)
+
+    def close(self, timeout=10.0):
+        """
+        남은 턴을 저장하고 워커 스레드를 멈춘다 (프로세스 종료 시). 이후 append는 바로 저장한다.
+        연결이 계속 실패하면 timeout초 뒤에 포기하고 저장하지 못한 턴 수를 로그로 남긴다.
+        """
+        if self._pid != os.getpid() or self._closing:
+            return True
+        self._closing = True
+        self._close_deadline = time.monotonic() + timeout
+        flushed = self.flush(timeout)
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(max(self._close_deadline - time.monotonic(), 0))
+        if not flushed:
+            logging.error(f"대화 기록 {self._pending}턴을 저장하지 못하고 종료")
+        return flushed
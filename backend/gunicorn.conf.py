@@ -0,0 +1,70 @@
+#gunicorn.conf.py
+#운영 모드 pre-fork 서버 설정 (python chatbot_service.py --production 또는 gunicorn -c gunicorn.conf.py "chatbot_service:create_app()")
+#앱은 마스터에서 한 번 import하고(preload_app) 워커는 fork로 복사한다. MongoDB/OpenAI 클라이언트는 import 때 만들지 않으므로
+#워커마다 fork 후에 자기 클라이언트와 커넥션 풀을 만든다 (lazy_resources.py).
+#워커 수 × 스레드 수가 동시에 처리하는 요청 수, 워커 수 × MONGO_MAX_POOL_SIZE가 MongoDB 연결 수 상한이다.
+import logging
+import multiprocessing
+import os
+import time
+
+bind = os.environ.get("BIND", "0.0.0.0:5001")
+#기본은 코어 수만큼 워커. GPT 응답 대기는 I/O라 워커마다 스레드 여러 개로 동시에 기다린다
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+#요청이 워커 사이를 오가므로(sticky session 없음) 워커마다 둔 대화 이력 메모리 캐시는 금방 낡고,
+#낡은 이력이 GPT 맥락으로 쓰인 뒤 MongoDB에 덮어써진다. 워커가 여럿이면 캐시를 끄고 매 턴 MongoDB에서 읽는다.
+#(설정 파일은 preload로 앱을 import하기 전에 실행되므로 chatbot_service의 HISTORY_CACHE_SIZE에 반영된다)
+if workers > 1:
+    os.environ["HISTORY_CACHE_SIZE"] = "0"
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+#GPT 입장 제어(llm_admission.py)는 워커마다 따로 센다. 전체 한도(*_TOTAL)를 주면 워커 수로 나눠 워커별 한도로 쓰고,
+#없으면 동시 턴 한도를 스레드 수보다 작게 잡아 한도가 실제로 걸리고 고정 문항 요청이 쓸 스레드가 남게 한다.
+if os.environ.get("LLM_MAX_CONCURRENT_TOTAL"):
+    os.environ["LLM_MAX_CONCURRENT"] = str(max(int(os.environ["LLM_MAX_CONCURRENT_TOTAL"]) // workers, 1))
+else:
+    os.environ.setdefault("LLM_MAX_CONCURRENT", str(max(threads - 2, 1)))
+if os.environ.get("LLM_TOKENS_PER_MINUTE_TOTAL"):
+    os.environ["LLM_TOKENS_PER_MINUTE"] = str(max(int(os.environ["LLM_TOKENS_PER_MINUTE_TOTAL"]) // workers, 1))
+#워커 하트비트 제한 시간 (GPT 호출 LLM_DEADLINE보다 길게)
+timeout = int(os.environ.get("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", "5"))
+preload_app = True
+accesslog = os.environ.get("WEB_ACCESS_LOG")
+
+_master_started_at = time.perf_counter()
+
+
+def on_starting(server):
+    #인덱스는 워커마다가 아니라 마스터에서 한 번 만들고, 마스터가 쓴 클라이언트는 fork 전에 닫는다
+    import chatbot_service
+    from mongo_indexes import ensure_indexes
+
+    if os.environ.get("ENSURE_INDEXES", "1") != "0":
+        ensure_indexes(chatbot_service.mongo_client)
+    chatbot_service.mongo_client.close()
+
+
+def when_ready(server):
+    logging.info(f"마스터 준비 완료 ({time.perf_counter() - _master_started_at:.2f}초, 워커 {workers}개 × 스레드 {threads}개)")
+
+
+def post_worker_init(worker):
+    import chatbot_service
+
+    started_at = time.perf_counter()
+    try:
+        chatbot_service.warm_up()
+    except Exception:
+        #MongoDB/OpenAI 연결 실패는 요청 처리 중에 다시 시도되므로 워커는 그대로 띄운다
+        logging.exception("워커 준비 중 연결 실패")
+    logging.info(f"워커 {os.getpid()} 준비 완료 ({time.perf_counter() - started_at:.3f}초)")
+
+
+def worker_exit(server, worker):
+    #write-behind 큐에 남은 대화 기록을 저장하고 종료 (graceful_timeout 안에서)
+    import chatbot_service
+
+    if chatbot_service.dialog_writer is not None:
+        chatbot_service.dialog_writer.close(timeout=max(graceful_timeout - 5, 1))
@@ -0,0 +1,93 @@
+#lazy_resources.py
+#프로세스(PID)별로 처음 쓸 때 만드는 클라이언트 (pre-fork 다중 워커용)
+#pymongo MongoClient는 백그라운드 모니터 스레드와 커넥션 풀을 가지므로 fork 전에 만든 것을 자식 프로세스가 쓰면 안 되고,
+#import 시점에 만들면 서버 시작도 연결 설정만큼 느려진다. 그래서 import 때는 만들지 않고 처음 쓰는 순간 현재 프로세스에서 만든다.
+#fork된 워커는 PID가 다르므로 부모가 만든 객체를 버리고 자기 것을 새로 만든다.
+#  LazyResource("mongo", create_mongo_client)   # 클라이언트
+#  resource["phq9_chatbot"]["slots"]            # LazyHandle: 데이터베이스/컬렉션 핸들도 쓰는 시점에 해석
+#속성 접근은 실제 객체로 넘기므로 기존 코드는 그대로 collection.find_one(...)처럼 쓴다.
+import logging
+import os
+import threading
+import time
+
+
+class LazyHandle:
+    """parent[key]를 처음 쓸 때 해석하는 핸들. parent 객체가 바뀌면(새 프로세스, set) 다시 해석한다."""
+
+    def __init__(self, parent, key):
+        self._parent = parent
+        self._key = key
+        self._parent_value = None
+        self._value = None
+
+    def get(self):
+        parent_value = self._parent.get()
+        if parent_value is not self._parent_value:
+            self._value = parent_value[self._key]
+            self._parent_value = parent_value
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, key):
+        return LazyHandle(self, key)
+
+    def __repr__(self):
+        return f"LazyHandle({self._parent!r}[{self._key!r}])"
+
+
+class LazyResource:
+    """
+    name: 로그/지표에 쓰는 이름, factory: 인자 없이 객체를 만드는 함수
+    on_create: (name, 걸린 초)를 받는 콜백 (시작 시간 지표용)
+    """
+
+    def __init__(self, name, factory, on_create=None):
+        self.name = name
+        self.factory = factory
+        self.on_create = on_create
+        self._pid = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self):
+        return self._pid == os.getpid()
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    started_at = time.perf_counter()
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+                    elapsed = time.perf_counter() - started_at
+                    logging.info(f"{self.name} 클라이언트 생성 (pid {self._pid}, {elapsed:.3f}초)")
+                    if self.on_create is not None:
+                        self.on_create(self.name, elapsed)
+        return self._value
+
+    def set(self, value):
+        """factory 대신 이미 만든 객체를 쓴다 (테스트/벤치마크용 가짜 클라이언트 등)."""
+        with self._lock:
+            self._value = value
+            self._pid = os.getpid()
+
+    def close(self):
+        """이 프로세스에서 만든 객체를 닫고 버린다 (fork 전에 부모에서 쓴 클라이언트 정리용)."""
+        with self._lock:
+            value, self._value = self._value, None
+            created, self._pid = self._pid == os.getpid(), None
+        if created and hasattr(value, "close"):
+            value.close()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, key):
+        return LazyHandle(self, key)
+
+    def __repr__(self):
+        return f"LazyResource({self.name!r})"
@@ -0,0 +1,244 @@
+#llm_admission.py
+#GPT를 호출하는 대화 턴의 입장 제어(admission control)와 우선순위 스케줄링
+#- 동시에 GPT 호출 단계에 들어가는 턴 수를 max_concurrent로 제한한다 (턴 하나 = 응답 생성 + 슬롯 추출 호출).
+#- tokens_per_minute를 주면 토큰 버킷으로 분당 토큰 사용량을 제한한다. 입장할 때 추정 토큰을 빼 두고,
+#  턴이 끝나면 response.usage로 잰 실제 사용량과의 차이를 돌려주거나 더 뺀다.
+#- 자리가 없으면 우선순위 큐에서 기다린다. 우선순위가 같으면 먼저 온 순서. 위기 턴(PRIORITY_CRISIS)이 일반 턴보다 먼저 들어간다.
+#- 일반 턴은 대기열이 max_queue를 넘거나 max_wait초 안에 들어가지 못하면 AdmissionRejected (호출한 쪽은 503 + Retry-After).
+#  위기 턴은 대기열 길이와 상관없이 줄을 서고, crisis_max_wait초가 지나면 한도를 넘겨서라도 들어간다 (거절하지 않음).
+#GPT 재시도/서킷 브레이커는 llm_resilience.py, 이 모듈은 그 앞에서 몇 개의 턴을 동시에 보낼지만 정한다.
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import threading
+import time
+
+PRIORITY_CRISIS = 0
+PRIORITY_ROUTINE = 1
+PRIORITY_NAMES = {PRIORITY_CRISIS: "crisis", PRIORITY_ROUTINE: "routine"}
+
+#현재 요청이 받은 입장 티켓 (create_completion이 실제 토큰 사용량을 기록할 때 사용)
+current_ticket = contextvars.ContextVar("current_ticket", default=None)
+
+
+class AdmissionRejected(Exception):
+    """대기열이 가득 찼거나 대기 시간 안에 입장하지 못한 경우. retry_after: 다시 시도할 때까지 권장 대기(초)"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """분당 tokens_per_minute개씩 차오르는 토큰 버킷 (최대 1분치). 사용량 보정으로 음수(빚)가 될 수 있다."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, amount, now):
+        """amount개를 뺄 수 있을 때까지 남은 시간(초). 1분치보다 큰 요청은 버킷이 가득 차면 들여보낸다."""
+        self._refill(now)
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed, 0.0) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def adjust(self, amount):
+        """추정치와 실제 사용량의 차이를 반영한다 (양수면 돌려주고 음수면 더 뺀다)."""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionTicket:
+    """입장한 턴. with 블록이 끝나거나 release()하면 자리를 돌려준다."""
+
+    def __init__(self, controller, priority, estimated_tokens):
+        self.controller = controller
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = 0
+        self._released = False
+        self._context_token = None
+
+    def record_usage(self, tokens):
+        with self.controller._lock:
+            self.used_tokens += tokens
+
+    def release(self):
+        self.controller._release(self)
+
+    def __enter__(self):
+        self._context_token = current_ticket.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current_ticket.reset(self._context_token)
+        self.release()
+
+
+class AdmissionController:
+    """
+    max_concurrent: 동시에 GPT 호출 단계에 있을 수 있는 턴 수 (0이면 입장 제어 안 함)
+    tokens_per_minute: 분당 토큰 예산 (0이면 제한 안 함)
+    max_queue: 일반 턴 대기열 최대 길이, max_wait: 일반 턴 최대 대기 시간(초)
+    crisis_max_wait: 위기 턴이 이 시간(초)을 기다리면 한도를 넘겨 입장
+    on_event: (이벤트, 우선순위 이름) 콜백. admitted, rejected_queue_full, rejected_timeout, crisis_overflow
+    on_wait: (우선순위 이름, 대기 초) 콜백 (대기 시간 지표용)
+    poll_interval: aadmit이 자리가 났는지 다시 확인하는 간격(초)
+    """
+
+    def __init__(self, max_concurrent=6, tokens_per_minute=0, max_queue=200, max_wait=10.0,
+                 crisis_max_wait=30.0, on_event=None, on_wait=None, poll_interval=0.01):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.crisis_max_wait = crisis_max_wait
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.on_event = on_event
+        self.on_wait = on_wait
+        self.poll_interval = poll_interval
+        self.active = 0
+        self._waiting = []  # (우선순위, 도착 순번, 대기 항목) 힙
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    @property
+    def enabled(self):
+        return self.max_concurrent > 0
+
+    def queue_depths(self):
+        with self._lock:
+            depths = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _, _ in self._waiting:
+                depths[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            return depths
+
+    def tokens_available(self):
+        if self.bucket is None:
+            return None
+        with self._lock:
+            self.bucket._refill(time.monotonic())
+            return self.bucket.tokens
+
+    def _notify(self, event, priority):
+        if self.on_event is not None:
+            self.on_event(event, PRIORITY_NAMES.get(priority, str(priority)))
+
+    def _token_wait(self, estimated_tokens, now):
+        return self.bucket.wait_time(estimated_tokens, now) if self.bucket is not None else 0.0
+
+    def admit(self, priority=PRIORITY_ROUTINE, estimated_tokens=0):
+        """
+        자리가 날 때까지 기다렸다가 AdmissionTicket을 돌려준다 (with 문으로 사용).
+        일반 턴이 대기열 초과/대기 시간 초과면 AdmissionRejected.
+        """
+        ticket = AdmissionTicket(self, priority, estimated_tokens)
+        if not self.enabled:
+            return ticket
+        started_at = time.monotonic()
+        with self._changed:
+            entry = self._enqueue(ticket)
+            try:
+                #토큰이 모자라면 차오를 때까지, 아니면 다른 턴이 끝나거나 대기열이 바뀔 때까지 기다린다
+                while (wait := self._wait_time(entry, started_at)) is not None:
+                    self._changed.wait(wait)
+            except BaseException:
+                self._remove(entry)
+                raise
+            self._enter(entry)
+        return self._admitted(ticket, started_at)
+
+    async def aadmit(self, priority=PRIORITY_ROUTINE, estimated_tokens=0):
+        """
+        admit의 비동기 버전 (비동기 서빙 모드용). 같은 대기열과 한도를 쓴다.
+        이벤트 루프를 막지 않도록 잠금은 확인할 때만 잡고, 자리가 날 때까지 poll_interval초마다 다시 확인한다.
+        """
+        ticket = AdmissionTicket(self, priority, estimated_tokens)
+        if not self.enabled:
+            return ticket
+        started_at = time.monotonic()
+        with self._lock:
+            entry = self._enqueue(ticket)
+        try:
+            while True:
+                with self._lock:
+                    wait = self._wait_time(entry, started_at)
+                    if wait is None:
+                        self._enter(entry)
+                        break
+                await asyncio.sleep(min(wait, self.poll_interval))
+        except BaseException:
+            with self._lock:
+                self._remove(entry)
+            raise
+        return self._admitted(ticket, started_at)
+
+    def _enqueue(self, ticket):
+        #잠금을 잡은 상태에서 호출
+        if ticket.priority != PRIORITY_CRISIS and len(self._waiting) >= self.max_queue:
+            self._notify("rejected_queue_full", ticket.priority)
+            raise AdmissionRejected("대기열 가득 참", self._retry_after(ticket.estimated_tokens))
+        entry = (ticket.priority, next(self._sequence), ticket)
+        heapq.heappush(self._waiting, entry)
+        return entry
+
+    def _wait_time(self, entry, started_at):
+        """잠금을 잡은 상태에서 호출. 들어갈 수 있으면 None, 아니면 더 기다릴 시간(초). 대기 시간 초과면 AdmissionRejected."""
+        priority, _, ticket = entry
+        crisis = priority == PRIORITY_CRISIS
+        deadline = started_at + (self.crisis_max_wait if crisis else self.max_wait)
+        now = time.monotonic()
+        token_wait = self._token_wait(ticket.estimated_tokens, now)
+        if self._waiting[0] is entry and self.active < self.max_concurrent and token_wait == 0:
+            return None
+        if now >= deadline:
+            if crisis:
+                self._notify("crisis_overflow", priority)
+                return None
+            self._notify("rejected_timeout", priority)
+            raise AdmissionRejected("대기 시간 초과", self._retry_after(ticket.estimated_tokens))
+        return min(deadline - now, token_wait) if token_wait else deadline - now
+
+    def _enter(self, entry):
+        #잠금을 잡은 상태에서 호출
+        self._remove(entry)
+        self.active += 1
+        if self.bucket is not None:
+            self.bucket.take(entry[2].estimated_tokens)
+
+    def _admitted(self, ticket, started_at):
+        self._notify("admitted", ticket.priority)
+        if self.on_wait is not None:
+            self.on_wait(PRIORITY_NAMES.get(ticket.priority, str(ticket.priority)), time.monotonic() - started_at)
+        return ticket
+
+    def _remove(self, entry):
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        #맨 앞이 바뀌었을 수 있으므로 기다리는 턴들을 깨운다
+        self._changed.notify_all()
+
+    def _retry_after(self, estimated_tokens):
+        token_wait = self._token_wait(estimated_tokens, time.monotonic())
+        return max(1, math.ceil(token_wait))
+
+    def _release(self, ticket):
+        with self._changed:
+            if ticket._released or not self.enabled:
+                return
+            ticket._released = True
+            self.active -= 1
+            if self.bucket is not None and ticket.used_tokens:
+                self.bucket.adjust(ticket.estimated_tokens - ticket.used_tokens)
+            self._changed.notify_all()
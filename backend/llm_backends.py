@@ -0,0 +1,224 @@
+#llm_backends.py
+#GPT 호출을 보낼 LLM 백엔드와 엔드포인트/단계별 선택
+#모든 백엔드는 create(**kwargs)/acreate(**kwargs)로 OpenAI chat.completions 형식의 요청을 받아
+#ChatCompletion(스트리밍이면 ChatCompletionChunk 반복자)을 돌려준다. 그래서 캐시/지표/파서는 백엔드를 몰라도 된다.
+#- OpenAIBackend: ResilientCompletions(제한 시간/재시도/헤징/서킷 브레이커)를 거쳐 OpenAI API 호출
+#- LocalSeq2SeqBackend: transformers 모델을 서버 시작 시 CPU에 올려 두고, 동시에 들어온 요청을 묶어서 생성
+#  (pip install transformers torch sentencepiece 필요. tools(함수 호출)는 지원하지 않고, response_format은 무시한다)
+#라우팅 예시: LLM_BACKEND_ROUTES="slot_extraction=local,phq9_high_c_low_u.reply=local"
+#  키는 "엔드포인트.단계", "단계", "엔드포인트" 순으로 찾고, 없으면 기본 백엔드를 쓴다.
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from llm_resilience import LLMUnavailableError
+
+
+class OpenAIBackend:
+    name = "openai"
+    supports_tools = True
+    model = None  #요청의 model을 그대로 쓴다
+
+    def __init__(self, completions):
+        self.completions = completions  #ResilientCompletions
+
+    def create(self, **kwargs):
+        return self.completions.create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        return await self.completions.acreate(**kwargs)
+
+
+def render_prompt(messages):
+    """chat 템플릿이 없는 seq2seq 모델용: 메시지를 역할 표시와 함께 한 문자열로 잇는다."""
+    return "\n\n".join(f"[{m['role']}]\n{m.get('content') or ''}" for m in messages)
+
+
+class LocalSeq2SeqBackend:
+    """
+    model_name: Hugging Face 모델 이름 또는 로컬 경로 (예: google/flan-t5-base)
+    kind: seq2seq(AutoModelForSeq2SeqLM) 또는 causal(AutoModelForCausalLM, chat 템플릿 사용)
+    max_batch_size/batch_wait_ms: 첫 요청이 들어온 뒤 batch_wait_ms 동안 최대 max_batch_size개까지 모아서 한 번에 생성
+    timeout: 요청 하나가 큐 대기 + 생성에 쓸 수 있는 최대 시간(초), 넘으면 LLMUnavailableError
+    """
+    name = "local"
+    supports_tools = False
+
+    def __init__(self, model_name, kind="seq2seq", max_batch_size=8, batch_wait_ms=10, max_input_tokens=1024,
+                 timeout=20.0, num_threads=None, model=None, tokenizer=None):
+        self.model = model_name  #요청의 model 대신 쓰는 이름 (캐시 키/응답의 model)
+        self.kind = kind
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_input_tokens = max_input_tokens
+        self.timeout = timeout
+        self._model = model
+        self._tokenizer = tokenizer
+        if self._model is None:
+            self._load(num_threads)
+        #배치 스레드는 프로세스마다 처음 요청할 때 시작한다 (pre-fork 워커는 fork 전 스레드를 물려받지 못함)
+        self._queue = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker_pid != os.getpid():
+            with self._worker_lock:
+                if self._worker_pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,), name="local-llm-batcher", daemon=True).start()
+                    self._worker_pid = os.getpid()
+        return self._queue
+
+    def _load(self, num_threads):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer
+
+        started_at = time.perf_counter()
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self._tokenizer = AutoTokenizer.from_pretrained(self.model)
+        model_cls = AutoModelForSeq2SeqLM if self.kind == "seq2seq" else AutoModelForCausalLM
+        self._model = model_cls.from_pretrained(self.model).eval()
+        if self.kind == "causal":
+            #배치 생성 시 왼쪽 패딩이어야 프롬프트 뒤에 바로 이어서 생성된다
+            self._tokenizer.padding_side = "left"
+            if self._tokenizer.pad_token is None:
+                self._tokenizer.pad_token = self._tokenizer.eos_token
+        logging.info(f"로컬 LLM 로드 완료: {self.model} ({self.kind}, {time.perf_counter() - started_at:.1f}초)")
+
+    def _prompt(self, messages):
+        if self.kind == "causal" and getattr(self._tokenizer, "chat_template", None):
+            return self._tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return render_prompt(messages)
+
+    def _run(self, jobs):
+        while True:
+            batch = [jobs.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batch = [job for job in batch if job[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._generate([prompt for prompt, _, _ in batch], max(n for _, n, _ in batch))
+            except Exception as e:
+                logging.exception("로컬 LLM 생성 실패")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _generate(self, prompts, max_new_tokens):
+        """프롬프트 리스트를 한 번에 생성하고 [(텍스트, 입력 토큰 수, 출력 토큰 수)]를 반환한다."""
+        import torch
+
+        inputs = self._tokenizer(prompts, return_tensors="pt", padding=True, truncation=True,
+                                 max_length=self.max_input_tokens)
+        with torch.inference_mode():
+            outputs = self._model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        if self.kind == "causal":
+            outputs = outputs[:, inputs["input_ids"].shape[1]:]
+        texts = self._tokenizer.batch_decode(outputs, skip_special_tokens=True)
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        pad_id = self._tokenizer.pad_token_id
+        completion_tokens = [int((row != pad_id).sum()) for row in outputs]
+        return [(text.strip(), int(p), c) for text, p, c in zip(texts, prompt_tokens, completion_tokens)]
+
+    def submit(self, kwargs):
+        if kwargs.get("tools"):
+            raise ValueError("로컬 백엔드는 tools(함수 호출)를 지원하지 않습니다")
+        future = Future()
+        self._ensure_worker().put((self._prompt(kwargs["messages"]), kwargs.get("max_tokens") or 256, future))
+        return future
+
+    def _completion(self, kwargs, result):
+        text, prompt_tokens, completion_tokens = result
+        return ChatCompletion.model_validate({
+            "id": f"local-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _stream(self, completion):
+        #토큰 단위 스트리밍은 하지 않고 완성된 응답을 청크 하나로 보낸다
+        yield ChatCompletionChunk.model_validate({
+            "id": completion.id,
+            "object": "chat.completion.chunk",
+            "created": completion.created,
+            "model": completion.model,
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": completion.choices[0].message.content},
+                         "finish_reason": "stop"}],
+        })
+
+    def create(self, **kwargs):
+        future = self.submit(kwargs)
+        try:
+            result = future.result(timeout=self.timeout)
+        except Exception as e:
+            future.cancel()
+            raise LLMUnavailableError(f"로컬 LLM 생성 실패: {e!r}") from e
+        completion = self._completion(kwargs, result)
+        return self._stream(completion) if kwargs.get("stream") else completion
+
+    async def acreate(self, **kwargs):
+        future = self.submit(kwargs)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except Exception as e:
+            future.cancel()
+            raise LLMUnavailableError(f"로컬 LLM 생성 실패: {e!r}") from e
+        completion = self._completion(kwargs, result)
+        return self._stream(completion) if kwargs.get("stream") else completion
+
+
+def parse_backend_routes(text):
+    """"slot_extraction=local,chat.reply=openai" → {"slot_extraction": "local", "chat.reply": "openai"}"""
+    routes = {}
+    for part in text.split(","):
+        if "=" in part:
+            key, backend = part.split("=", 1)
+            routes[key.strip()] = backend.strip()
+    return routes
+
+
+class BackendRouter:
+    """
+    backends: {"openai": OpenAIBackend, "local": LocalSeq2SeqBackend, ...}
+    routes: parse_backend_routes 결과, default: 기본 백엔드 이름
+    """
+
+    def __init__(self, backends, routes=None, default="openai"):
+        self.backends = backends
+        self.routes = routes or {}
+        self.default = default
+        for key, name in self.routes.items():
+            if name not in backends:
+                raise ValueError(f"LLM 백엔드 '{name}'이(가) 없습니다 (라우트 {key})")
+
+    def select(self, endpoint, stage, kwargs):
+        name = self.routes.get(f"{endpoint}.{stage}") or self.routes.get(stage) or self.routes.get(endpoint) or self.default
+        backend = self.backends[name]
+        if kwargs.get("tools") and not backend.supports_tools:
+            #combined 모드처럼 함수 호출이 필요한 요청은 지원하는 백엔드로 보낸다
+            backend = next(b for b in self.backends.values() if b.supports_tools)
+        return backend
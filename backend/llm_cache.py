@@ -0,0 +1,166 @@
+#llm_cache.py
+#temperature=0 GPT 호출 결과 캐시
+#모델 + 메시지 + 파라미터를 해시한 키로 응답을 저장한다.
+#프로세스 내 LRU(+TTL)를 먼저 보고, 없으면 선택적으로 공유 백엔드(MongoDB)를 본다.
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from openai.types.chat import ChatCompletion
+
+
+def now_utc():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def completion_cache_key(kwargs):
+    payload = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(kwargs):
+    """결정적인 호출(temperature 0, 스트리밍 아님)만 캐시한다."""
+    return kwargs.get("temperature", 1.0) == 0 and not kwargs.get("stream") and kwargs.get("n", 1) == 1
+
+
+class MongoCacheBackend:
+    """
+    여러 워커/서버가 공유하는 캐시 백엔드. created_at TTL 인덱스로 만료된 항목을 MongoDB가 지운다.
+    """
+
+    def __init__(self, collection, ttl_seconds):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self._index_ready = False
+
+    def _ensure_index(self):
+        #서버 시작(import) 시점에 MongoDB에 연결하지 않도록 처음 쓸 때 인덱스를 만든다
+        if not self._index_ready:
+            self.collection.create_index("created_at", expireAfterSeconds=int(self.ttl_seconds))
+            self._index_ready = True
+
+    def get(self, key):
+        self._ensure_index()
+        doc = self.collection.find_one({"_id": key}, {"response": 1, "created_at": 1})
+        if not doc:
+            return None
+        #TTL 인덱스 삭제는 최대 1분 정도 늦을 수 있으므로 직접 한 번 더 확인
+        created_at = doc["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+        if (now_utc() - created_at).total_seconds() > self.ttl_seconds:
+            return None
+        return ChatCompletion.model_validate(doc["response"])
+
+    def set(self, key, response):
+        self.collection.replace_one(
+            {"_id": key},
+            {"_id": key, "response": response.model_dump(mode="json"), "created_at": now_utc()},
+            upsert=True,
+        )
+
+
+class CompletionCache:
+    def __init__(self, max_entries=1024, ttl_seconds=600, backend=None, on_event=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self.on_event = on_event  #조회 결과("hit", "shared_hit", "miss")를 받는 콜백 (지표 기록용)
+        self._entries = OrderedDict()  # key -> (만료 시각, 응답)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self._notify("hit")
+                    return response
+                del self._entries[key]
+
+        if self.backend is not None:
+            try:
+                response = self.backend.get(key)
+            except Exception as e:
+                logging.warning(f"공유 캐시 조회 실패: {e}")
+                response = None
+            if response is not None:
+                self._store(key, response)
+                with self._lock:
+                    self.shared_hits += 1
+                self._notify("shared_hit")
+                return response
+
+        with self._lock:
+            self.misses += 1
+        self._notify("miss")
+        return None
+
+    def _notify(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def set(self, key, response):
+        self._store(key, response)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, response)
+            except Exception as e:
+                logging.warning(f"공유 캐시 저장 실패: {e}")
+
+    def _store(self, key, response):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+    def cached_create(self, create_fn, **kwargs):
+        """
+        create_fn(**kwargs)(= client.chat.completions.create)를 캐시로 감싼다.
+        캐시 대상이 아닌 호출은 그대로 전달한다.
+        """
+        if not is_cacheable(kwargs):
+            return create_fn(**kwargs)
+        key = completion_cache_key(kwargs)
+        response = self.get(key)
+        if response is not None:
+            return response
+        response = create_fn(**kwargs)
+        self.set(key, response)
+        return response
+
+    async def acached_create(self, create_fn, **kwargs):
+        """cached_create의 비동기 버전 (비동기 서빙 모드용)"""
+        if not is_cacheable(kwargs):
+            return await create_fn(**kwargs)
+        key = completion_cache_key(kwargs)
+        response = self.get(key)
+        if response is not None:
+            return response
+        response = await create_fn(**kwargs)
+        self.set(key, response)
+        return response
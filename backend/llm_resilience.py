@@ -0,0 +1,215 @@
+#llm_resilience.py
+#OpenAI 호출 제한 시간/재시도/헤징/서킷 브레이커
+#- 시도마다 제한 시간(timeout)을 두고, 재시도를 포함한 전체 호출은 deadline 안에서 끝낸다.
+#- 일시적인 오류(타임아웃, 연결 오류, 429, 5xx)만 지터를 섞은 지수 백오프로 최대 max_retries번 재시도한다.
+#- hedge_after초 안에 응답이 없으면 같은 요청을 하나 더 보내고 먼저 온 응답을 쓴다 (스트리밍 호출은 제외).
+#- 연속 실패가 failure_threshold번이면 reset_seconds 동안 호출하지 않고 바로 LLMUnavailableError를 낸다.
+#  이후 한 번의 시험 호출이 성공하면 다시 닫힌다.
+#호출한 쪽은 LLMUnavailableError를 받으면 고정 질문 같은 대체 응답을 보낸다.
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+#재시도할 오류 (APITimeoutError는 APIConnectionError의 하위 클래스)
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class LLMUnavailableError(Exception):
+    """재시도/제한 시간 안에 응답을 받지 못했거나 서킷 브레이커가 열려 있는 경우"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """호출해도 되면 True. 열린 뒤 reset_seconds가 지나면 시험 호출 하나만 허용한다."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_seconds:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        """재시도 대상이 아닌 오류(400 등)로 끝난 시험 호출은 성공/실패로 치지 않고 다음 시험 호출을 허용한다."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        """실패를 기록하고, 이번 실패로 브레이커가 열렸으면 True"""
+        with self._lock:
+            self._failures += 1
+            reopened = self._probing
+            self._probing = False
+            if reopened or (self._opened_at is None and 0 < self.failure_threshold <= self._failures):
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class ResilientCompletions:
+    """
+    create_fn: client.chat.completions.create (AsyncOpenAI면 acreate 사용)
+    timeout: 시도 1번의 제한 시간(초), deadline: 재시도를 포함한 전체 제한 시간(초)
+    hedge_after: 이 시간(초) 안에 응답이 없으면 같은 요청을 하나 더 보냄 (0이면 헤징 안 함)
+    on_event: "retry", "timeout", "hedge", "hedge_won", "circuit_open", "rejected" 이벤트를 받는 콜백 (지표 기록용)
+    """
+
+    def __init__(self, create_fn, timeout=20.0, deadline=30.0, max_retries=2, backoff_base=0.5, backoff_max=4.0,
+                 hedge_after=0.0, breaker=None, on_event=None, hedge_workers=16):
+        self.create_fn = create_fn
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.on_event = on_event
+        #헤징 요청은 llm_executor와 다른 풀에서 보낸다 (llm_executor 안에서 호출될 때 풀이 막히지 않도록)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers) if hedge_after > 0 else None
+
+    def _notify(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def _backoff(self, attempt):
+        #full jitter: 0 ~ min(backoff_max, backoff_base * 2^attempt)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _before_call(self):
+        if not self.breaker.allow():
+            self._notify("rejected")
+            raise LLMUnavailableError("서킷 브레이커 열림")
+
+    def _on_failure(self, error):
+        if self.breaker.record_failure():
+            logging.warning(f"GPT 호출 연속 실패로 서킷 브레이커 열림 ({self.breaker.reset_seconds}초)")
+            self._notify("circuit_open")
+        raise LLMUnavailableError(f"GPT 호출 실패: {error}") from error
+
+    def _hedged(self, kwargs, timeout):
+        first = self._hedge_executor.submit(self.create_fn, **kwargs, timeout=timeout)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+        self._notify("hedge")
+        second = self._hedge_executor.submit(self.create_fn, **kwargs, timeout=max(timeout - self.hedge_after, 0.1))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._notify("hedge_won")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def create(self, **kwargs):
+        self._before_call()
+        started_at = time.monotonic()
+        hedge = self._hedge_executor is not None and not kwargs.get("stream")
+        attempt = 0
+        while True:
+            remaining = self.deadline - (time.monotonic() - started_at)
+            timeout = min(self.timeout, remaining)
+            try:
+                if hedge:
+                    response = self._hedged(kwargs, timeout)
+                else:
+                    response = self.create_fn(**kwargs, timeout=timeout)
+                self.breaker.record_success()
+                return response
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, openai.APITimeoutError):
+                    self._notify("timeout")
+                delay = self._backoff(attempt)
+                attempt += 1
+                if attempt > self.max_retries or time.monotonic() - started_at + delay >= self.deadline:
+                    self._on_failure(e)
+                logging.info(f"GPT 호출 재시도 {attempt}/{self.max_retries} ({delay:.2f}초 후): {e}")
+                self._notify("retry")
+                time.sleep(delay)
+            except Exception:
+                self.breaker.release()
+                raise
+
+    async def _ahedged(self, kwargs, timeout):
+        first = asyncio.ensure_future(self.create_fn(**kwargs, timeout=timeout))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        self._notify("hedge")
+        second = asyncio.ensure_future(self.create_fn(**kwargs, timeout=max(timeout - self.hedge_after, 0.1)))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._notify("hedge_won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def acreate(self, **kwargs):
+        """create의 비동기 버전 (create_fn은 AsyncOpenAI의 create)"""
+        self._before_call()
+        started_at = time.monotonic()
+        hedge = self.hedge_after > 0 and not kwargs.get("stream")
+        attempt = 0
+        while True:
+            remaining = self.deadline - (time.monotonic() - started_at)
+            timeout = min(self.timeout, remaining)
+            try:
+                if hedge:
+                    response = await self._ahedged(kwargs, timeout)
+                else:
+                    response = await self.create_fn(**kwargs, timeout=timeout)
+                self.breaker.record_success()
+                return response
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, openai.APITimeoutError):
+                    self._notify("timeout")
+                delay = self._backoff(attempt)
+                attempt += 1
+                if attempt > self.max_retries or time.monotonic() - started_at + delay >= self.deadline:
+                    self._on_failure(e)
+                logging.info(f"GPT 호출 재시도 {attempt}/{self.max_retries} ({delay:.2f}초 후): {e}")
+                self._notify("retry")
+                await asyncio.sleep(delay)
+            except Exception:
+                self.breaker.release()
+                raise
@@ -0,0 +1,282 @@
+#metrics.py
+#단계별 지연/토큰/캐시/오류 지표 수집 및 Prometheus 텍스트 형식 출력 (/metrics)
+#엔드포인트 라벨은 요청 시작 시 contextvar에 넣고, 같은 요청 안의 GPT 호출/MongoDB 명령이 그 라벨로 기록된다.
+#llm_executor 등 다른 스레드로 넘길 때는 contextvars.copy_context().run으로 감싸야 라벨이 따라간다.
+#프로세스별 값이므로 워커를 여러 개 띄우면 워커마다 따로 수집된다.
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#현재 요청의 엔드포인트 라벨과 요청별 단계 시간 합계(Server-Timing 헤더용)
+current_endpoint = contextvars.ContextVar("current_endpoint", default="none")
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def total(self, **labels):
+        """주어진 라벨 값과 맞는 시계열의 합 (라벨을 생략하면 전체 합)"""
+        with self._lock:
+            return sum(value for label_values, value in self._values.items()
+                       if all(label_values[self.labels.index(k)] == v for k, v in labels.items()))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label 값 → [버킷별 개수, 합계, 개수]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    le_labels = _label_text(self.labels + ("le",), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{le_labels} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_label_text(self.labels + ('le',), label_values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, label_values)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  #출력 시점에 값을 만드는 함수 (예: 캐시 통계)
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            lines.extend(collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.add(Histogram(
+    "chatbot_http_request_duration_seconds", "요청 처리 시간", ("endpoint", "status")))
+llm_request_duration = registry.add(Histogram(
+    "chatbot_llm_request_duration_seconds", "GPT 호출 시간 (캐시 적중 포함)", ("endpoint", "stage")))
+llm_tokens = registry.add(Counter(
+    "chatbot_llm_tokens_total", "GPT 사용 토큰 수 (response.usage)", ("endpoint", "stage", "kind")))
+llm_errors = registry.add(Counter(
+    "chatbot_llm_errors_total", "GPT 호출 오류 수", ("endpoint", "stage")))
+llm_cache_events = registry.add(Counter(
+    "chatbot_llm_cache_events_total", "GPT 응답 캐시 조회 결과 (hit, shared_hit, miss)", ("endpoint", "event")))
+mongo_command_duration = registry.add(Histogram(
+    "chatbot_mongo_command_duration_seconds", "MongoDB 명령 시간", ("endpoint", "collection", "command")))
+mongo_command_errors = registry.add(Counter(
+    "chatbot_mongo_command_errors_total", "MongoDB 명령 오류 수", ("endpoint", "collection", "command")))
+llm_resilience_events = registry.add(Counter(
+    "chatbot_llm_resilience_events_total",
+    "GPT 호출 재시도/타임아웃/헤징/서킷 브레이커/고정 질문 대체 횟수", ("endpoint", "event")))
+slot_updates_rejected = registry.add(Counter(
+    "chatbot_slot_updates_rejected_total", "슬롯 추출 응답에서 검증에 실패해 버린 항목 수", ("endpoint", "reason")))
+slot_write_conflicts = registry.add(Counter(
+    "chatbot_slot_write_conflicts_total",
+    "슬롯 문서 저장 버전 충돌 수 (retry: 다시 합쳐 재시도, overwrite: 재시도 후 버전 확인 없이 저장)", ("endpoint", "event")))
+dialog_writer_events = registry.add(Counter(
+    "chatbot_dialog_writer_events_total",
+    "대화 기록 write-behind 턴 수 (queued, written, sync_write, dropped)와 배치 재시도(retry), write concern 오류(write_concern_error) 횟수", ("event",)))
+llm_admission_events = registry.add(Counter(
+    "chatbot_llm_admission_events_total",
+    "GPT 호출 입장 제어 결과 (admitted, rejected_queue_full, rejected_timeout, crisis_overflow)", ("endpoint", "priority", "event")))
+llm_admission_wait = registry.add(Histogram(
+    "chatbot_llm_admission_wait_seconds", "GPT 호출 입장 대기 시간", ("endpoint", "priority")))
+stage_duration = registry.add(Histogram(
+    "chatbot_stage_duration_seconds", "요청 내 처리 단계 시간 (요약 생성 등)", ("endpoint", "stage")))
+
+
+#프로세스 시작 단계별 시간(초): import, 클라이언트 생성(mongo, openai), 워커 준비(warm_up)
+startup_timings = {}
+
+
+def record_startup(phase, seconds):
+    startup_timings[phase] = seconds
+
+
+def startup_metrics():
+    lines = ["# HELP chatbot_startup_seconds 이 프로세스의 시작 단계별 시간", "# TYPE chatbot_startup_seconds gauge"]
+    for phase, seconds in sorted(startup_timings.items()):
+        lines.append(f'chatbot_startup_seconds{{phase="{phase}"}} {seconds:.6f}')
+    return lines
+
+
+registry.collectors.append(startup_metrics)
+
+
+def add_timing(name, seconds):
+    timings = current_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def start_request(endpoint):
+    """요청 시작 시 호출. 반환값은 finish_request에 넘긴다."""
+    current_endpoint.set(endpoint)
+    current_timings.set({})
+    return time.perf_counter()
+
+
+def finish_request(started_at, status):
+    """요청 종료 시 호출. Server-Timing 헤더 값을 반환한다."""
+    elapsed = time.perf_counter() - started_at
+    endpoint = current_endpoint.get()
+    http_request_duration.observe(elapsed, endpoint, str(status))
+    timings = current_timings.get() or {}
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in sorted(timings.items())]
+    parts.append(f"total;dur={elapsed * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def record_llm_call(stage, elapsed, response=None, error=False):
+    endpoint = current_endpoint.get()
+    llm_request_duration.observe(elapsed, endpoint, stage)
+    add_timing(f"llm_{stage}", elapsed)
+    if error:
+        llm_errors.inc(endpoint, stage)
+        return
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    llm_tokens.inc(endpoint, stage, "prompt", amount=usage.prompt_tokens or 0)
+    llm_tokens.inc(endpoint, stage, "completion", amount=usage.completion_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    if cached:
+        llm_tokens.inc(endpoint, stage, "cached_prompt", amount=cached)
+
+
+def record_cache_event(event):
+    llm_cache_events.inc(current_endpoint.get(), event)
+
+
+def record_resilience_event(event):
+    llm_resilience_events.inc(current_endpoint.get(), event)
+
+
+def record_slot_rejection(reason):
+    slot_updates_rejected.inc(current_endpoint.get(), reason)
+
+
+def record_slot_conflict(event):
+    slot_write_conflicts.inc(current_endpoint.get(), event)
+
+
+def record_admission_event(event, priority):
+    llm_admission_events.inc(current_endpoint.get(), priority, event)
+
+
+def record_admission_wait(priority, seconds):
+    llm_admission_wait.observe(seconds, current_endpoint.get(), priority)
+
+
+def record_dialog_writer_event(event, count=1):
+    #백그라운드 스레드에서도 기록하므로 엔드포인트 라벨 없음
+    dialog_writer_events.inc(event, amount=count)
+
+
+@contextmanager
+def timed_stage(stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stage_duration.observe(elapsed, current_endpoint.get(), stage)
+        add_timing(stage, elapsed)
+
+
+def timed(stage):
+    """함수 실행 시간을 stage 단계로 기록하는 데코레이터"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """MongoClient(event_listeners=[...])로 등록. 명령을 보낸 스레드에서 호출되므로 엔드포인트 라벨을 그대로 쓴다."""
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._collections[(event.request_id, event.connection_id)] = (event.database_name, collection)
+
+    def _finish(self, event):
+        with self._lock:
+            database, collection = self._collections.pop((event.request_id, event.connection_id), ("", ""))
+        return f"{database}.{collection}" if collection else database
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        elapsed = event.duration_micros / 1e6
+        mongo_command_duration.observe(elapsed, current_endpoint.get(), collection, event.command_name)
+        add_timing("mongo", elapsed)
+
+    def failed(self, event):
+        collection = self._finish(event)
+        mongo_command_errors.inc(current_endpoint.get(), collection, event.command_name)
@@ -0,0 +1,196 @@
+#mongo_indexes.py
+#챗봇 컬렉션에 필요한 인덱스 선언/생성 및 쿼리 플랜(IXSCAN) 확인
+#서버 시작 시 ensure_indexes()로 인덱스를 만들고(이미 있으면 그대로 둠),
+#verify_query_plans()로 각 엔드포인트의 조회가 인덱스를 타는지 explain()으로 확인한다.
+#실행 예시:
+#  python mongo_indexes.py            # 인덱스 생성
+#  python mongo_indexes.py --verify   # 인덱스 생성 후 쿼리 플랜 확인 (COLLSCAN이 있으면 종료 코드 1)
+import datetime
+import logging
+import os
+import sys
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+
+#(데이터베이스, 컬렉션) → 필요한 인덱스
+REQUIRED_INDEXES = {
+    ("phq9_chatbot", "slots"): [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("last_updated", ASCENDING)], name="last_updated"),
+        IndexModel([("completed_at", DESCENDING)], name="completed_at"),
+    ],
+    ("phq9_chatbot", "session_history"): [
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+    ("phq9_chatbot", "edited_answers"): [
+        IndexModel([("user_id", ASCENDING), ("saved_at", DESCENDING)], name="user_id_saved_at"),
+        IndexModel([("saved_at", ASCENDING)], name="saved_at"),
+    ],
+    ("phq9_fixed_db", "slots"): [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("last_updated", ASCENDING)], name="last_updated"),
+        IndexModel([("completed_at", DESCENDING)], name="completed_at"),
+    ],
+    ("phq9_fixed_db", "phq9_fixed_dialog"): [
+        #버킷 문서(dialog_store.py): 사용자당 여러 문서. 최신 버킷 조회 / 열린 버킷 추가용
+        IndexModel([("user", ASCENDING), ("first_ts", DESCENDING)], name="user_first_ts"),
+        IndexModel([("user", ASCENDING), ("count", ASCENDING)], name="user_open_bucket"),
+        IndexModel([("last_stored_at", ASCENDING)], name="last_stored_at"),
+        IndexModel([("last_ts", ASCENDING)], name="last_ts"),
+    ],
+    ("phq9_fixed_db", "session_history"): [
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+    ("phq9_fixed_editable", "slots"): [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("last_updated", ASCENDING)], name="last_updated"),
+        IndexModel([("completed_at", DESCENDING)], name="completed_at"),
+    ],
+    ("phq9_fixed_editable", "dialog"): [
+        IndexModel([("user", ASCENDING), ("first_ts", DESCENDING)], name="user_first_ts"),
+        IndexModel([("user", ASCENDING), ("count", ASCENDING)], name="user_open_bucket"),
+        IndexModel([("last_stored_at", ASCENDING)], name="last_stored_at"),
+        IndexModel([("last_ts", ASCENDING)], name="last_ts"),
+    ],
+    ("phq9_fixed_editable", "session_history"): [
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+    ("phq9_high_c_low_u", "slots"): [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+        IndexModel([("last_updated", ASCENDING)], name="last_updated"),
+        IndexModel([("completed_at", DESCENDING)], name="completed_at"),
+    ],
+    ("phq9_high_c_low_u", "session_history"): [
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+}
+
+#워터마크 필드 인덱스(last_updated, updated_at, saved_at, last_stored_at)는 study_export.py의 증분 내보내기용
+#slots의 completed_at 인덱스는 cohort_analytics.py의 캐시 지문(마지막 완료 시각) 조회용
+
+#더 이상 맞지 않는 인덱스 (있으면 삭제)
+#phq9_fixed_dialog는 버킷 문서로 바뀌면서 사용자당 문서가 여러 개가 되므로 user unique 인덱스를 지운다.
+OBSOLETE_INDEXES = {
+    ("phq9_fixed_db", "phq9_fixed_dialog"): ["user_unique"],
+}
+
+#엔드포인트별 핫패스 조회 (explain 확인용 예시 값)
+ENDPOINT_QUERIES = {
+    "chat": [
+        (("phq9_chatbot", "slots"), {"user_id": "__explain__"}, None),
+    ],
+    "phq9_high_c_low_u": [
+        (("phq9_high_c_low_u", "slots"), {"user_id": "__explain__"}, None),
+    ],
+    "phq9_fixed": [
+        (("phq9_fixed_db", "slots"), {"user_id": "__explain__"}, None),
+        (("phq9_fixed_db", "phq9_fixed_dialog"), {"user": "__explain__"}, [("first_ts", DESCENDING)]),
+    ],
+    "phq9_fixed_editable": [
+        (("phq9_fixed_editable", "slots"), {"user_id": "__explain__"}, None),
+        (("phq9_fixed_editable", "dialog"), {"user": "__explain__"}, [("first_ts", DESCENDING)]),
+    ],
+    "summary_edit": [
+        (("phq9_chatbot", "edited_answers"), {"user_id": "__explain__"}, [("saved_at", DESCENDING)]),
+    ],
+}
+#증분 내보내기 조회 (study_export.export_query와 같은 워터마크 조건)
+EXPORT_WATERMARK = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+ENDPOINT_QUERIES["export"] = [
+    ((db_name, coll_name), {field: {"$gt": EXPORT_WATERMARK}}, None)
+    for db_name, coll_name, field in [
+        ("phq9_chatbot", "slots", "last_updated"),
+        ("phq9_chatbot", "session_history", "updated_at"),
+        ("phq9_chatbot", "edited_answers", "saved_at"),
+        ("phq9_fixed_db", "slots", "last_updated"),
+        ("phq9_fixed_db", "phq9_fixed_dialog", "last_stored_at"),
+        ("phq9_fixed_db", "session_history", "updated_at"),
+        ("phq9_fixed_editable", "slots", "last_updated"),
+        ("phq9_fixed_editable", "dialog", "last_stored_at"),
+        ("phq9_fixed_editable", "session_history", "updated_at"),
+        ("phq9_high_c_low_u", "slots", "last_updated"),
+        ("phq9_high_c_low_u", "session_history", "updated_at"),
+    ]
+]
+
+
+def ensure_indexes(mongo_client, required=REQUIRED_INDEXES, obsolete=OBSOLETE_INDEXES):
+    """
+    선언된 인덱스를 만든다. 같은 정의의 인덱스가 이미 있으면 MongoDB가 아무것도 하지 않으므로 여러 번 호출해도 된다.
+    중복 데이터 등으로 실패한 인덱스는 로그만 남기고 건너뛴다. obsolete에 있는 인덱스는 먼저 지운다.
+    """
+    for (db_name, coll_name), names in obsolete.items():
+        collection = mongo_client[db_name][coll_name]
+        existing = collection.index_information()
+        for name in names:
+            if name in existing:
+                collection.drop_index(name)
+                logging.info(f"오래된 인덱스 삭제: {db_name}.{coll_name}.{name}")
+    created = {}
+    for (db_name, coll_name), models in required.items():
+        collection = mongo_client[db_name][coll_name]
+        try:
+            created[f"{db_name}.{coll_name}"] = collection.create_indexes(models)
+        except OperationFailure as e:
+            logging.error(f"인덱스 생성 실패 {db_name}.{coll_name}: {e}")
+    logging.info(f"인덱스 확인 완료: {created}")
+    return created
+
+
+def plan_stages(plan):
+    """explain 결과의 winningPlan에서 모든 stage 이름을 모은다."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def verify_query_plans(mongo_client, endpoint_queries=ENDPOINT_QUERIES):
+    """
+    엔드포인트별 조회를 explain()해서 IXSCAN을 쓰는지 확인한다.
+    반환값: {엔드포인트: [{"collection", "filter", "stages", "uses_index"}]}
+    """
+    report = {}
+    for endpoint, queries in endpoint_queries.items():
+        results = []
+        for (db_name, coll_name), query, sort in queries:
+            cursor = mongo_client[db_name][coll_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = cursor.limit(1).explain()
+            stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+            uses_index = any(stage in ("IXSCAN", "EXPRESS_IXSCAN", "IDHACK") for stage in stages) and "COLLSCAN" not in stages
+            results.append({
+                "collection": f"{db_name}.{coll_name}",
+                "filter": query,
+                "stages": stages,
+                "uses_index": uses_index,
+            })
+            if not uses_index:
+                logging.warning(f"[{endpoint}] {db_name}.{coll_name} {query} 가 인덱스를 사용하지 않음: {stages}")
+        report[endpoint] = results
+    return report
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    client = MongoClient(os.environ.get("MONGO_URI"))
+    ensure_indexes(client)
+    if "--verify" in sys.argv:
+        report = verify_query_plans(client)
+        ok = True
+        for endpoint, results in report.items():
+            for r in results:
+                print(f"{endpoint:22s} {r['collection']:35s} {'IXSCAN' if r['uses_index'] else 'COLLSCAN':8s} {r['stages']}")
+                ok = ok and r["uses_index"]
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,257 @@
+#phq9_rules.py
+#PHQ-9 빈도/강도 표현을 규칙 기반으로 점수화하는 모듈
+#슬롯 추출 GPT 프롬프트의 점수 기준(0~3점)을 그대로 따르며, 확실한 경우에만 결과를 돌려준다.
+#결과가 None이면 기존처럼 GPT 슬롯 추출을 사용한다.
+import datetime
+import re
+from collections import namedtuple
+
+import pytz
+
+FreqMatch = namedtuple("FreqMatch", ["score", "phrase"])
+
+#빠른 경로는 짧은 빈도 답변에만 적용 (긴 발화는 다른 문항 내용이 섞여 있을 수 있음)
+MAX_FAST_PATH_CHARS = 60
+
+#최근 2주(14일) 중 증상이 있었던 날수 → 점수
+def days_to_score(days):
+    if days <= 0:
+        return 0
+    if days < 7:
+        return 1
+    if days < 12:
+        return 2
+    return 3
+
+#프롬프트의 점수 기준을 정규식으로 옮긴 것 (긴 표현이 먼저 오도록 정렬)
+FREQ_PATTERNS = [
+    #3점: 거의 매일, 대부분의 날
+    (r"거의\s*매일", 3),
+    (r"하루도\s*(?:빠짐\s*없이|안\s*빼고|안\s*빠지고|빼지\s*않고|빠지지\s*않고|빼먹지\s*않고)", 3),
+    (r"빠짐\s*없이", 3),
+    (r"대부분의?\s*날", 3),
+    (r"(?:2|두)\s*주\s*내내", 3),
+    (r"매일\s*같이", 3),
+    (r"매일", 3),
+    (r"날마다", 3),
+    (r"맨날", 3),
+    (r"항상", 3),
+    #2점: 절반 이상, 자주
+    (r"절반\s*이상", 2),
+    (r"반\s*이상", 2),
+    (r"(?:일|1|한)\s*주일?\s*(?:넘게|이상)", 2),
+    (r"자주", 2),
+    #1점: 며칠 동안, 가끔
+    (r"며칠", 1),
+    (r"가끔", 1),
+    (r"이따금", 1),
+    (r"드물게", 1),
+    (r"한두\s*번", 1),
+    (r"몇\s*번", 1),
+    #0점: 전혀 아니다, 그런 적 없다
+    (r"전혀\s*(?:없|아니|아녔|그렇지|그런\s*적)", 0),
+    (r"그런\s*적\s*(?:은|이)?\s*(?:한\s*번도\s*)?없", 0),
+    (r"한\s*번도\s*(?:없|그런\s*적)", 0),
+    (r"하루도\s*(?:없|안\s*그랬|그런\s*적)", 0),
+]
+COMPILED_FREQ_PATTERNS = [(re.compile(p), score) for p, score in FREQ_PATTERNS]
+
+#발화 전체가 짧은 부정 답변인 경우 (예: "아니요", "거의 없어요")
+NEGATIVE_ONLY_RE = re.compile(
+    r"^\s*(?:아니요|아뇨|아니|없어요|없었어요|없었습니다|없습니다|거의\s*없어요|거의\s*없었어요|거의\s*없음|전혀요|전혀)\s*[.!~]*\s*$"
+)
+
+#날수를 직접 말한 경우
+KOREAN_DAY_WORDS = {"하루": 1, "이틀": 2, "사흘": 3, "나흘": 4, "닷새": 5, "엿새": 6, "열흘": 10}
+KOREAN_COUNTS = {"한": 1, "두": 2, "세": 3, "네": 4, "다섯": 5, "여섯": 6, "일곱": 7}
+COUNT = r"(\d+|다섯|여섯|일곱|한|두|세|네)"
+#"일주일에 3번", "주 5일", "한 주에 두세 번"은 2주 기준 두 배로 센다 ("자주"의 '주'는 제외)
+PER_WEEK_RE = re.compile(r"(?<!자)(?:(?:일|1|한)\s*)?주(?:일)?\s*(?:에\s*)?(?:한\s+)?" + COUNT + r"\s*(?:(?:~|-|에서)\s*" + COUNT + r"\s*)?(?:일|번|회)")
+#"이틀에 한 번", "3일마다"처럼 간격으로 말한 경우: 14일 // 간격
+INTERVAL_RE = re.compile(
+    r"(\d+\s*일|" + "|".join(KOREAN_DAY_WORDS) + r")\s*(?:에\s*(?:한|1)\s*(?:번|회|차례)|마다)"
+)
+DAY_RANGE_RE = re.compile(r"(\d+)\s*(?:~|-|에서)\s*(\d+)\s*일")
+DAY_COUNT_RE = re.compile(r"(?<![\d~])(\d+)\s*일(?!\s*주)")
+DAY_WORD_RE = re.compile("|".join(KOREAN_DAY_WORDS))
+ONE_WEEK_RE = re.compile(r"(?<![\d두])(?:일|1|한)\s*주일?")
+TWO_WEEKS_RE = re.compile(r"(?:2|두)\s*주")
+
+#빈도가 아닌 표현: "하루 종일"은 강도, "하루에도 몇 번", "하루 세 끼", "하루 2시간"은 하루 안의 양,
+#"하루도 못 잤어요"는 강도라 날수로 볼 수 없다 ("하루도 안 빼고", "하루도 안 그랬어요"는 FREQ_PATTERNS에서 처리)
+PER_DAY_AMOUNT = (
+    r"(?:\d+|한|두|세|네|다섯|여섯|일곱|여덟|아홉|열|몇|여러|수십)\s*"
+    r"(?:번|회|차례|끼니|끼|시간|분|잔|개|갑|알|병|캔|그릇)"
+)
+NOT_FREQUENCY_RE = re.compile(
+    r"(?:온\s*)?하루\s*(?:종일|내내)|온종일"
+    r"|하루에도\s*(?:몇|여러|수십|수차례)\s*(?:번|차례)?"
+    r"|하루\s*(?:에\s*)?" + PER_DAY_AMOUNT +
+    r"|하루도\s*(?:못|제대로|편히|푹)|하루도\s*안(?!\s*(?:빼|빠지|그랬))"
+)
+
+#"매일은 아니고", "자주는 않아요"처럼 빈도 표현 바로 뒤의 부정
+NEGATED_AFTER_RE = re.compile(r"^\s*(?:은|는|까지는|까진)?\s*(?:아니|않|안\s)")
+#확신이 없는 답변
+UNCERTAIN_RE = re.compile(r"모르겠|모르|글쎄|애매|\?")
+
+
+def find_day_matches(text):
+    """
+    숫자/고유어로 말한 날수를 찾아 (점수, 원문 표현, 위치) 목록을 돌려준다.
+    """
+    found = []
+    taken = []
+
+    def add(m, days):
+        if any(m.start() < end and start < m.end() for start, end in taken):
+            return
+        taken.append((m.start(), m.end()))
+        found.append((days_to_score(days), m.group(0).strip(), m.start(), m.end()))
+
+    for m in INTERVAL_RE.finditer(text):
+        interval = m.group(1).replace(" ", "")
+        interval = KOREAN_DAY_WORDS.get(interval) or int(interval.rstrip("일"))
+        if interval > 0:
+            add(m, 14 // interval)
+    for m in PER_WEEK_RE.finditer(text):
+        count = m.group(2) or m.group(1)
+        add(m, int(KOREAN_COUNTS.get(count, count)) * 2)
+    for m in DAY_RANGE_RE.finditer(text):
+        add(m, int(m.group(2)))
+    for m in DAY_COUNT_RE.finditer(text):
+        add(m, int(m.group(1)))
+    for m in DAY_WORD_RE.finditer(text):
+        add(m, KOREAN_DAY_WORDS[m.group(0)])
+    for m in TWO_WEEKS_RE.finditer(text):
+        add(m, 14)
+    for m in ONE_WEEK_RE.finditer(text):
+        add(m, 7)
+    return found
+
+
+def parse_frequency(text):
+    """
+    사용자 발화에서 최근 2주간의 빈도 표현을 찾아 FreqMatch(score, phrase)를 돌려준다.
+    표현이 없거나, 서로 다른 점수의 표현이 섞여 있거나, 부정/불확실 표현이 있으면 None.
+    "하루 종일", "하루에도 몇 번"처럼 날수가 아닌 표현은 빈도로 세지 않는다.
+    """
+    if not text:
+        return None
+    text = text.strip()
+    if len(text) > MAX_FAST_PATH_CHARS or UNCERTAIN_RE.search(text):
+        return None
+
+    if NEGATIVE_ONLY_RE.match(text):
+        return FreqMatch(0, "거의 없음")
+
+    matches = []
+    taken = [(m.start(), m.end()) for m in NOT_FREQUENCY_RE.finditer(text)]
+    for pattern, score in COMPILED_FREQ_PATTERNS:
+        for m in pattern.finditer(text):
+            if any(m.start() < end and start < m.end() for start, end in taken):
+                continue
+            taken.append((m.start(), m.end()))
+            matches.append((score, m.group(0), m.start(), m.end()))
+    for score, phrase, start, end in find_day_matches(text):
+        if not any(start < t_end and t_start < end for t_start, t_end in taken):
+            matches.append((score, phrase, start, end))
+
+    if not matches:
+        return None
+    for score, _, _, end in matches:
+        if score > 0 and NEGATED_AFTER_RE.match(text[end:]):
+            return None
+    if len({score for score, _, _, _ in matches}) != 1:
+        return None
+
+    score = matches[0][0]
+    if score == 0:
+        return FreqMatch(0, "거의 없음")
+    start = min(m[2] for m in matches)
+    end = max(m[3] for m in matches)
+    phrase = text[start:end]
+    #"3~4일 정도"처럼 바로 뒤에 붙은 '정도/쯤/넘게'까지 원문 그대로 보존
+    tail = re.match(r"\s*(?:정도|쯤|넘게|이상|동안|가량)", text[end:])
+    if tail:
+        phrase += tail.group(0)
+    return FreqMatch(score, phrase.strip())
+
+
+#봇 질문에서 어떤 PHQ-9 문항을 물었는지 판단하기 위한 키워드
+PHQ9_ITEM_KEYWORDS = {
+    "흥미나 즐거움 감소": ["흥미", "즐거움", "즐겁", "재미"],
+    "우울감": ["우울", "가라앉", "희망이 없", "절망"],
+    "수면 문제": ["잠", "수면", "주무"],
+    "피로감": ["피곤", "피로", "기운", "에너지"],
+    "식욕 변화": ["식욕", "입맛", "먹", "식사"],
+    "자기비하": ["실패자", "자책", "실망", "탓"],
+    "집중력 저하": ["집중"],
+    "정신 운동성 지연 또는 초조": ["느리게", "느려", "안절부절", "초조", "들떠"],
+    "자살 생각": ["죽고", "자해", "자살", "죽는"],
+}
+
+
+def match_items(text, candidates):
+    return [item for item in candidates if any(k in text for k in PHQ9_ITEM_KEYWORDS.get(item, []))]
+
+
+#위기 문항 (PHQ-9 9번). 이 문항과 관련된 턴은 GPT 호출 입장 제어에서 먼저 처리한다
+CRISIS_ITEM = "자살 생각"
+
+
+def is_crisis_turn(slot_doc, user_input):
+    """
+    직전에 9번 문항을 물었거나, 사용자 발화에 관련 표현이 있거나, 이미 9번에 1점 이상 응답한 세션이면 True.
+    우선순위를 정하는 데만 쓰므로 애매하면 True 쪽으로 본다.
+    """
+    if slot_doc.get("last_asked_item") == CRISIS_ITEM or match_items(user_input or "", [CRISIS_ITEM]):
+        return True
+    slot = next((s for s in slot_doc['slots'] if s['item'] == CRISIS_ITEM), None)
+    return bool(slot and (slot.get("score") or 0) > 0)
+
+
+def detect_asked_item(bot_response, slot_doc):
+    """
+    봇 응답이 물어본 미응답 문항을 추정한다. 마지막 질문 문장을 우선 보고,
+    키워드가 없으면(같은 문항 후속 질문) 직전에 물었던 문항을 유지한다.
+    """
+    unanswered = [s['item'] for s in slot_doc['slots'] if s['status'] != 'answered']
+    sentences = [s for s in re.split(r"(?<=[.?!])\s+", bot_response or "") if s.strip()]
+    questions = [s for s in sentences if "?" in s]
+    for text in ([questions[-1]] if questions else []) + [bot_response or ""]:
+        hits = match_items(text, unanswered)
+        if len(hits) == 1:
+            return hits[0]
+        if len(hits) > 1:
+            return None
+    previous = slot_doc.get("last_asked_item")
+    return previous if previous in unanswered else None
+
+
+def rule_based_slot_update(slot_doc, user_input):
+    """
+    직전에 물은 문항(slot_doc['last_asked_item'])에 대해 사용자 답변의 빈도 표현이 확실하면
+    slot_update_parser.parse_dicts와 같은 형식의 슬롯 업데이트 리스트를 돌려준다. 확실하지 않으면 None.
+    답변에 다른 문항의 표현이 있거나 위기 문항 표현이 있으면 어느 문항에 대한 빈도인지 알 수 없으므로 None (GPT 추출).
+    """
+    item = slot_doc.get("last_asked_item")
+    if not item:
+        return None
+    mentioned = match_items(user_input or "", list(PHQ9_ITEM_KEYWORDS))
+    if CRISIS_ITEM in mentioned or any(other != item for other in mentioned):
+        return None
+    slot = next((s for s in slot_doc['slots'] if s['item'] == item), None)
+    if slot is None or slot['status'] == 'answered':
+        return None
+    match = parse_frequency(user_input)
+    if match is None:
+        return None
+    return [{
+        "item": item,
+        "status": "answered",
+        "score": match.score,
+        "raw_user_input": user_input,
+        "freq_or_intensity": match.phrase,
+        "last_updated": datetime.datetime.now(pytz.timezone('Asia/Seoul')).isoformat(),
+    }]
@@ -0,0 +1,230 @@
+#prompts.py
+#대화형 PHQ-9 엔드포인트(/api/chat, /api/phq9_high_c_low_u)의 프롬프트 템플릿
+#고정 지시문은 서버 시작 시 한 번만 만들고, 턴마다 바뀌는 값은 메시지 목록의 맨 끝(user 메시지)에만 넣는다.
+#이렇게 하면 매 턴 프롬프트 앞부분이 같아져서 OpenAI 프롬프트 프리픽스 캐시가 적용된다.
+import logging
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken이 없으면 토큰 수를 추정값으로 보고
+    tiktoken = None
+
+_encoding = None
+
+
+def count_tokens(text, model="gpt-4o"):
+    """
+    text의 토큰 수를 (토큰 수, 정확한 값 여부)로 반환한다.
+    tiktoken 인코딩을 쓸 수 없으면 UTF-8 바이트 수 기반 추정값을 쓴다.
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(model)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text)), True
+    #한글은 UTF-8로 3바이트, gpt-4o 토크나이저에서 대략 글자당 0.7~0.8 토큰
+    return max(1, round(len(text.encode("utf-8")) / 4)), False
+
+
+class PromptTemplate:
+    """
+    system: 고정 지시문 (시작 시 한 번 만들어 재사용)
+    user_format: 턴마다 바뀌는 값이 들어가는 user 메시지 형식 (str.format 필드)
+    static_values: user_format 중 엔드포인트별로 고정된 값
+    """
+
+    def __init__(self, name, system, user_format, **static_values):
+        self.name = name
+        self.system = system
+        self.user_format = user_format
+        self.static_values = static_values
+        self.system_message = {"role": "system", "content": system}
+
+    def render(self, **values):
+        return [
+            self.system_message,
+            {"role": "user", "content": self.user_format.format(**self.static_values, **values)},
+        ]
+
+    def static_prefix(self):
+        """매 턴 동일한 프롬프트 앞부분 (system + user 메시지의 첫 변수 앞까지)"""
+        user_head = self.user_format.split("{", 1)[0]
+        return self.system + user_head
+
+    def token_report(self):
+        system_tokens, exact = count_tokens(self.system)
+        prefix_tokens, _ = count_tokens(self.static_prefix())
+        return {
+            "system_tokens": system_tokens,
+            "static_prefix_tokens": prefix_tokens,
+            "exact": exact,
+        }
+
+
+REPLY_SYSTEM_PROMPT = (
+    "당신은 공감적이고 따뜻한 정신건강 챗봇입니다. 지금 사용자의 PHQ-9 우울증 자가진단을 대화형 방식으로 진행하고 있습니다.\n\n"
+    "* 대화 규칙:\n"
+    "- 이미 응답이 완료된 문항은 절대 반복해서 질문하지 마세요.\n"
+    "- 첫 번째 인삿말 이후에는 '안녕하세요' 같은 인삿말을 반복하지 마세요.\n"
+    "- 사용자의 발화를 분석하여 어떤 PHQ-9 항목(item)에 해당하는지 판단하세요.\n"
+    "- 사용자의 발화를 바탕으로 해당 항목의 점수(0~3점)와 빈도/강도 정보를 추론하세요.\n"
+    "- 빈도(며칠, 거의 매일 등)나 강도(심함의 정도) 정보가 부족한 경우, 반드시 후속 질문을 통해 **최근 2주간**의 **빈도나 강도**에 대해 자연스럽게 따뜻한 말투로 물어보세요.\n"
+    "- 후속 질문은 기계적이거나 일반적인 표현을 피하고, 반드시 이전 사용자의 응답과 **맥락**을 고려한 말투여야 합니다.\n"
+    "- 후속 질문 예시:\n"
+    "  * “말씀해주셔서 감사해요. 최근 2주 동안 이런 일이 얼마나 자주 있었나요?”\n"
+    "  * “많이 힘드셨겠어요. 최근 2주간 이런 기분이 거의 매일 있었을까요, 아니면 가끔이었을까요?”\n"
+    "  * “솔직하게 얘기해주셔서 고마워요. 최근 2주간 이런 감정이 얼마나 강하게 느껴졌는지 말씀해주실 수 있을까요?”\n"
+    "- 후속 질문에는 항상 '최근 2주간'이라는 표현이 **자연스럽게 포함**되어야 합니다.\n"
+    "- 점수와 빈도/강도가 **모두** 명확히 파악된 경우에만 해당 항목을 'answered'상태로 간주하세요.\n"
+    "- 사용자의 최근 응답을 바탕으로 다음으로 가장 관련 있어 보이는 미응답한 PHQ-9 항목 **하나만** 선택해 자연스럽게 다음 질문을 이어가세요.\n"
+    "- 다음 질문은 반드시 사용자 메시지 끝에 주어지는 '현재 미응답 항목 리스트' 중 하나만 선택하세요.\n"
+    "* 말투:\n"
+    "- 항상 따뜻하고 지지적인, 배려심 있는 말투를 사용하세요. 친절한 친구처럼 대화해주세요.\n"
+    "- 사용자를 재촉하거나 압박하지 말고, 필요한 경우에는 공감 어린 후속 질문으로 자연스럽게 유도하세요.\n\n"
+    "* 출력 방식:\n"
+    "- 사용자의 응답에 점수와 빈도/강도가 명확히 포함된 경우, 따뜻하게 공감하며 다음 미응답 항목으로 자연스럽게 넘어가세요.\n"
+    "- 빈도 또는 강도 정보가 부족한 경우, **단 하나의 후속 질문**만 사용해 해당 정보를 자연스럽게 물어보세요. 반드시 대화 문맥에 맞는 따뜻한 말투여야 합니다."
+)
+
+REPLY_USER_FORMAT = (
+    "아래 미응답 항목 리스트 중에서 가장 관련 있는 {target_word} 하나를 골라 자연스럽게 질문하세요.\n"
+    "이전 대화: {context_text}\n"
+    "이전 답변 완료 문항: {answered_items}\n"
+    "현재 미응답 항목 리스트:\n{unanswered_items}"
+)
+
+
+def build_slot_system_prompt(phq9_items):
+    return (
+        "당신은 사용자의 PHQ-9 자가진단 대화 내용을 바탕으로 슬롯 업데이트 JSON을 생성하는 보조 도우미입니다.\n\n"
+        "- 전체 대화 맥락(이전 발화들)과 최신 입력을 함께 고려해서 평가하세요."
+        "- 빈도 또는 강도(freq_intensity)와 점수(score)가 모두 명확히 포함된 경우에만 해당 문항을 'answered'로 간주하세요."
+        "- 출력은 아래와 같이 updates 배열을 담은 **JSON 객체 하나만** 제공해야 합니다. 그 외의 텍스트는 절대 포함하지 마세요:\n"
+        "{\n"
+        "  \"updates\": [\n"
+        "    {\n"
+        "      \"item\": \"우울감\",\n"
+        "      \"status\": \"answered\",\n"
+        "      \"score\": (사용자 응답에 근거하여 추론된 0~3 중 하나),\n"
+        "      \"raw_user_input\": \"사용자의 원문 발화\",\n"
+        "      \"freq_or_intensity\": \"사용자가 표현한 빈도 또는 강도 그대로(ex.거의 5일정도, 한 3~4일, 2주넘게)\",\n"
+        "      \"last_updated\": null\n"
+        "    }\n"
+        "  ]\n"
+        "}\n\n"
+        "예시:"
+        "{\n"
+        "  \"updates\": [\n"
+        "    {\n"
+        "      \"item\": \"식욕 변화\",\n"
+        "      \"status\": \"answered\",\n"
+        "      \"score\": 1,\n"
+        "      \"raw_user_input\": \"맞아...초콜릿을 안 먹게 된지 3~4일 정도 된 것 같아...\",\n"
+        "      \"freq_or_intensity\": \"3~4일 정도\",\n"
+        "      \"last_updated\": null\n"
+        "    }\n"
+        "  ]\n"
+        "}\n"
+        "- 새로 파악된 정보가 없으면 {\"updates\": []}를 출력하세요.\n"
+        "- score는 다음 기준에 따라 추정하세요:\n"
+        "  - 전혀 아니다, 그런 적 없다, 전혀 하지 않았다 → 0점\n"
+        "  - 며칠 동안, 가끔 → 1점\n"
+        "  - 절반 이상, 자주 → 2점\n"
+        "  - 거의 매일, 대부분의 날 → 3점\n"
+        "- 빈도나 강도에 대한 언급이 없으면 freq_or_intensity는 null로 설정하세요.\n"
+        "- 사용자가 명확히 특정 증상이 *전혀 없다*고 말했으면, 꼭 status: answered, score: 0, freq_or_intensity: 거의 없음 으로 updates에 포함하세요.\n"
+        "- 이전에 언급된 증상에 대한 후속 응답이 있을 수 있으므로, 같은 항목이라도 내용이 다르면 업데이트해야 합니다.\n"
+        "- 이미 'answered' 상태로 응답된 문항은 다시 질문하지 마세요. updates에도 포함하지 마세요.\n"
+        "- 사용자의 최신 응답은 '직전에 질문한 문항'에 대한 후속 설명일 가능성이 높습니다. "
+        "따라서 '마지막으로 질문했던 문항'이 존재하면, 그 문항만을 업데이트 대상으로 간주하세요.\n"
+        f"- 가능한 item 값: {phq9_items}"
+    )
+
+
+SLOT_USER_FORMAT = (
+    "전체 대화 맥락:\n{context_text}\n\n"
+    "사용자의 최신 입력:\n{latest_user_input}\n\n"
+    "현재까지의 사용자 응답 상태(JSON):\n{slot_state}\n"
+    "* 이미 'answered'상태인 문항은 다시 묻거나 updates에 포함하지 마세요:\n"
+    "{answered_items}"
+)
+
+
+#compact 슬롯 상태(slot_state.py)용 user 메시지 형식
+SLOT_USER_FORMAT_COMPACT = (
+    "전체 대화 맥락:\n{context_text}\n\n"
+    "사용자의 최신 입력:\n{latest_user_input}\n\n"
+    "현재까지의 사용자 응답 상태:\n{slot_state}\n"
+    "* '응답 완료' 문항은 다시 묻거나 updates에 포함하지 마세요."
+)
+
+
+def build_combined_system_prompt(phq9_items):
+    """combined 모드: 응답 생성 지시문 뒤에 슬롯 추출 기준을 붙이고, 결과는 report_turn 함수 호출로만 받는다."""
+    return (
+        REPLY_SYSTEM_PROMPT + "\n\n"
+        "* 슬롯 업데이트:\n"
+        "- 응답 문장과 함께, 전체 대화 맥락과 사용자의 최신 입력에서 파악된 PHQ-9 문항 정보를 updates 배열에 넣으세요.\n"
+        "- 빈도 또는 강도(freq_or_intensity)와 점수(score)가 모두 명확히 포함된 경우에만 status를 'answered'로 하세요.\n"
+        "- score 기준: 전혀 아니다/그런 적 없다 → 0점, 며칠 동안/가끔 → 1점, 절반 이상/자주 → 2점, 거의 매일/대부분의 날 → 3점\n"
+        "- 빈도나 강도에 대한 언급이 없으면 freq_or_intensity는 null로 하세요.\n"
+        "- 사용자가 특정 증상이 *전혀 없다*고 말했으면 status: answered, score: 0, freq_or_intensity: 거의 없음 으로 넣으세요.\n"
+        "- '응답 완료' 문항은 updates에 넣지 마세요. 사용자의 최신 입력은 '직전 질문 문항'에 대한 후속 설명일 가능성이 높습니다.\n"
+        "- 새로 파악된 정보가 없으면 updates는 빈 배열로 두세요.\n"
+        "* 제출 방식:\n"
+        "- 반드시 report_turn 함수를 호출해 bot_response(사용자에게 보낼 응답 문장)와 updates를 함께 제출하세요.\n"
+        f"- 가능한 item 값: {phq9_items}"
+    )
+
+
+COMBINED_USER_FORMAT = (
+    "아래 미응답 항목 리스트 중에서 가장 관련 있는 {target_word} 하나를 골라 자연스럽게 질문하세요.\n"
+    "이전 대화: {context_text}\n"
+    "사용자의 최신 입력: {latest_user_input}\n"
+    "현재까지의 사용자 응답 상태:\n{slot_state}\n"
+    "현재 미응답 항목 리스트:\n{unanswered_items}"
+)
+
+
+def build_prompt_templates(phq9_items):
+    """
+    서버 시작 시 한 번 호출해 엔드포인트별 템플릿을 만든다.
+    chat과 high_c_low_u는 같은 system 프롬프트를 공유하므로 캐시도 공유된다.
+    """
+    slot_system_prompt = build_slot_system_prompt(phq9_items)
+    combined_system_prompt = build_combined_system_prompt(phq9_items)
+    templates = {
+        "chat_reply": PromptTemplate("chat_reply", REPLY_SYSTEM_PROMPT, REPLY_USER_FORMAT, target_word="문항"),
+        "high_reply": PromptTemplate("high_reply", REPLY_SYSTEM_PROMPT, REPLY_USER_FORMAT, target_word="항목"),
+        "slot_extraction": PromptTemplate("slot_extraction", slot_system_prompt, SLOT_USER_FORMAT),
+        "slot_extraction_compact": PromptTemplate("slot_extraction_compact", slot_system_prompt, SLOT_USER_FORMAT_COMPACT),
+        "chat_combined": PromptTemplate("chat_combined", combined_system_prompt, COMBINED_USER_FORMAT, target_word="문항"),
+        "high_combined": PromptTemplate("high_combined", combined_system_prompt, COMBINED_USER_FORMAT, target_word="항목"),
+    }
+    for name, report in prompt_token_report(templates).items():
+        logging.info(
+            f"프롬프트 템플릿 '{name}': system {report['system_tokens']} 토큰, "
+            f"고정 프리픽스 {report['static_prefix_tokens']} 토큰"
+            + ("" if report["exact"] else " (추정값)")
+        )
+    return templates
+
+
+def prompt_token_report(templates):
+    """템플릿별 system/고정 프리픽스 토큰 수 (시작 로그와 벤치마크 결과에 사용)"""
+    return {name: template.token_report() for name, template in templates.items()}
+
+
+def log_prompt_usage(template_name, response):
+    """
+    응답의 usage에서 프롬프트 토큰 수와 프리픽스 캐시 적중 토큰 수를 기록한다.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    logging.info(f"[{template_name}] prompt_tokens={usage.prompt_tokens} cached_tokens={cached}")
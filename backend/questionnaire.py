@@ -0,0 +1,143 @@
+#questionnaire.py
+#고정 문항 설문(PHQ-9 고정 문항, 이후 GAD-7 등)을 상태 기계로 진행하는 엔진
+#문항 리스트는 서버 시작 시 한 번 전이 표(steps)로 컴파일하고, 턴마다 상태를 읽은 뒤
+#current_index를 조건으로 건 원자적 쓰기 한 번으로 다음 상태/답변/요약 캐시를 함께 저장한다.
+#세션 문서: {"user_id", "started", "current_index", "answers": {"0": 답변, ...}, "edited_items", "summary_cache", "completed_at", "last_updated"}
+#상태 = current_index (0: 시작 전, 1..n-1: 해당 번호 문항을 보내고 답변 대기, n: 마지막 문항까지 보낸 뒤 완료)
+import logging
+from collections import namedtuple
+
+from pymongo.errors import DuplicateKeyError
+
+#question: 이번 턴에 보낼 문항 (완료 상태면 None)
+#answer_index: 이번 사용자 메시지를 답변으로 기록할 문항 번호 (없으면 None)
+Step = namedtuple("Step", ["state", "question", "next_state", "answer_index", "starts_session"])
+
+#query/update: 세션 문서 쓰기 (쓸 것이 없으면 update는 None)
+#bot_message: 대화 기록에 남길 봇 메시지 (요약 응답은 기록하지 않음)
+TurnPlan = namedtuple("TurnPlan", ["step", "query", "update", "response", "bot_message", "summary_items"])
+
+
+class Questionnaire:
+    """
+    items: 순서대로 물을 문항 리스트
+    closing_message: 완료 후 보낼 마무리 메시지 (summary_header가 없을 때)
+    summary_header/format_summary: 완료 후 답변 요약을 보여줄 때의 첫 줄과 문항별 요약 함수(slots, edited_map)
+    """
+
+    def __init__(self, name, items, closing_message=None, summary_header=None, format_summary=None):
+        self.name = name
+        self.items = list(items)
+        self.closing_message = closing_message
+        self.summary_header = summary_header
+        self.format_summary = format_summary
+        self.steps = self._compile()
+
+    def _compile(self):
+        n = len(self.items)
+        steps = [Step(0, self.items[0], 1, None, True)]
+        for state in range(1, n):
+            steps.append(Step(state, self.items[state], state + 1, state - 1, False))
+        steps.append(Step(n, None, n, n - 1, False))
+        return steps
+
+    @property
+    def summarizes(self):
+        return self.summary_header is not None
+
+    def state_of(self, doc):
+        if not doc or not doc.get("started"):
+            return 0
+        return min(doc.get("current_index", 0), len(self.items))
+
+    def build_summary(self, answers, edited_items=None):
+        """
+        답변 맵으로 (요약 문자열, summary_items)를 만든다. 문항 수만큼만 돈다.
+        edited_items: /api/summary/edit로 저장된 [{"item", "edited_answer"}]
+        """
+        answers = answers or {}
+        slots = [{"item": q, "raw_user_input": answers.get(str(i), "")} for i, q in enumerate(self.items)]
+        edited_map = {e["item"]: e["edited_answer"] for e in (edited_items or [])}
+        summary_items = [
+            {"num": num, "item": s["item"], "answer": edited_map.get(s["item"], s["raw_user_input"])}
+            for num, s in enumerate(slots, 1)
+        ]
+        final_summary = "\n\n".join([self.summary_header, self.format_summary(slots, edited_map)])  #\n\n 두 줄 띄우기
+        return final_summary, summary_items
+
+    def plan_turn(self, user_id, doc, user_message, now):
+        """세션 문서(doc)와 사용자 메시지로 이번 턴의 응답과 저장할 내용을 정한다. DB 접근은 하지 않는다."""
+        step = self.steps[self.state_of(doc)]
+        doc = doc or {}
+        answers = {} if step.starts_session else dict(doc.get("answers") or {})
+        edited_items = None if step.starts_session else doc.get("edited_items")
+
+        set_fields = {}
+        if step.starts_session:
+            #새 세션 시작 시 이전 세션의 답변/요약이 섞이지 않도록 비운다
+            set_fields.update(started=True, answers={}, edited_items=[], summary_cache=None, completed_at=None)
+        if step.next_state != step.state:
+            set_fields["current_index"] = step.next_state
+        #문항당 첫 답변만 기록한다 (완료 후 다시 호출돼도 마지막 답변이 덮어써지지 않도록)
+        if user_message and step.answer_index is not None and str(step.answer_index) not in answers:
+            answers[str(step.answer_index)] = user_message.strip()
+            set_fields[f"answers.{step.answer_index}"] = user_message.strip()
+            if len(answers) == len(self.items):
+                set_fields["completed_at"] = now
+
+        summary_items = None
+        if step.question is not None:
+            response = bot_message = step.question
+        elif self.summarizes:
+            bot_message = None
+            cache = doc.get("summary_cache")
+            if cache and not set_fields:
+                response, summary_items = cache["text"], cache["items"]
+            else:
+                response, summary_items = self.build_summary(answers, edited_items)
+                set_fields["summary_cache"] = {"text": response, "items": summary_items}
+        else:
+            response = bot_message = self.closing_message
+
+        update = None
+        if set_fields:
+            set_fields["last_updated"] = now
+            update = {"$set": set_fields}
+        #다른 요청이 먼저 상태를 바꿨으면 쓰기가 매칭되지 않도록 읽은 current_index를 조건으로 건다
+        query = {"user_id": user_id, "current_index": doc.get("current_index", 0)}
+        return TurnPlan(step, query, update, response, bot_message, summary_items)
+
+    def advance(self, collection, user_id, user_message, now, retries=3):
+        """
+        세션 문서를 읽고(1번) 이번 턴 결과를 조건부 원자적 쓰기(최대 1번)로 저장한 뒤 TurnPlan을 반환한다.
+        같은 사용자의 동시 요청과 충돌하면 다시 읽어서 재시도한다.
+        """
+        for _ in range(retries):
+            doc = collection.find_one({"user_id": user_id})
+            plan = self.plan_turn(user_id, doc, user_message, now)
+            if plan.update is None:
+                return plan
+            try:
+                result = collection.update_one(plan.query, plan.update, upsert=doc is None)
+            except DuplicateKeyError:
+                continue
+            if result.matched_count or result.upserted_id is not None:
+                return plan
+            logging.info(f"[{self.name}] {user_id} 상태 충돌, 다시 시도")
+        raise RuntimeError(f"[{self.name}] {user_id} 세션 상태 저장 실패 (동시 요청 충돌)")
+
+    async def aadvance(self, collection, user_id, user_message, now, retries=3):
+        """advance의 비동기 버전 (collection은 AsyncMongoClient 컬렉션)"""
+        for _ in range(retries):
+            doc = await collection.find_one({"user_id": user_id})
+            plan = self.plan_turn(user_id, doc, user_message, now)
+            if plan.update is None:
+                return plan
+            try:
+                result = await collection.update_one(plan.query, plan.update, upsert=doc is None)
+            except DuplicateKeyError:
+                continue
+            if result.matched_count or result.upserted_id is not None:
+                return plan
+            logging.info(f"[{self.name}] {user_id} 상태 충돌, 다시 시도")
+        raise RuntimeError(f"[{self.name}] {user_id} 세션 상태 저장 실패 (동시 요청 충돌)")
@@ -0,0 +1,121 @@
+#session_history.py
+#서버 측 대화 이력 저장소
+#클라이언트가 '|'로 이어 붙인 conversation_history를 매 턴 올려 보내던 방식을 대신한다.
+#사용자별 링 버퍼(최근 메시지 max_messages개, 합계 max_tokens 토큰 이내)를 메모리에 두고,
+#collection이 주어지면 턴마다 MongoDB에 한 번 써서(write-through) 재시작/캐시 밀림 후에도 이어서 쓴다.
+#여러 워커로 띄울 때 같은 사용자가 다른 워커로 가면 메모리 사본이 오래될 수 있으므로
+#sticky session을 쓰거나 HISTORY_CACHE_SIZE=0(매 턴 MongoDB에서 읽기)으로 둔다.
+#서버에 이력이 없는 첫 턴에는 클라이언트가 보낸 이력(Node 서버가 넣은 첫 인사말)으로 시작한다 (get의 initial).
+import datetime
+import threading
+from collections import OrderedDict, deque
+
+from prompts import count_tokens
+
+
+def parse_client_history(conversation_history):
+    """클라이언트가 '|'로 이어 붙인 conversation_history를 메시지 리스트로 만든다."""
+    if not isinstance(conversation_history, str):
+        return []
+    return [text for text in conversation_history.split('|') if text.strip()]
+
+
+class SessionHistoryStore:
+    def __init__(self, collection=None, max_messages=6, max_tokens=1500, max_sessions=10000):
+        self.collection = collection
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # user_id -> deque[(text, 토큰 수)]
+        self._lock = threading.Lock()
+
+    def _trim(self, buffer):
+        #토큰 예산을 넘으면 오래된 메시지부터 버린다 (최신 메시지 하나는 남김)
+        total = sum(tokens for _, tokens in buffer)
+        while len(buffer) > 1 and total > self.max_tokens:
+            _, tokens = buffer.popleft()
+            total -= tokens
+
+    def _buffer_from(self, messages):
+        buffer = deque(maxlen=self.max_messages)
+        for text in messages or []:
+            buffer.append((text, count_tokens(text)[0]))
+        self._trim(buffer)
+        return buffer
+
+    def _cached(self, user_id):
+        with self._lock:
+            buffer = self._sessions.get(user_id)
+            if buffer is not None:
+                self._sessions.move_to_end(user_id)
+            return buffer
+
+    def _remember(self, user_id, buffer):
+        if self.max_sessions <= 0:
+            return
+        with self._lock:
+            self._sessions[user_id] = buffer
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def _appended(self, user_id, history, texts):
+        buffer = self._buffer_from(list(history) + [text for text in texts if text])
+        self._remember(user_id, buffer)
+        messages = [text for text, _ in buffer]
+        update = {"$set": {"messages": messages, "updated_at": datetime.datetime.now(datetime.timezone.utc)}}
+        return messages, update
+
+    def get(self, user_id, initial=None):
+        """
+        user_id의 최근 대화 메시지(텍스트) 리스트를 오래된 순으로 반환한다.
+        저장된 이력이 없으면 initial(메시지 리스트)로 시작한다.
+        """
+        buffer = self._cached(user_id)
+        if buffer is None:
+            doc = self.collection.find_one({"_id": user_id}, {"messages": 1}) if self.collection is not None else None
+            buffer = self._buffer_from(doc.get("messages") if doc else [])
+            self._remember(user_id, buffer)
+        return self._messages(buffer, initial)
+
+    def _messages(self, buffer, initial):
+        if not buffer and initial:
+            return [text for text, _ in self._buffer_from(initial)]
+        return [text for text, _ in buffer]
+
+    def append(self, user_id, history, *texts):
+        """
+        history(이번 요청에서 get()으로 받은 이력)에 texts를 붙이고 예산에 맞게 자른 뒤 한 번 저장한다.
+        잘린 후의 이력을 반환한다.
+        """
+        messages, update = self._appended(user_id, history, texts)
+        if self.collection is not None:
+            self.collection.update_one({"_id": user_id}, update, upsert=True)
+        return messages
+
+    def clear(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        if self.collection is not None:
+            self.collection.delete_one({"_id": user_id})
+
+    async def aget(self, user_id, initial=None):
+        """get의 비동기 버전 (collection은 AsyncMongoClient 컬렉션)"""
+        buffer = self._cached(user_id)
+        if buffer is None:
+            doc = await self.collection.find_one({"_id": user_id}, {"messages": 1}) if self.collection is not None else None
+            buffer = self._buffer_from(doc.get("messages") if doc else [])
+            self._remember(user_id, buffer)
+        return self._messages(buffer, initial)
+
+    async def aappend(self, user_id, history, *texts):
+        messages, update = self._appended(user_id, history, texts)
+        if self.collection is not None:
+            await self.collection.update_one({"_id": user_id}, update, upsert=True)
+        return messages
+
+    async def aclear(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        if self.collection is not None:
+            await self.collection.delete_one({"_id": user_id})
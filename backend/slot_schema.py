@@ -0,0 +1,189 @@
+#slot_schema.py
+#슬롯 추출 GPT 응답의 JSON 스키마(structured output)와 검증 파서
+#response_format으로 item을 PHQ9_ITEMS enum으로 묶어 보내고, 응답은 json으로 한 번만 파싱한 뒤
+#항목별로 검증해 SlotUpdate로 만든다. 검증에 실패한 항목은 버리고 사유별로 on_reject에 알린다.
+#스키마를 쓰지 않는 경우(SLOT_STRUCTURED_OUTPUT=0)의 코드 블록/앞뒤 설명문이 붙은 {"updates": [...]} 객체나 예전 형식의 JSON 배열도 같은 파서로 읽는다.
+#combined 모드: 응답 문장과 슬롯 업데이트를 report_turn 함수 호출 하나로 함께 받는다 (build_turn_tool, parse_turn).
+import datetime
+import json
+import logging
+from collections import namedtuple
+
+import pytz
+
+#update_slot_structure/rule_based_slot_update와 같은 필드 (last_updated는 서버에서 채운다)
+SlotUpdate = namedtuple("SlotUpdate", ["item", "status", "score", "raw_user_input", "freq_or_intensity", "last_updated"])
+
+SLOT_STATUSES = ("answered", "unanswered")
+SLOT_SCORES = (0, 1, 2, 3)
+TURN_TOOL_NAME = "report_turn"
+
+
+def slot_update_schema(phq9_items):
+    """슬롯 업데이트 항목 하나의 JSON 스키마"""
+    return {
+        "type": "object",
+        "properties": {
+            "item": {"type": "string", "enum": list(phq9_items)},
+            "status": {"type": "string", "enum": list(SLOT_STATUSES)},
+            "score": {"type": ["integer", "null"], "description": "0~3 중 하나, 알 수 없으면 null"},
+            "raw_user_input": {"type": ["string", "null"]},
+            "freq_or_intensity": {"type": ["string", "null"]},
+        },
+        "required": ["item", "status", "score", "raw_user_input", "freq_or_intensity"],
+        "additionalProperties": False,
+    }
+
+
+def build_slot_response_format(phq9_items):
+    """슬롯 추출 요청의 response_format (strict json_schema). 최상위는 객체여야 하므로 배열을 updates에 담는다."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "phq9_slot_updates",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"updates": {"type": "array", "items": slot_update_schema(phq9_items)}},
+                "required": ["updates"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def build_turn_tool(phq9_items):
+    """combined 모드의 함수 정의: 사용자에게 보낼 응답 문장과 슬롯 업데이트를 함께 받는다."""
+    return {
+        "type": "function",
+        "function": {
+            "name": TURN_TOOL_NAME,
+            "description": "사용자에게 보낼 응답 문장과 이번 입력에서 파악된 PHQ-9 슬롯 업데이트를 제출한다.",
+            "strict": True,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "bot_response": {"type": "string", "description": "사용자에게 보낼 응답 문장"},
+                    "updates": {"type": "array", "items": slot_update_schema(phq9_items)},
+                },
+                "required": ["bot_response", "updates"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _optional_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    raise ValueError
+
+
+class SlotUpdateParser:
+    """
+    items: 허용할 문항 이름 리스트 (PHQ9_ITEMS)
+    on_reject: 버린 항목마다 사유(reason)를 받는 함수 (예: metrics.record_slot_rejection)
+    """
+
+    def __init__(self, items, on_reject=None):
+        self.items = frozenset(items)
+        self.on_reject = on_reject
+        self._decoder = json.JSONDecoder()
+
+    def _reject(self, reason, detail):
+        logging.warning(f"슬롯 업데이트 제외({reason}): {detail}")
+        if self.on_reject is not None:
+            self.on_reject(reason)
+
+    def _decode(self, text):
+        """
+        응답 문자열에서 JSON 값 하나를 읽는다. 스키마 응답은 그대로 읽히고,
+        코드 블록이나 설명문이 앞뒤에 붙은 경우에는 처음 나오는 '[' 또는 '{'부터 읽는다.
+        """
+        text = (text or "").strip()
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+        starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+        if not starts:
+            raise ValueError("JSON 없음")
+        return self._decoder.raw_decode(text, min(starts))[0]
+
+    def _validate(self, raw, now_str):
+        if not isinstance(raw, dict):
+            return None, "not_object"
+        if not isinstance(raw.get("item"), str) or raw["item"] not in self.items:
+            return None, "unknown_item"
+        status = raw.get("status") or "unanswered"
+        if status not in SLOT_STATUSES:
+            return None, "invalid_status"
+        score = raw.get("score")
+        if isinstance(score, str) and score.strip().isdigit():
+            score = int(score)
+        if score is not None and (isinstance(score, bool) or score not in SLOT_SCORES):
+            return None, "invalid_score"
+        if score is not None:
+            score = int(score)
+        try:
+            raw_user_input = _optional_text(raw.get("raw_user_input"))
+            freq_or_intensity = _optional_text(raw.get("freq_or_intensity"))
+        except ValueError:
+            return None, "invalid_field"
+        return SlotUpdate(raw["item"], status, score, raw_user_input, freq_or_intensity, now_str), None
+
+    def parse(self, text):
+        """
+        GPT 응답 문자열을 SlotUpdate 리스트로 만든다. 전체를 읽지 못하면 빈 리스트.
+        같은 문항이 여러 번 나오면 처음 것만 쓴다.
+        """
+        try:
+            data = self._decode(text)
+        except ValueError as e:
+            self._reject("invalid_json", f"{e}: {text!r}")
+            return []
+        return self._parse_updates(data)
+
+    def _parse_updates(self, data):
+        if isinstance(data, dict) and "updates" in data:
+            data = data["updates"]
+        elif isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
+            self._reject("invalid_json", repr(data))
+            return []
+
+        now_str = datetime.datetime.now(pytz.timezone('Asia/Seoul')).isoformat()  #서버에서 강제로 갱신
+        updates = []
+        seen = set()
+        for raw in data:
+            update, reason = self._validate(raw, now_str)
+            if update is not None and update.item in seen:
+                update, reason = None, "duplicate_item"
+            if update is None:
+                self._reject(reason, raw)
+                continue
+            seen.add(update.item)
+            updates.append(update)
+        return updates
+
+    def parse_dicts(self, text):
+        """update_slot_structure에 바로 넘길 수 있는 dict 리스트"""
+        return [update._asdict() for update in self.parse(text)]
+
+    def parse_turn(self, arguments):
+        """
+        report_turn 함수 호출 인자(JSON 문자열)를 (응답 문장, 슬롯 업데이트 dict 리스트)로 만든다.
+        응답 문장이 없으면 (None, [])을 반환한다.
+        """
+        try:
+            data = json.loads(arguments or "")
+        except ValueError as e:
+            self._reject("invalid_json", f"{e}: {arguments!r}")
+            return None, []
+        bot_response = data.get("bot_response") if isinstance(data, dict) else None
+        if not isinstance(bot_response, str) or not bot_response.strip():
+            self._reject("missing_reply", arguments)
+            return None, []
+        updates = self._parse_updates({"updates": data.get("updates") or []})
+        return bot_response.strip(), [update._asdict() for update in updates]
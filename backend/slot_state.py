@@ -0,0 +1,122 @@
+#slot_state.py
+#슬롯 추출 프롬프트에 넣는 현재 응답 상태 직렬화
+#기존 방식(json)은 9개 슬롯의 모든 필드(null, timestamp 포함)를 매 턴 넣고 응답 완료 목록을 한 번 더 붙였다.
+#compact 방식은 미응답 문항(알고 있는 점수/빈도만), 응답 완료 문항 이름, 직전 질문 문항만 짧고 고정된 순서로 넣는다.
+#측정 모드: 저장된 슬롯 문서를 턴 단위로 되돌려 보며 두 방식의 토큰 수를 비교한다.
+#  python slot_state.py                 # MONGO_URI의 대화형 엔드포인트 슬롯 문서로 측정
+#  python slot_state.py --file docs.jsonl --limit 200
+import argparse
+import json
+import os
+import statistics
+
+from prompts import count_tokens
+
+#측정 모드에서 읽을 슬롯 컬렉션 (데이터베이스, 컬렉션)
+RECORDED_SLOT_COLLECTIONS = [("phq9_chatbot", "slots"), ("phq9_high_c_low_u", "slots")]
+
+
+def json_slot_state(slots):
+    """기존 형식: 전체 슬롯 JSON과 응답 완료 문항 리스트"""
+    answered_items = [s['item'] for s in slots if s['status'] == 'answered']
+    return json.dumps(slots, ensure_ascii=False, default=str), str(answered_items)
+
+
+def compact_slot_state(slots, last_asked_item=None):
+    """
+    예시:
+    미응답: 흥미나 즐거움 감소, 수면 문제(점수 2), 피로감
+    응답 완료: 우울감
+    직전 질문 문항: 수면 문제
+    """
+    pending = []
+    answered = []
+    for s in slots:
+        if s['status'] == 'answered':
+            answered.append(s['item'])
+            continue
+        known = []
+        if s.get('score') is not None:
+            known.append(f"점수 {s['score']}")
+        if s.get('freq_or_intensity'):
+            known.append(f"빈도 {s['freq_or_intensity']}")
+        pending.append(f"{s['item']}({', '.join(known)})" if known else s['item'])
+    lines = [
+        f"미응답: {', '.join(pending) or '없음'}",
+        f"응답 완료: {', '.join(answered) or '없음'}",
+    ]
+    if last_asked_item:
+        lines.append(f"직전 질문 문항: {last_asked_item}")
+    return "\n".join(lines)
+
+
+def slot_state_tokens(slots, last_asked_item=None):
+    """(json 형식 토큰 수, compact 형식 토큰 수)"""
+    json_tokens = sum(count_tokens(text)[0] for text in json_slot_state(slots))
+    compact_tokens = count_tokens(compact_slot_state(slots, last_asked_item))[0]
+    return json_tokens, compact_tokens
+
+
+def replay_turn_states(slot_doc):
+    """
+    저장된 최종 슬롯 문서에서 턴별 상태를 되살린다.
+    last_updated 순서대로 슬롯을 하나씩 채워 가며, 처음(빈 상태)부터 마지막 상태까지 반환한다.
+    """
+    filled = [s for s in slot_doc.get('slots', []) if s.get('last_updated') is not None]
+    filled.sort(key=lambda s: str(s['last_updated']))
+    current = {
+        s['item']: dict(s, status="unanswered", score=None, raw_user_input=None, freq_or_intensity=None, last_updated=None)
+        for s in slot_doc.get('slots', [])
+    }
+    states = [[dict(s) for s in current.values()]]
+    for slot in filled:
+        current[slot['item']] = dict(slot)
+        states.append([dict(s) for s in current.values()])
+    return states
+
+
+def measure_savings(slot_docs):
+    per_turn = []
+    for doc in slot_docs:
+        for slots in replay_turn_states(doc):
+            json_tokens, compact_tokens = slot_state_tokens(slots, doc.get('last_asked_item'))
+            per_turn.append((json_tokens, compact_tokens))
+    if not per_turn:
+        return {"turns": 0}
+    saved = [j - c for j, c in per_turn]
+    return {
+        "turns": len(per_turn),
+        "json_tokens_mean": round(statistics.fmean(j for j, _ in per_turn), 1),
+        "compact_tokens_mean": round(statistics.fmean(c for _, c in per_turn), 1),
+        "saved_tokens_mean": round(statistics.fmean(saved), 1),
+        "saved_tokens_total": sum(saved),
+        "saved_ratio": round(sum(saved) / sum(j for j, _ in per_turn), 3),
+        "exact_token_counts": count_tokens("토큰")[1],
+    }
+
+
+def load_recorded_docs(limit):
+    from pymongo import MongoClient
+
+    client = MongoClient(os.environ.get("MONGO_URI"))
+    for db_name, coll_name in RECORDED_SLOT_COLLECTIONS:
+        cursor = client[db_name][coll_name].find({}, {"slots": 1, "last_asked_item": 1, "_id": 0}).limit(limit)
+        for doc in cursor:
+            yield doc
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="슬롯 상태 직렬화 방식별 토큰 절감 측정")
+    parser.add_argument("--file", help="슬롯 문서 JSON Lines 파일 (생략하면 MONGO_URI에서 읽음)")
+    parser.add_argument("--limit", type=int, default=500, help="컬렉션당 최대 문서 수")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            docs = [json.loads(line) for line in f if line.strip()][:args.limit]
+    else:
+        docs = list(load_recorded_docs(args.limit))
+    print(json.dumps(measure_savings(docs), ensure_ascii=False, indent=2))
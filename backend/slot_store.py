@@ -0,0 +1,243 @@
+#slot_store.py
+#대화형 실험군(chat, phq9_high_c_low_u)의 슬롯 문서와 수정 답변(/api/summary/edit) 저장
+#동기 앱(chatbot_service.py)과 비동기 앱(chatbot_service_async.py)이 같은 규칙으로 읽고 쓰도록
+#쓰기 내용(filter, update)은 한 곳에서 만들고, 실행만 동기(pymongo)/비동기(AsyncMongoClient) 함수로 나눈다.
+import datetime
+import logging
+import os
+
+import pytz
+from pymongo import ReturnDocument
+
+import metrics
+from phq9_rules import detect_asked_item
+
+
+#PHQ-9 항목 정의
+PHQ9_ITEMS = [
+    "흥미나 즐거움 감소", "우울감", "수면 문제", "피로감", "식욕 변화",
+    "자기비하", "집중력 저하", "정신 운동성 지연 또는 초조", "자살 생각"
+]
+#슬롯 문서 저장이 버전 충돌로 실패했을 때 최신 문서에 다시 합쳐 재시도하는 횟수
+SLOT_WRITE_RETRIES = int(os.environ.get("SLOT_WRITE_RETRIES", "3"))
+
+#슬롯 초기화
+def init_slot_structure(user_id):
+    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
+    return {
+        "user_id": user_id,
+        "slots": [
+            {
+                "item": item,
+                "status": "unanswered",
+                "score": None,
+                "raw_user_input": None,
+                "freq_or_intensity": None,
+                "last_updated": None,
+            }
+            for item in PHQ9_ITEMS
+        ],
+        "last_asked_item": None,   # 직전에 봇이 물어본 문항 (규칙 기반 슬롯 추출에 사용)
+        "last_updated": now,
+        "version": 0,   # 슬롯을 바꾸는 쓰기마다 1씩 증가 (compare-and-swap 저장에 사용)
+    }
+
+#슬롯 업데이트 조건 확인 및 적용
+def update_slot_structure(slot_doc, new_slot_data, changes=None):
+    """
+    changes(dict)를 넘기면 바뀐 필드를 {"slots.<idx>.<필드>": 값} 형태로 모아준다.
+    이 dict를 그대로 $set에 넣으면 바뀐 부분만 저장된다.
+    """
+    updated = False
+    now = datetime.datetime.now(pytz.timezone('Asia/Seoul'))
+    if changes is None:
+        changes = {}
+
+    for new_slot in new_slot_data:
+        for idx, existing in enumerate(slot_doc["slots"]):
+            if existing["item"] == new_slot["item"]:
+                prefix = f"slots.{idx}."
+                #score/freq_or_intensity가 null이 아니면 덮어씀
+                if new_slot.get("score") is not None and new_slot["score"] != existing.get("score"):
+                    existing["score"] = changes[prefix + "score"] = new_slot["score"]
+                    updated = True
+                if new_slot.get("freq_or_intensity") is not None and new_slot["freq_or_intensity"] != existing.get("freq_or_intensity"):
+                    existing["freq_or_intensity"] = changes[prefix + "freq_or_intensity"] = new_slot["freq_or_intensity"]
+                    updated = True
+                #raw_user_input은 항상 최신으로 업데이트
+                if new_slot.get("raw_user_input") and new_slot["raw_user_input"] != existing.get("raw_user_input"):
+                    existing["raw_user_input"] = changes[prefix + "raw_user_input"] = new_slot["raw_user_input"]
+                    updated = True
+
+                if ( #6월 25일자 코드 변경한거 
+                    new_slot.get("status")=="answered"
+                    and new_slot.get("freq_or_intensity") is not None
+                    and new_slot.get("score") is not None
+                    and existing['status']!='answered'
+                ):
+                    existing['status'] = changes[prefix + "status"] = 'answered'
+                    updated=True
+                #업데이트되었을 경우 timestamp 갱신
+                if updated:
+                    existing["last_updated"] = changes[prefix + "last_updated"] = now
+                break
+
+    if updated:
+        slot_doc["last_updated"] = changes["last_updated"] = now
+        #9개 문항이 처음 모두 채워진 턴을 기록 (코호트 분석의 완료율/완료까지 걸린 턴 수)
+        if not slot_doc.get("completed_at") and all(s["status"] == "answered" for s in slot_doc["slots"]):
+            slot_doc["completed_at"] = changes["completed_at"] = now
+            slot_doc["completed_turn"] = changes["completed_turn"] = slot_doc.get("turn_count")
+    return slot_doc
+
+
+#슬롯 문서 조회/저장 (턴당 읽기 1번 + 원자적 쓰기 1번)
+#같은 사용자의 턴이 동시에 처리될 수 있으므로(중복 전송, 프록시 재시도) 저장은 version 필드로 compare-and-swap 한다.
+#읽은 뒤 다른 턴이 먼저 저장했으면 최신 문서를 다시 읽어 이번 턴의 업데이트를 합친 뒤 다시 저장한다 (잠금 없음).
+def slot_doc_upsert(user_id, count_turn=True):
+    """
+    슬롯 문서를 읽고, 없으면 초기 구조로 만드는 find_one_and_update의 (filter, update) (upsert 한 번으로 조회/생성).
+    count_turn이면 같은 쓰기에서 턴 수(turn_count)도 하나 올린다. turn_count는 $inc라 version은 올리지 않는다.
+    """
+    defaults = init_slot_structure(user_id)
+    defaults.pop("user_id")
+    update = {"$setOnInsert": defaults}
+    if count_turn:
+        update["$inc"] = {"turn_count": 1}
+    return {"user_id": user_id}, update
+
+
+def load_slot_doc(collection, user_id, count_turn=True):
+    """슬롯 문서를 읽고, 없으면 초기 구조로 만들어 돌려준다."""
+    query, update = slot_doc_upsert(user_id, count_turn)
+    return collection.find_one_and_update(query, update, upsert=True, return_document=ReturnDocument.AFTER)
+
+
+async def aload_slot_doc(collection, user_id, count_turn=True):
+    """load_slot_doc의 비동기 버전 (AsyncMongoClient 컬렉션)"""
+    query, update = slot_doc_upsert(user_id, count_turn)
+    return await collection.find_one_and_update(query, update, upsert=True, return_document=ReturnDocument.AFTER)
+
+
+def slot_version_filter(user_id, version):
+    """읽었을 때의 version과 같은 문서만 고르는 필터 (version이 없는 예전 문서는 0으로 본다)"""
+    return {"user_id": user_id, "version": version if version else {"$in": [0, None]}}
+
+
+def slot_version_update(changes):
+    return {"$set": changes, "$inc": {"version": 1}}
+
+
+def collect_slot_changes(slot_doc, new_slot_data, bot_response=None):
+    """
+    슬롯 업데이트를 적용하고 (갱신된 slot_doc, $set에 넣을 changes)를 반환한다.
+    bot_response가 있으면 이번에 물어본 문항(last_asked_item)도 changes에 포함한다.
+    """
+    changes = {}
+    previous_asked_item = slot_doc.get("last_asked_item")
+    slot_doc = update_slot_structure(slot_doc, new_slot_data, changes)
+    if bot_response is not None:
+        last_asked_item = detect_asked_item(bot_response, slot_doc)
+        if last_asked_item != previous_asked_item:
+            slot_doc["last_asked_item"] = changes["last_asked_item"] = last_asked_item
+    return slot_doc, changes
+
+
+def plan_slot_write(user_id, slot_doc, new_slot_data, bot_response, attempt):
+    """
+    슬롯 업데이트를 적용하고 (갱신된 slot_doc, 쓰기)를 돌려준다. 쓰기는 find_one_and_update의 (filter, update)이고
+    바뀐 것이 없으면 None이다. 마지막 시도(attempt == SLOT_WRITE_RETRIES)는 버전 확인 없이 저장한다.
+    """
+    slot_doc, changes = collect_slot_changes(slot_doc, new_slot_data, bot_response)
+    if not changes:
+        return slot_doc, None
+    if attempt < SLOT_WRITE_RETRIES:
+        return slot_doc, (slot_version_filter(user_id, slot_doc.get("version")), slot_version_update(changes))
+    metrics.record_slot_conflict("overwrite")
+    logging.warning(f"슬롯 저장 버전 충돌이 계속되어 버전 확인 없이 저장 ({user_id})")
+    return slot_doc, ({"user_id": user_id}, slot_version_update(changes))
+
+
+def persist_slot_updates(collection, user_id, slot_doc, new_slot_data, bot_response=None):
+    """
+    슬롯 업데이트를 적용하고 바뀐 필드만 한 번의 원자적 쓰기로 저장한 뒤 저장 후 문서를 반환한다.
+    버전 충돌이면 최신 문서를 다시 읽어 update_slot_structure로 이번 턴의 업데이트를 다시 합치고 재시도한다.
+    SLOT_WRITE_RETRIES번 충돌하면 마지막으로 합친 변경은 버전 확인 없이 저장한다.
+    """
+    for attempt in range(SLOT_WRITE_RETRIES + 1):
+        slot_doc, write = plan_slot_write(user_id, slot_doc, new_slot_data, bot_response, attempt)
+        if write is None:
+            return slot_doc
+        saved = collection.find_one_and_update(*write, return_document=ReturnDocument.AFTER)
+        if saved is not None:
+            return saved
+        metrics.record_slot_conflict("retry")
+        slot_doc = load_slot_doc(collection, user_id, count_turn=False)
+    return slot_doc
+
+
+async def apersist_slot_updates(collection, user_id, slot_doc, new_slot_data, bot_response=None):
+    """persist_slot_updates의 비동기 버전"""
+    for attempt in range(SLOT_WRITE_RETRIES + 1):
+        slot_doc, write = plan_slot_write(user_id, slot_doc, new_slot_data, bot_response, attempt)
+        if write is None:
+            return slot_doc
+        saved = await collection.find_one_and_update(*write, return_document=ReturnDocument.AFTER)
+        if saved is not None:
+            return saved
+        metrics.record_slot_conflict("retry")
+        slot_doc = await aload_slot_doc(collection, user_id, count_turn=False)
+    return slot_doc
+
+
+#/api/summary/edit: 수정한 답변을 edited_answers에 남기고, 수정 가능 고정 문항 세션이면 요약 캐시를 비운다
+def clean_edited_items(edited_items):
+    """요청의 edited_items를 [{"item", "edited_answer"}]로 정리한다. 형식이 틀리면 ValueError(응답에 넣을 메시지)."""
+    if not isinstance(edited_items, list):
+        raise ValueError("edited_items must be a list")
+    cleaned = []
+    for idx, it in enumerate(edited_items):
+        if not isinstance(it, dict):
+            raise ValueError(f"edited_items[{idx}] invalid")
+        item = it.get("item")
+        edited_answer = it.get("edited_answer")
+        if not item:
+            raise ValueError(f"edited_items[{idx}] missing item")
+        if edited_answer is None:
+            edited_answer = ""  # 빈 문자열 허용
+        cleaned.append({
+            "item": item,
+            "edited_answer": edited_answer
+        })
+    return cleaned
+
+
+def edited_answers_writes(user_id, cleaned):
+    """(edited_answers에 넣을 문서, 수정 가능 고정 문항 세션 update_one의 (filter, update))"""
+    doc = {
+        "user_id": user_id,
+        "edited_items": cleaned,
+        "saved_at": datetime.datetime.now(pytz.timezone('Asia/Seoul'))
+    }
+    #수정 가능 고정 문항 세션이면 수정 내용을 반영하도록 요약 캐시를 비운다
+    session_update = (
+        {"user_id": user_id, "answers": {"$exists": True}},
+        {"$set": {"edited_items": cleaned, "summary_cache": None}},
+    )
+    return doc, session_update
+
+
+def save_edited_answers(edited_collection, session_collection, user_id, cleaned):
+    """수정 답변을 저장하고 edited_answers 문서의 id를 돌려준다."""
+    doc, session_update = edited_answers_writes(user_id, cleaned)
+    inserted = edited_collection.insert_one(doc)
+    session_collection.update_one(*session_update)
+    return inserted.inserted_id
+
+
+async def asave_edited_answers(edited_collection, session_collection, user_id, cleaned):
+    """save_edited_answers의 비동기 버전"""
+    doc, session_update = edited_answers_writes(user_id, cleaned)
+    inserted = await edited_collection.insert_one(doc)
+    await session_collection.update_one(*session_update)
+    return inserted.inserted_id
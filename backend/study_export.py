@@ -0,0 +1,346 @@
+#study_export.py
+#연구 데이터 일괄 내보내기 (NDJSON 스트림 또는 Parquet)
+#네 실험군(phq9_chatbot, phq9_fixed_db, phq9_fixed_editable, phq9_high_c_low_u)의 슬롯/세션 문서, 대화 버킷,
+#서버 측 이력과 수정 답변(edited_answers)을 커서 배치로 읽어 행 단위로 내보낸다.
+#필요한 필드만 projection으로 가져오고 문서를 모아 두지 않으므로 메모리 사용량은 데이터 크기와 무관하게 일정하다.
+#읽기는 secondaryPreferred로 보내고, max_docs_per_sec로 속도를 제한해 서비스 트래픽과 겹치지 않게 한다.
+#증분 내보내기: 각 소스의 워터마크 필드(last_updated 등)가 (since, until] 구간인 문서만 읽는다.
+#  - 슬롯/세션/이력 문서는 구간 안에 바뀐 문서의 현재 상태를 내보낸다.
+#  - 대화 버킷은 같은 버킷에 메시지가 계속 추가되므로 저장 시각(stored_at)이 구간 안인 메시지만 내보낸다.
+#    write-behind 저장은 재시도로 요청 시각(timestamp)보다 한참 늦을 수 있으므로 구간은 요청 시각이 아니라 저장 시각으로 나눈다.
+#  CLI는 끝까지 성공했을 때만 출력 파일을 옮기고 until을 상태 파일에 저장한다. 다음 실행은 그 값부터 이어서 읽고,
+#  중간에 실패하면 같은 구간을 다시 읽는다.
+#실행 예시:
+#  python study_export.py --out export.ndjson --state-file export_state.json
+#  python study_export.py --format parquet --out export_dir --since 2025-07-01T00:00:00+09:00
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from collections import namedtuple
+
+from pymongo import ReadPreference
+
+#name: 행의 source 값, kind: 행 형식 (Parquet 파일 하나 = kind 하나)
+ExportSource = namedtuple("ExportSource", ["name", "db", "collection", "watermark", "kind"])
+
+EXPORT_SOURCES = [
+    ExportSource("chat_slots", "phq9_chatbot", "slots", "last_updated", "slots"),
+    ExportSource("chat_history", "phq9_chatbot", "session_history", "updated_at", "history"),
+    ExportSource("fixed_sessions", "phq9_fixed_db", "slots", "last_updated", "sessions"),
+    ExportSource("fixed_dialog", "phq9_fixed_db", "phq9_fixed_dialog", "last_stored_at", "dialog"),
+    ExportSource("fixed_history", "phq9_fixed_db", "session_history", "updated_at", "history"),
+    ExportSource("editable_sessions", "phq9_fixed_editable", "slots", "last_updated", "sessions"),
+    ExportSource("editable_dialog", "phq9_fixed_editable", "dialog", "last_stored_at", "dialog"),
+    ExportSource("editable_history", "phq9_fixed_editable", "session_history", "updated_at", "history"),
+    ExportSource("high_slots", "phq9_high_c_low_u", "slots", "last_updated", "slots"),
+    ExportSource("high_history", "phq9_high_c_low_u", "session_history", "updated_at", "history"),
+    ExportSource("edited_answers", "phq9_chatbot", "edited_answers", "saved_at", "edited_answers"),
+]
+
+PROJECTIONS = {
+    "slots": {"_id": 0, "user_id": 1, "slots": 1, "last_updated": 1},
+    "sessions": {"_id": 0, "user_id": 1, "current_index": 1, "answers": 1, "last_updated": 1},
+    "dialog": {"_id": 0, "user": 1, "messages": 1},
+    "history": {"messages": 1, "updated_at": 1},  #_id가 user_id
+    "edited_answers": {"user_id": 1, "edited_items": 1, "saved_at": 1},
+}
+
+#kind별 열 (이름, 타입). 모든 행에는 source와 arm(데이터베이스 이름)이 붙는다.
+COLUMNS = {
+    "slots": [
+        ("user_id", "string"), ("item", "string"), ("status", "string"), ("score", "int"),
+        ("raw_user_input", "string"), ("freq_or_intensity", "string"),
+        ("slot_updated_at", "timestamp"), ("updated_at", "timestamp"),
+    ],
+    "sessions": [
+        ("user_id", "string"), ("question_index", "int"), ("answer", "string"),
+        ("current_index", "int"), ("updated_at", "timestamp"),
+    ],
+    "dialog": [("user_id", "string"), ("sender", "string"), ("text", "string"), ("timestamp", "timestamp")],
+    "history": [("user_id", "string"), ("position", "int"), ("text", "string"), ("updated_at", "timestamp")],
+    "edited_answers": [
+        ("user_id", "string"), ("edited_id", "string"), ("item", "string"),
+        ("edited_answer", "string"), ("saved_at", "timestamp"),
+    ],
+}
+
+
+#until 기본값을 현재 시각보다 이만큼 앞으로 당긴다. 요청 처리 중에 잡은 timestamp가 내보내기를 시작한 뒤에
+#저장되거나 서버 간 시계가 조금 어긋나도, 그런 문서가 이번 구간에서 빠진 채 다음 구간에서도 빠지지 않게 한다.
+WATERMARK_LAG_SECONDS = 5
+
+
+def export_now(lag_seconds=WATERMARK_LAG_SECONDS):
+    """내보내기 구간의 끝(until) 기본값. MongoDB datetime 정밀도에 맞춰 밀리초 단위로 자른다."""
+    now = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=lag_seconds)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def to_utc(value):
+    """MongoDB의 naive UTC datetime과 ISO 문자열(규칙 기반 슬롯의 last_updated)을 aware UTC로 맞춘다."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def parse_watermark(text):
+    """ISO 8601 문자열 → aware UTC datetime (빈 값이면 None, 시간대가 없으면 UTC로 본다)"""
+    if not text:
+        return None
+    try:
+        return to_utc(datetime.datetime.fromisoformat(text.strip().replace("Z", "+00:00")))
+    except ValueError:
+        raise ValueError(f"워터마크 형식이 잘못되었습니다: {text!r}")
+
+
+def format_watermark(value):
+    return value.isoformat().replace("+00:00", "Z")
+
+
+def select_sources(names=None, sources=EXPORT_SOURCES):
+    """쉼표로 구분한 source 이름 또는 kind로 소스를 고른다 (없으면 전체)."""
+    if not names:
+        return list(sources)
+    wanted = {name.strip() for name in names.split(",") if name.strip()}
+    selected = [s for s in sources if s.name in wanted or s.kind in wanted]
+    unknown = wanted - {s.name for s in selected} - {s.kind for s in selected}
+    if unknown:
+        raise ValueError(f"알 수 없는 소스: {', '.join(sorted(unknown))}")
+    return selected
+
+
+def export_query(source, since, until):
+    if source.kind == "dialog":
+        #열린 버킷은 last_stored_at이 계속 바뀌므로 구간 뒤에 저장된 메시지가 있는 버킷을 모두 읽고
+        #메시지는 rows_from_doc에서 거른다. last_stored_at이 없는 예전 버킷은 last_ts로 판단한다.
+        if since is None:
+            return {}
+        return {"$or": [
+            {"last_stored_at": {"$gt": since}},
+            {"last_stored_at": {"$exists": False}, "last_ts": {"$gt": since}},
+        ]}
+    bounds = {"$lte": until}
+    if since is not None:
+        bounds["$gt"] = since
+    return {source.watermark: bounds}
+
+
+def _in_window(ts, since, until):
+    return ts is not None and (since is None or ts > since) and ts <= until
+
+
+def rows_from_doc(source, doc, since, until):
+    """문서 하나를 kind 형식의 행(dict)들로 편다."""
+    base = {"source": source.name, "arm": source.db}
+    if source.kind == "slots":
+        updated_at = to_utc(doc.get("last_updated"))
+        for slot in doc.get("slots") or []:
+            yield dict(
+                base, user_id=doc.get("user_id"), item=slot.get("item"), status=slot.get("status"),
+                score=slot.get("score"), raw_user_input=slot.get("raw_user_input"),
+                freq_or_intensity=slot.get("freq_or_intensity"),
+                slot_updated_at=to_utc(slot.get("last_updated")), updated_at=updated_at,
+            )
+    elif source.kind == "sessions":
+        updated_at = to_utc(doc.get("last_updated"))
+        answers = doc.get("answers") or {}
+        for index in sorted(answers, key=int):
+            yield dict(
+                base, user_id=doc.get("user_id"), question_index=int(index), answer=answers[index],
+                current_index=doc.get("current_index"), updated_at=updated_at,
+            )
+    elif source.kind == "dialog":
+        for message in doc.get("messages") or []:
+            ts = to_utc(message.get("timestamp"))
+            if _in_window(to_utc(message.get("stored_at")) or ts, since, until):
+                yield dict(base, user_id=doc.get("user"), sender=message.get("sender"), text=message.get("text"), timestamp=ts)
+    elif source.kind == "history":
+        updated_at = to_utc(doc.get("updated_at"))
+        for position, text in enumerate(doc.get("messages") or []):
+            yield dict(base, user_id=doc.get("_id"), position=position, text=text, updated_at=updated_at)
+    elif source.kind == "edited_answers":
+        saved_at = to_utc(doc.get("saved_at"))
+        for edited in doc.get("edited_items") or []:
+            yield dict(
+                base, user_id=doc.get("user_id"), edited_id=str(doc.get("_id")), item=edited.get("item"),
+                edited_answer=edited.get("edited_answer"), saved_at=saved_at,
+            )
+
+
+def iter_export_rows(mongo_client, since=None, until=None, sources=EXPORT_SOURCES, batch_size=500,
+                     max_docs_per_sec=0, stats=None):
+    """
+    소스를 차례로 커서 배치(batch_size)로 읽어 행을 하나씩 내보낸다.
+    max_docs_per_sec > 0이면 배치마다 쉬어서 초당 읽는 문서 수를 제한한다.
+    stats(dict)를 넘기면 소스별 문서/행 수를 채운다.
+    """
+    until = until or export_now()
+    for source in sources:
+        collection = mongo_client[source.db][source.collection].with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED)
+        cursor = collection.find(export_query(source, since, until), PROJECTIONS[source.kind]).batch_size(batch_size)
+        started_at = time.monotonic()
+        docs = rows = 0
+        try:
+            for doc in cursor:
+                docs += 1
+                for row in rows_from_doc(source, doc, since, until):
+                    rows += 1
+                    yield row
+                if max_docs_per_sec > 0 and docs % batch_size == 0:
+                    ahead = docs / max_docs_per_sec - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        finally:
+            cursor.close()
+            if stats is not None:
+                stats[source.name] = {"docs": docs, "rows": rows}
+        logging.info(f"내보내기 {source.name}: 문서 {docs}개, 행 {rows}개 ({time.monotonic() - started_at:.1f}초)")
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return format_watermark(to_utc(value))
+    return str(value)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, default=_json_default) + "\n"
+
+
+def write_ndjson(rows, fp):
+    count = 0
+    for line in ndjson_lines(rows):
+        fp.write(line)
+        count += 1
+    return count
+
+
+class ParquetExportWriter:
+    """
+    kind별로 <out_dir>/<kind>.parquet 파일을 만들고 row_group_size 행마다 row group 하나로 쓴다.
+    메모리에는 kind별로 row group 하나 분량만 둔다. close() 전까지는 .tmp 파일에 쓴다. (pip install pyarrow 필요)
+    """
+
+    def __init__(self, out_dir, row_group_size=10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+        self.out_dir = out_dir
+        self.row_group_size = row_group_size
+        self._types = {"string": pa.string(), "int": pa.int64(), "timestamp": pa.timestamp("us", tz="UTC")}
+        self._writers = {}
+        self._buffers = {}
+        self.rows = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _path(self, kind):
+        return os.path.join(self.out_dir, f"{kind}.parquet")
+
+    def _schema(self, kind):
+        fields = [("source", "string"), ("arm", "string")] + COLUMNS[kind]
+        return self._pa.schema([(name, self._types[type_name]) for name, type_name in fields])
+
+    def _flush(self, kind):
+        buffer = self._buffers.get(kind)
+        if not buffer:
+            return
+        if kind not in self._writers:
+            self._writers[kind] = self._pq.ParquetWriter(self._path(kind) + ".tmp", self._schema(kind))
+        writer = self._writers[kind]
+        writer.write_table(self._pa.Table.from_pylist(buffer, schema=writer.schema))
+        buffer.clear()
+
+    def write(self, kind, row):
+        buffer = self._buffers.setdefault(kind, [])
+        buffer.append(row)
+        self.rows += 1
+        if len(buffer) >= self.row_group_size:
+            self._flush(kind)
+
+    def close(self):
+        for kind in list(self._buffers):
+            self._flush(kind)
+        for kind, writer in self._writers.items():
+            writer.close()
+            os.replace(self._path(kind) + ".tmp", self._path(kind))
+
+
+def run_export(mongo_client, fmt, out, since=None, until=None, sources=EXPORT_SOURCES, batch_size=500,
+               max_docs_per_sec=0):
+    """내보내기를 끝까지 실행하고 {"watermark", "rows", "sources"}를 반환한다."""
+    until = until or export_now()
+    stats = {}
+    rows = iter_export_rows(mongo_client, since, until, sources, batch_size, max_docs_per_sec, stats)
+    kinds = {s.name: s.kind for s in sources}
+    if fmt == "parquet":
+        writer = ParquetExportWriter(out)
+        for row in rows:
+            writer.write(kinds[row["source"]], row)
+        writer.close()
+        count = writer.rows
+    elif out == "-":
+        count = write_ndjson(rows, sys.stdout)
+    else:
+        with open(out + ".tmp", "w", encoding="utf-8") as fp:
+            count = write_ndjson(rows, fp)
+        os.replace(out + ".tmp", out)
+    return {"watermark": format_watermark(until), "since": since and format_watermark(since), "rows": count,
+            "sources": stats}
+
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(path, result):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = argparse.ArgumentParser(description="PHQ-9 연구 데이터 내보내기")
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson")
+    parser.add_argument("--out", default="-", help="NDJSON 파일 경로('-'이면 표준 출력) 또는 Parquet 디렉터리")
+    parser.add_argument("--since", help="이 시각 이후에 바뀐 데이터만 (ISO 8601, 생략하면 상태 파일의 워터마크)")
+    parser.add_argument("--until", help="이 시각까지 (기본: 시작 시각)")
+    parser.add_argument("--state-file", help="성공 시 다음 실행의 워터마크를 저장할 파일")
+    parser.add_argument("--sources", help="쉼표로 구분한 source 이름 또는 kind (기본: 전체)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--max-docs-per-sec", type=float, default=0, help="초당 읽을 최대 문서 수 (0이면 제한 없음)")
+    args = parser.parse_args()
+    if args.format == "parquet" and args.out == "-":
+        parser.error("--format parquet에는 --out 디렉터리가 필요합니다")
+
+    since = parse_watermark(args.since or load_state(args.state_file).get("watermark"))
+    client = MongoClient(os.environ.get("MONGO_URI"))
+    result = run_export(
+        client, args.format, args.out, since, parse_watermark(args.until), select_sources(args.sources),
+        args.batch_size, args.max_docs_per_sec,
+    )
+    if args.state_file:
+        save_state(args.state_file, result)
+    print(json.dumps(result, ensure_ascii=False, indent=2), file=sys.stderr)
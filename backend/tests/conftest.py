@@ -0,0 +1,5 @@
+#backend/ 모듈을 패키지 없이 바로 import할 수 있게 한다 (bench/run_bench.py와 동일)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
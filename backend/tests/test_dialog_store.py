@@ -0,0 +1,119 @@
+import datetime
+import threading
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from dialog_store import DialogWriter, dialog_message
+from study_export import EXPORT_SOURCES, rows_from_doc
+
+
+class RecordingCollection:
+    """update_one/bulk_write 호출만 기록하는 컬렉션. bulk_write는 release가 set될 때까지 막을 수 있다."""
+
+    full_name = "test.dialog"
+
+    def __init__(self):
+        self.single_writes = []
+        self.bulk_writes = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def update_one(self, query, update, upsert=False):
+        self.single_writes.append(query["user"])
+
+    def bulk_write(self, ops, ordered=True):
+        self.release.wait(5)
+        self.bulk_writes.append(len(ops))
+
+
+def turn(text):
+    return [dialog_message("user", text, datetime.datetime.now(datetime.timezone.utc))]
+
+
+def test_routine_turns_are_batched():
+    collection = RecordingCollection()
+    writer = DialogWriter(flush_interval=0.01)
+    for i in range(5):
+        writer.append(collection, f"user{i}", turn("답변"))
+    assert writer.flush(5)
+    assert collection.single_writes == []
+    assert sum(collection.bulk_writes) == 5
+    writer.close()
+
+
+def test_durable_turn_is_written_before_append_returns():
+    collection = RecordingCollection()
+    collection.release.clear()  #백그라운드 쓰기가 멈춰 있어도
+    events = []
+    writer = DialogWriter(flush_interval=0.01, on_event=lambda event, count: events.append(event))
+    writer.append(collection, "routine", turn("답변"))
+    writer.append(collection, "crisis", turn("죽고 싶다는 생각이 들어요"), durable=True)
+    assert collection.single_writes == ["crisis"]
+    assert "sync_write" in events
+    collection.release.set()
+    writer.close()
+    assert collection.bulk_writes == [1]
+
+
+class FlakyCollection(RecordingCollection):
+    """처음 failures번은 연결 오류를 내고, 성공한 bulk_write의 연산을 남긴다."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.ops = []
+
+    def bulk_write(self, ops, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("connection refused")
+        self.ops.extend(ops)
+
+
+def test_retried_turn_is_stamped_at_write_time():
+    collection = FlakyCollection(failures=2)
+    writer = DialogWriter(flush_interval=0.01, retry_backoff=0.2)
+    messages = turn("답변")
+    writer.append(collection, "user", messages)
+    assert writer.flush(5)
+    writer.close()
+    update = collection.ops[0]._doc
+    stored_at = update["$max"]["last_stored_at"]
+    assert stored_at - messages[0]["timestamp"] >= datetime.timedelta(seconds=0.5)
+    assert update["$push"]["messages"]["$each"][0]["stored_at"] == stored_at
+
+
+def test_late_written_message_is_exported_in_its_write_window():
+    source = next(s for s in EXPORT_SOURCES if s.kind == "dialog")
+    requested = datetime.datetime(2025, 7, 1, 9, 0, tzinfo=datetime.timezone.utc)
+    stored = requested + datetime.timedelta(minutes=10)
+    doc = {"user": "u1", "messages": [dict(dialog_message("user", "답변", requested), stored_at=stored)]}
+    before = list(rows_from_doc(source, doc, requested - datetime.timedelta(minutes=1), requested + datetime.timedelta(minutes=1)))
+    after = list(rows_from_doc(source, doc, requested + datetime.timedelta(minutes=1), stored))
+    assert before == []
+    assert [row["timestamp"] for row in after] == [requested]
+
+
+class WriteConcernCollection(RecordingCollection):
+    """적용은 했지만 write concern 오류를 내는 컬렉션."""
+
+    def bulk_write(self, ops, ordered=True):
+        self.bulk_writes.append(len(ops))
+        raise BulkWriteError({
+            "writeErrors": [], "nUpserted": len(ops),
+            "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}],
+        })
+
+
+def test_write_concern_error_counts_batch_as_written_without_resending():
+    collection = WriteConcernCollection()
+    events = []
+    writer = DialogWriter(flush_interval=0.01, on_event=lambda event, count: events.append((event, count)))
+    writer.append(collection, "user0", turn("답변"))
+    writer.append(collection, "user1", turn("답변"))
+    assert writer.flush(5)
+    writer.close()
+    assert sum(collection.bulk_writes) == 2
+    assert ("dropped", 1) not in events
+    assert sum(count for event, count in events if event == "written") == 2
+    assert "write_concern_error" in [event for event, _ in events]
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from llm_admission import AdmissionController, AdmissionRejected, PRIORITY_CRISIS
+
+
+def test_async_admission_waits_for_a_released_slot():
+    controller = AdmissionController(max_concurrent=1, max_wait=1.0)
+
+    async def scenario():
+        first = await controller.aadmit()
+        waiting = asyncio.ensure_future(controller.aadmit())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        first.release()
+        second = await asyncio.wait_for(waiting, 1.0)
+        second.release()
+
+    asyncio.run(scenario())
+    assert controller.active == 0
+    assert controller.queue_depths() == {"crisis": 0, "routine": 0}
+
+
+def test_async_admission_rejects_routine_turns_but_not_crisis_turns():
+    events = []
+    controller = AdmissionController(max_concurrent=1, max_wait=0.05, crisis_max_wait=0.05,
+                                     on_event=lambda event, priority: events.append(event))
+    held = controller.admit()
+
+    async def scenario():
+        with pytest.raises(AdmissionRejected):
+            await controller.aadmit()
+        return await controller.aadmit(PRIORITY_CRISIS)
+
+    crisis = asyncio.run(scenario())
+    assert events[-3:] == ["rejected_timeout", "crisis_overflow", "admitted"]
+    crisis.release()
+    held.release()
+    assert controller.active == 0
@@ -0,0 +1,66 @@
+import os
+import uuid
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from mongo_indexes import ENDPOINT_QUERIES, REQUIRED_INDEXES, ensure_indexes, plan_stages, verify_query_plans
+
+#explain 확인은 실제 mongod가 필요하다 (mongomock은 쿼리 플랜이 없음). 없으면 건너뛴다.
+MONGO_TEST_URI = os.environ.get("MONGO_TEST_URI", "mongodb://localhost:27017")
+
+
+@pytest.fixture
+def mongo_client():
+    client = MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        pytest.skip(f"mongod에 연결할 수 없음: {MONGO_TEST_URI}")
+    yield client
+    client.close()
+
+
+def with_prefix(mapping, prefix):
+    """운영 데이터베이스를 건드리지 않도록 (db, collection) 키의 db 이름에 접두사를 붙인다."""
+    return {(prefix + db_name, coll_name): value for (db_name, coll_name), value in mapping.items()}
+
+
+def test_endpoint_queries_have_indexes():
+    for queries in ENDPOINT_QUERIES.values():
+        for collection, _, _ in queries:
+            assert collection in REQUIRED_INDEXES
+
+
+def test_plan_stages_collects_nested_stages():
+    plan = {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+    assert plan_stages(plan) == ["LIMIT", "FETCH", "IXSCAN"]
+
+
+def test_endpoint_queries_use_indexes(mongo_client):
+    prefix = f"test_{uuid.uuid4().hex[:8]}_"
+    required = with_prefix(REQUIRED_INDEXES, prefix)
+    endpoint_queries = {
+        endpoint: [((prefix + db_name, coll_name), query, sort) for (db_name, coll_name), query, sort in queries]
+        for endpoint, queries in ENDPOINT_QUERIES.items()
+    }
+    try:
+        ensure_indexes(mongo_client, required=required, obsolete={})
+        report = verify_query_plans(mongo_client, endpoint_queries)
+        not_indexed = [(endpoint, r["collection"], r["stages"])
+                       for endpoint, results in report.items() for r in results if not r["uses_index"]]
+        assert not_indexed == []
+    finally:
+        for db_name in {db_name for db_name, _ in required}:
+            mongo_client.drop_database(db_name)
+
+
+def test_export_sources_have_watermark_indexes():
+    from study_export import EXPORT_SOURCES
+
+    for source in EXPORT_SOURCES:
+        models = REQUIRED_INDEXES.get((source.db, source.collection), [])
+        leading_fields = [next(iter(model.document["key"])) for model in models]
+        assert source.watermark in leading_fields, source.name
@@ -0,0 +1,86 @@
+import pytest
+
+from phq9_rules import PHQ9_ITEM_KEYWORDS, parse_frequency, rule_based_slot_update
+
+
+@pytest.mark.parametrize("text, score", [
+    #날수/주당 횟수
+    ("일주일에 3번 정도요", 1),
+    ("일주일에 4번", 2),
+    ("주 5일", 2),
+    ("주5일은 그래요", 2),
+    ("한 주에 두 번", 1),
+    ("매주 5번은", 2),
+    ("3~4일 정도", 1),
+    ("열흘 정도요", 2),
+    ("2주 내내요", 3),
+    #간격으로 말한 경우
+    ("이틀에 한 번", 2),
+    ("2일에 한 번", 2),
+    ("3일마다요", 1),
+    #빠짐없이
+    ("하루도 안 빼고요", 3),
+    ("하루도 빠짐없이", 3),
+    ("빠짐없이 그랬어요", 3),
+    ("거의 매일이요", 3),
+    #0점
+    ("전혀 없었어요", 0),
+    ("하루도 없었어요", 0),
+    ("아니요", 0),
+])
+def test_frequency_score(text, score):
+    match = parse_frequency(text)
+    assert match is not None
+    assert match.score == score
+
+
+@pytest.mark.parametrize("text", [
+    #강도나 하루 안의 횟수는 빈도 답변이 아니다 (GPT 슬롯 추출로 넘김)
+    "하루 종일 피곤해요",
+    "온종일 누워만 있어요",
+    "하루에도 몇 번",
+    "하루에도 여러 번 울컥해요",
+    #하루 안의 양(횟수/시간/끼니)이나 "하루도 못"은 날수가 아니다
+    "하루 세 끼 잘 먹어요",
+    "하루에 두 번",
+    "하루에 한 번씩은",
+    "하루 2시간 자요",
+    "하루에 12시간 자요",
+    "하루도 못 잤어요",
+    "하루도 안 자고 버텼어요",
+    #부정/불확실/섞인 표현
+    "매일은 아니고요",
+    "잘 모르겠어요",
+    "가끔이요 아니 거의 매일",
+    "",
+])
+def test_not_a_frequency_answer(text):
+    assert parse_frequency(text) is None
+
+
+def test_phrase_keeps_original_wording():
+    assert parse_frequency("3~4일 정도요").phrase == "3~4일 정도"
+
+
+def slot_doc(last_asked_item):
+    return {
+        "last_asked_item": last_asked_item,
+        "slots": [{"item": item, "status": "unanswered", "score": None} for item in PHQ9_ITEM_KEYWORDS],
+    }
+
+
+def test_rule_based_update_scores_asked_item():
+    updates = rule_based_slot_update(slot_doc("수면 문제"), "거의 매일이요")
+    assert [(u["item"], u["score"]) for u in updates] == [("수면 문제", 3)]
+
+
+@pytest.mark.parametrize("asked, text", [
+    #수면 질문에 자살 생각으로 답한 경우: 수면 점수로 기록하면 9번 문항이 빠진다
+    ("수면 문제", "죽고 싶을 때가 가끔 있어요"),
+    #다른 문항에 대한 빈도
+    ("수면 문제", "입맛이 없는 날이 거의 매일이에요"),
+    #위기 문항을 물었더라도 규칙 기반으로 확정하지 않는다
+    ("자살 생각", "죽고 싶을 때가 가끔 있어요"),
+])
+def test_rule_based_update_defers_other_items(asked, text):
+    assert rule_based_slot_update(slot_doc(asked), text) is None
@@ -0,0 +1,22 @@
+from session_history import SessionHistoryStore, parse_client_history
+
+GREETING = "안녕하세요~저는 챗봇이입니다! 혹시 요즘 스트레스 받는 일 없으신가요?"
+
+
+def test_parse_client_history():
+    #Node 서버는 "|인사말" 형태로 보낸다
+    assert parse_client_history(f"|{GREETING}") == [GREETING]
+    assert parse_client_history(None) == []
+
+
+def test_first_turn_starts_from_client_history():
+    store = SessionHistoryStore()
+    history = store.get("user", [GREETING])
+    assert history == [GREETING]
+    assert store.append("user", history, "요즘 잠을 못 자요", "그러셨군요") == [GREETING, "요즘 잠을 못 자요", "그러셨군요"]
+
+
+def test_server_history_wins_over_client_history():
+    store = SessionHistoryStore()
+    store.append("user", [], "첫 메시지", "첫 응답")
+    assert store.get("user", ["클라이언트가 보낸 이력"]) == ["첫 메시지", "첫 응답"]
@@ -0,0 +1,31 @@
+import json
+
+from phq9_rules import PHQ9_ITEM_KEYWORDS
+from prompts import build_slot_system_prompt
+from slot_schema import SlotUpdateParser
+
+PHQ9_ITEMS = list(PHQ9_ITEM_KEYWORDS)
+
+
+def prompt_example(prompt):
+    #"예시:" 뒤의 JSON 객체
+    return prompt.split("예시:", 1)[1].split("\n- ", 1)[0]
+
+
+def test_prompt_example_is_updates_object():
+    example = json.loads(prompt_example(build_slot_system_prompt(PHQ9_ITEMS)))
+    assert list(example) == ["updates"]
+
+
+def test_prompt_example_parses():
+    rejected = []
+    parser = SlotUpdateParser(PHQ9_ITEMS, on_reject=rejected.append)
+    updates = parser.parse(prompt_example(build_slot_system_prompt(PHQ9_ITEMS)))
+    assert [(u.item, u.score, u.freq_or_intensity) for u in updates] == [("식욕 변화", 1, "3~4일 정도")]
+    assert rejected == []
+
+
+def test_legacy_array_still_parses():
+    parser = SlotUpdateParser(PHQ9_ITEMS)
+    text = '```json\n[{"item": "우울감", "status": "answered", "score": 2, "raw_user_input": "자주요", "freq_or_intensity": "자주", "last_updated": null}]\n```'
+    assert [u.item for u in parser.parse(text)] == ["우울감"]
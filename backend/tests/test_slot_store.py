@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from slot_store import apersist_slot_updates, clean_edited_items, init_slot_structure, persist_slot_updates
+
+ANSWER = [{"item": "수면 문제", "status": "answered", "score": 2, "raw_user_input": "거의 못 자요", "freq_or_intensity": "거의 매일"}]
+
+
+class ConflictingCollection:
+    """처음 conflicts번의 버전 확인 쓰기는 다른 턴이 먼저 저장한 것처럼 실패하는 슬롯 컬렉션."""
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        self.doc = init_slot_structure("user")
+        self.filters = []
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        self.filters.append(query)
+        if "$setOnInsert" in update:
+            return self.doc
+        if "version" in query and self.conflicts:
+            self.conflicts -= 1
+            self.doc["version"] += 1
+            return None
+        self.doc["version"] += 1
+        return dict(self.doc, saved=True)
+
+
+class AsyncConflictingCollection(ConflictingCollection):
+    async def find_one_and_update(self, *args, **kwargs):
+        return super().find_one_and_update(*args, **kwargs)
+
+
+def test_sync_and_async_persist_retry_conflicts_the_same_way():
+    sync_collection = ConflictingCollection(conflicts=1)
+    saved = persist_slot_updates(sync_collection, "user", init_slot_structure("user"), ANSWER)
+    async_collection = AsyncConflictingCollection(conflicts=1)
+    asaved = asyncio.run(apersist_slot_updates(async_collection, "user", init_slot_structure("user"), ANSWER))
+    assert saved["saved"] and asaved["saved"]
+    assert sync_collection.filters == async_collection.filters
+
+
+def test_clean_edited_items():
+    assert clean_edited_items([{"item": "피로감", "edited_answer": None}]) == [{"item": "피로감", "edited_answer": ""}]
+    with pytest.raises(ValueError, match="must be a list"):
+        clean_edited_items("피로감")
+    with pytest.raises(ValueError, match=r"edited_items\[0\] missing item"):
+        clean_edited_items([{"edited_answer": "수정"}])